@@ -1,2 +1,19 @@
-from .get_inputs import get_inputs
-from .run_decon import run_5d_decon
+import os
+
+# A thread policy from the environment must be in place before numpy or TensorFlow start their pools
+if os.environ.get('RLDECON_THREADS') or os.environ.get('RLDECON_WORKERS'):
+    from .threads import ThreadPolicy
+    ThreadPolicy.from_env().apply()
+
+# get_inputs and run_5d_decon pull in TensorFlow, flowdec and tkinter, so they are imported on
+# first use. This keeps the lightweight modules (e.g. RLDecon.telemetry) importable from
+# environments that only have numpy/cupy, such as the one used by ScottRLDecon/rlgc.py.
+def __getattr__(name):
+    if name == 'get_inputs':
+        from .get_inputs import get_inputs as value
+    elif name == 'run_5d_decon':
+        from .run_decon import run_5d_decon as value
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
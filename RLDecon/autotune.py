@@ -0,0 +1,158 @@
+import json
+import os
+import platform
+import threading
+import time
+
+import numpy as np
+import scipy.fft
+
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.rldecon', 'autotune.json')
+
+# Relative L2 difference from the reference engine a candidate may have to be chosen
+DEFAULT_TOLERANCE = 0.02
+
+# Benchmarks run on the central block of the first volume, at most this many y/x pixels
+SAMPLE_SIZE = 256
+
+# Padding is only ever grown by up to this much to reach FFT-friendly sizes
+MAX_EXTRA_PAD = 16
+
+_lock = threading.Lock()
+
+
+def fast_pad(shape, pad_amount):
+    """Smallest padding >= pad_amount that makes the most padded axes 5-smooth (fast FFT sizes)."""
+    def slow_axes(pad):
+        return sum(scipy.fft.next_fast_len(n + 2*pad, real=True) != n + 2*pad for n in shape)
+    return min(range(pad_amount, pad_amount + MAX_EXTRA_PAD + 1), key=lambda pad: (slow_axes(pad), pad))
+
+
+def available_backends(flowdec = True):
+    """Engines that can run here as (mode, backend) pairs, the flowdec reference first (unless flowdec=False)."""
+    candidates = []
+    try:
+        if flowdec:
+            import flowdec  # noqa: F401
+            candidates.append(('rl', None))
+    except ImportError:
+        pass
+    candidates.append(('rfft', 'numpy'))
+    try:
+        import cupy
+        if cupy.cuda.runtime.getDeviceCount() > 0:
+            candidates.append(('rfft', 'cupy'))
+    except Exception:
+        pass
+    return candidates
+
+
+def describe(config):
+    return ' '.join([config['mode']] + ([config['backend']] if config['backend'] else []) + [f"padding {config['pad_amount']}"])
+
+
+def candidate_configs(shape, pad_amount, flowdec = True):
+    return [{'mode': mode, 'backend': backend, 'pad_amount': pad}
+            for mode, backend in available_backends(flowdec) for pad in sorted({pad_amount, fast_pad(shape, pad_amount)})]
+
+
+def sample_volume(volume, size = SAMPLE_SIZE):
+    """Central (z, <=size, <=size) block of a volume, so benchmarks stay short on large stacks."""
+    return volume[tuple(slice(max(0, (n - size) // 2), max(0, (n - size) // 2) + size) if axis else slice(None)
+                        for axis, n in enumerate(volume.shape))]
+
+
+def cache_key(shape, kernel_shape, niter, pad_amount, options = None):
+    # options (regularization, cutoff, coarse start) only appear when set, so plain keys stay as they were
+    options = {k: v for k, v in (options or {}).items() if v is not None}
+    extra = ''.join(f'|{k}={v}' for k, v in sorted(options.items()))
+    return f'{platform.node()}|{tuple(shape)}|{tuple(kernel_shape)}|{niter}|{pad_amount}{extra}'
+
+
+def load_cache(cache_file_str = CACHE_FILE):
+    if cache_file_str and os.path.exists(cache_file_str):
+        with open(cache_file_str) as f:
+            return json.load(f)
+    return {}
+
+
+def save_decision(key, decision, cache_file_str = CACHE_FILE):
+    if not cache_file_str:
+        return
+    with _lock:
+        cache = load_cache(cache_file_str)
+        cache[key] = decision
+        os.makedirs(os.path.dirname(cache_file_str), exist_ok=True)
+        tmp_file_str = cache_file_str + '.tmp'
+        with open(tmp_file_str, 'w') as f:
+            json.dump(cache, f, indent=1)
+        os.replace(tmp_file_str, cache_file_str)
+
+
+def benchmark(volume, kernel, niter, config, repeats = 1, options = None):
+    """Seconds per run of one engine configuration after a warm-up run, and its result."""
+    from .deconvolvers import get_deconvolver
+    from .run_decon import deconvolve
+    algo = get_deconvolver(config['mode'], volume.ndim, config['pad_amount'], backend=config['backend'],
+                           **(options or {}))
+    # The warm-up builds the graph/session or OTF cache, which later volumes get for free
+    deconvolve(volume.copy(), kernel, 1, algo)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        result = deconvolve(volume.copy(), kernel, niter, algo)
+    return (time.perf_counter() - start) / repeats, np.asarray(result, dtype=np.float32)
+
+
+def autotune(volume, kernel, niter, pad_amount = 16, tolerance = DEFAULT_TOLERANCE, bench_iterations = 3,
+             cache_file_str = CACHE_FILE, regularization = None, cutoff = None, coarse_factor = None,
+             coarse_iterations = None):
+    """
+    Pick the fastest engine, backend and padding for deconvolving volumes like `volume`.
+
+    Every candidate (flowdec, the rl.py engine on numpy and, with a GPU, cupy, each at the given
+    padding and at the nearest FFT-friendly one) deconvolves the central block of `volume` for
+    `bench_iterations` iterations. Candidates whose result is within `tolerance` (relative L2)
+    of the first candidate, flowdec when it is installed, qualify and the fastest one wins. The
+    decision is cached per host, volume shape, kernel shape, niter, padding and engine options in
+    `cache_file_str` (~/.rldecon/autotune.json), so later runs skip the benchmark.
+
+    regularization, cutoff and the coarse-to-fine start (coarse_factor, coarse_iterations) are
+    passed to every candidate. flowdec can do none of them, so when any is set only the rl.py
+    engine competes and its numpy run is the reference.
+
+    Returns:
+    - dict with 'mode', 'backend' and 'pad_amount' (plus the benchmark 'seconds' and 'error').
+    """
+    options = {'regularization': regularization, 'cutoff': cutoff, 'coarse_factor': coarse_factor,
+               'coarse_iterations': coarse_iterations}
+    rfft_only = any(v is not None for v in options.values())
+    key = cache_key(volume.shape, kernel.shape, niter, pad_amount, options)
+    cached = load_cache(cache_file_str).get(key)
+    if cached is not None:
+        print(f'Autotune (cached): {describe(cached)}')
+        return cached
+
+    sample = np.asarray(sample_volume(volume), dtype=np.float32)
+    # FFT-friendly padding is judged on the full volume, which is what the choice is used for
+    configs = candidate_configs(volume.shape, pad_amount, flowdec=not rfft_only)
+    reference = None
+    best = None
+    for config in configs:
+        try:
+            seconds, result = benchmark(sample, kernel, min(niter, bench_iterations), config,
+                                        options=options if config['mode'] == 'rfft' else None)
+        except Exception as e:
+            print(f'Autotune: {describe(config)} failed: {e}')
+            continue
+        if reference is None:
+            reference = result
+        error = float(np.linalg.norm(result - reference) / max(np.linalg.norm(reference), 1e-12))
+        ok = error <= tolerance
+        print(f"Autotune: {describe(config)}: {seconds:.3f} s, error {error:.2e}{'' if ok else ' (rejected)'}")
+        if ok and (best is None or seconds < best['seconds']):
+            best = dict(config, seconds=seconds, error=error)
+    if best is None:
+        raise RuntimeError('Autotune: no engine could deconvolve the sample volume')
+    save_decision(key, best, cache_file_str)
+    print(f'Autotune: using {describe(best)}')
+    return best
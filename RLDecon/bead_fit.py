@@ -0,0 +1,260 @@
+import argparse
+import csv
+
+import numpy as np
+import tifffile
+from scipy import ndimage
+
+from .kernels import CSV_TO_AXES
+from .psf_average import expand_paths
+
+# Parameter order for the batched fit: amplitude, offset, centre (z, y, x) and the six unique
+# entries of the precision matrix (inverse covariance)
+PRECISION_INDEX = [(0, 0), (1, 1), (2, 2), (0, 1), (0, 2), (1, 2)]
+
+
+def estimate_roi_shape(stack, smooth = 1.0, search = (61, 41, 41), sigmas = 3.0, min_half = 5):
+    """
+    Size the fitting ROI from the second moments of the brightest bead.
+
+    The moments are taken over the connected region above the noise floor in a `search` box
+    around the brightest voxel, so they include the tails and overestimate the Gaussian sigmas;
+    `sigmas` of them per side keeps the whole bead without reaching its neighbours. Returns an
+    odd (z, y, x) shape no larger than the stack or the search box.
+    """
+    smoothed = ndimage.gaussian_filter(stack, smooth) if smooth else stack
+    peak = np.unravel_index(np.argmax(smoothed), stack.shape)
+    box = tuple(slice(max(0, c - n//2), min(s, c + n//2 + 1)) for c, n, s in zip(peak, search, stack.shape))
+    roi = stack[box].astype(np.float64)
+    bkgd = np.median(roi)
+    noise = 1.4826 * np.median(np.abs(roi - bkgd))
+    weights = np.clip(roi - bkgd, 0, None)
+    labels, _ = ndimage.label(weights > 3*noise)
+    weights[labels != labels[tuple(c - b.start for c, b in zip(peak, box))]] = 0
+
+    shape = []
+    for axis, (n, size) in enumerate(zip(search, stack.shape)):
+        profile = weights.sum(axis=tuple(a for a in range(3) if a != axis))
+        x = np.arange(len(profile))
+        centre = profile @ x / profile.sum()
+        sigma = np.sqrt(profile @ (x - centre)**2 / profile.sum())
+        half = min(max(int(np.ceil(sigmas * sigma)), min_half), n//2, (size - 1)//2)
+        shape.append(2*half + 1)
+    return tuple(shape)
+
+
+def find_beads(stack, roi_shape, threshold = 5.0, min_distance = 5, smooth = 1.0, min_fraction = 0.2):
+    """
+    Detect beads as local maxima of the lightly smoothed stack.
+
+    A voxel is a bead if it is the maximum within `min_distance` and more than `threshold`
+    robust standard deviations above the median. Side lobes and noise are suppressed by
+    dropping peaks that fall inside the ROI of a brighter bead or are less than `min_fraction`
+    as bright as the brightest one; beads whose ROI would leave the stack are dropped last.
+    Returns an (N, 3) integer array of (z, y, x) peak positions.
+    """
+    smoothed = ndimage.gaussian_filter(stack, smooth) if smooth else stack
+    bkgd = np.median(smoothed)
+    noise = 1.4826 * np.median(np.abs(smoothed - bkgd))
+    is_peak = (smoothed == ndimage.maximum_filter(smoothed, size=2*min_distance + 1)) & (smoothed > bkgd + threshold*noise)
+    peaks = np.argwhere(is_peak)
+    height = smoothed[tuple(peaks.T)] - bkgd
+    order = np.argsort(height)[::-1]
+    peaks, height = peaks[order], height[order]
+
+    half = np.array(roi_shape) // 2
+    kept = []
+    for peak, h in zip(peaks, height):
+        if h < min_fraction * height[0]:
+            break
+        if not any(np.all(np.abs(peak - other) <= half) for other in kept):
+            kept.append(peak)
+    peaks = np.array(kept, dtype=int).reshape(-1, 3)
+    inside = np.all((peaks >= half) & (peaks < np.array(stack.shape) - half), axis=1)
+    return peaks[inside]
+
+
+def extract_rois(stack, peaks, roi_shape):
+    """Cut an ROI around every peak in one fancy-indexing call. Returns (rois (N, V), coords (V, 3))."""
+    half = np.array(roi_shape) // 2
+    coords = np.stack(np.meshgrid(*[np.arange(n) - h for n, h in zip(roi_shape, half)], indexing='ij'), -1).reshape(-1, 3)
+    index = peaks[:, None, :] + coords[None, :, :]
+    return stack[index[..., 0], index[..., 1], index[..., 2]].astype(np.float64), coords.astype(np.float64)
+
+
+def moment_estimates(rois, coords):
+    """Initial amplitude, offset, centre and covariance of every ROI from background-subtracted moments."""
+    border = np.any(np.abs(coords) == np.abs(coords).max(axis=0), axis=1)
+    offset = np.median(rois[:, border], axis=1)
+    weights = np.clip(rois - offset[:, None], 0, None)
+    total = weights.sum(axis=1, keepdims=True)
+    centre = weights @ coords / total
+    d = coords[None] - centre[:, None]
+    cov = np.einsum('nv,nva,nvb->nab', weights, d, d) / total[..., None]
+    amplitude = rois.max(axis=1) - offset
+    return amplitude, offset, centre, cov
+
+
+def _model(params, coords):
+    amplitude, offset, centre = params[:, 0], params[:, 1], params[:, 2:5]
+    precision = np.zeros((len(params), 3, 3))
+    for k, (a, b) in enumerate(PRECISION_INDEX):
+        precision[:, a, b] = precision[:, b, a] = params[:, 5 + k]
+    d = coords[None] - centre[:, None]
+    Pd = d @ precision
+    gauss = np.exp(-0.5 * np.einsum('nva,nva->nv', d, Pd))
+    return amplitude[:, None] * gauss + offset[:, None], gauss, d, Pd
+
+
+def _jacobian(params, gauss, d, Pd):
+    Ag = params[:, 0, None] * gauss
+    columns = [gauss, np.ones_like(gauss)]
+    columns += [Ag * Pd[..., a] for a in range(3)]
+    columns += [Ag * (-0.5 if a == b else -1.0) * d[..., a] * d[..., b] for a, b in PRECISION_INDEX]
+    return np.stack(columns, axis=-1)
+
+
+def fit_gaussians(rois, coords, iterations = 30):
+    """
+    Fit a 3D Gaussian with full covariance plus offset to every ROI at once.
+
+    Starts from moment estimates and runs a Levenberg-Marquardt least-squares fit that is
+    vectorised over beads (each bead keeps its own damping). Returns (params, covariances,
+    converged) with covariances in (z, y, x) voxels.
+    """
+    amplitude, offset, centre, cov = moment_estimates(rois, coords)
+    # Moments of a noisy, truncated ROI are poorly conditioned; regularise before inverting
+    precision = np.linalg.inv(cov + 0.1 * np.eye(3))
+    params = np.concatenate([amplitude[:, None], offset[:, None], centre,
+                             np.stack([precision[:, a, b] for a, b in PRECISION_INDEX], axis=1)], axis=1)
+
+    damping = np.full(len(rois), 1e-3)
+    model, gauss, d, Pd = _model(params, coords)
+    cost = np.sum((model - rois)**2, axis=1)
+    for _ in range(iterations):
+        J = _jacobian(params, gauss, d, Pd)
+        JT = J.transpose(0, 2, 1)
+        JTJ = JT @ J
+        JTr = (JT @ (model - rois)[..., None])[..., 0]
+        diag = np.einsum('nii->ni', JTJ)
+        A = JTJ + damping[:, None, None] * np.einsum('ni,ij->nij', diag, np.eye(J.shape[-1]))
+        step = np.linalg.solve(A, -JTr[..., None])[..., 0]
+
+        trial = params + step
+        trial_model, trial_gauss, trial_d, trial_Pd = _model(trial, coords)
+        trial_cost = np.sum((trial_model - rois)**2, axis=1)
+        better = trial_cost < cost
+        params = np.where(better[:, None], trial, params)
+        cost = np.where(better, trial_cost, cost)
+        model = np.where(better[:, None], trial_model, model)
+        gauss = np.where(better[:, None], trial_gauss, gauss)
+        d = np.where(better[:, None, None], trial_d, d)
+        Pd = np.where(better[:, None, None], trial_Pd, Pd)
+        damping = np.where(better, damping / 10, damping * 10)
+
+    precision = np.zeros((len(params), 3, 3))
+    for k, (a, b) in enumerate(PRECISION_INDEX):
+        precision[:, a, b] = precision[:, b, a] = params[:, 5 + k]
+    converged = np.all(np.linalg.eigvalsh(precision) > 0, axis=1) & (params[:, 0] > 0)
+    covariances = np.full_like(precision, np.nan)
+    covariances[converged] = np.linalg.inv(precision[converged])
+    return params, covariances, converged
+
+
+def reject_outliers(params, covariances, converged, max_centre_shift = 2.0, mad_limit = 3.0):
+    """Keep converged fits whose centre stayed near the peak and whose sigmas are within mad_limit MADs of the median."""
+    keep = converged & np.all(np.abs(params[:, 2:5]) <= max_centre_shift, axis=1)
+    if not np.any(keep):
+        return keep
+    sigmas = np.sqrt(np.einsum('nii->ni', covariances[keep]))
+    median = np.median(sigmas, axis=0)
+    mad = 1.4826 * np.median(np.abs(sigmas - median), axis=0)
+    ok = np.all(np.abs(sigmas - median) <= mad_limit * np.maximum(mad, 1e-6), axis=1)
+    keep[np.flatnonzero(keep)[~ok]] = False
+    return keep
+
+
+def to_csv_covariance(cov, z_spacing = 1.0):
+    """
+    Convert a (z, y, x) voxel covariance to the csv layout read by kernels.voxel_covariance.
+
+    z_spacing follows the same convention as the deconvolution inputs (spacing in um x 10), so
+    z is expressed in the lateral units the fitted csvs use.
+    """
+    scale = np.array([z_spacing, 1, 1])
+    cov = cov * np.outer(scale, scale)
+    out = np.zeros((3, 3))
+    out[np.ix_(CSV_TO_AXES, CSV_TO_AXES)] = cov
+    return out
+
+
+def fit_beads(stack_files, roi_shape = None, threshold = 5.0, min_distance = 5, z_spacing = 1.0,
+              iterations = 30, min_fraction = 0.2):
+    """
+    Detect and fit every bead in a set of calibration stacks.
+
+    roi_shape=None sizes the ROI of each stack from its brightest bead (estimate_roi_shape).
+    Returns (covariance, beads): the amplitude-weighted mean accepted covariance in csv layout,
+    and one dict per detected bead with its file, position, fitted sigmas and whether it was
+    accepted.
+    """
+    beads = []
+    accepted = []
+    amplitudes = []
+    for stack_file in stack_files:
+        stack = tifffile.imread(stack_file).astype(np.float32)
+        shape = roi_shape or estimate_roi_shape(stack)
+        peaks = find_beads(stack, shape, threshold, min_distance, min_fraction=min_fraction)
+        if len(peaks) == 0:
+            print(f'{stack_file}: no beads found')
+            continue
+        rois, coords = extract_rois(stack, peaks, shape)
+        params, covariances, converged = fit_gaussians(rois, coords, iterations)
+        keep = reject_outliers(params, covariances, converged)
+        print(f'{stack_file}: {len(peaks)} beads in {shape} ROIs, {keep.sum()} accepted')
+        for peak, p, cov, k in zip(peaks, params, covariances, keep):
+            sigmas = np.sqrt(np.diag(cov)) if np.all(np.isfinite(cov)) else [np.nan]*3
+            beads.append({'file': stack_file, 'z': peak[0] + p[2], 'y': peak[1] + p[3], 'x': peak[2] + p[4],
+                          'amplitude': p[0], 'sigma_z': sigmas[0], 'sigma_y': sigmas[1], 'sigma_x': sigmas[2],
+                          'accepted': bool(k)})
+        accepted.append(covariances[keep])
+        amplitudes.append(params[keep, 0])
+
+    accepted = np.concatenate(accepted) if accepted else np.zeros((0, 3, 3))
+    if len(accepted) == 0:
+        raise ValueError('No beads passed the fit and outlier checks')
+    # Bright beads have the best signal to noise; weight them accordingly
+    mean = np.average(accepted, axis=0, weights=np.concatenate(amplitudes))
+    return to_csv_covariance(mean, z_spacing), beads
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit 3D Gaussian PSF covariances to beads in calibration stacks',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input', type=str, nargs='+', required=True, help='bead stacks or wildcards, e.g. "PSFs/*.ome.tif"')
+    parser.add_argument('--output', type=str, default='488PSF_sigma.csv')
+    parser.add_argument('--beads_output', type=str, required=False, help='optional per-bead table')
+    parser.add_argument('--roi', type=int, nargs=3, required=False,
+                        help='ROI size in z y x voxels (default: sized from the brightest bead of each stack)')
+    parser.add_argument('--threshold', type=float, default=5.0, help='detection threshold in robust standard deviations')
+    parser.add_argument('--min_distance', type=int, default=5)
+    parser.add_argument('--min_fraction', type=float, default=0.2,
+                        help='ignore peaks dimmer than this fraction of the brightest bead in a stack')
+    parser.add_argument('--z_spacing', type=float, default=1.0, help='bead stack z spacing in um x 10')
+    parser.add_argument('--iterations', type=int, default=30)
+    args = parser.parse_args()
+
+    covariance, beads = fit_beads(expand_paths(args.input), tuple(args.roi) if args.roi else None, args.threshold,
+                                  args.min_distance, args.z_spacing, args.iterations, args.min_fraction)
+    np.savetxt(args.output, covariance, delimiter=',', fmt='%f')
+    print(f'Covariance of {sum(b["accepted"] for b in beads)} beads written to {args.output}')
+
+    if args.beads_output:
+        with open(args.beads_output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(beads[0].keys()))
+            writer.writeheader()
+            writer.writerows(beads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import json
+import os
+
+import numpy as np
+import tifffile
+
+
+def _jsonable(value):
+    # Round-trip through JSON so tuples and numpy scalars compare equal to what was loaded back
+    return json.loads(json.dumps(value, default=lambda o: o.item() if hasattr(o, 'item') else str(o)))
+
+
+class TimepointCheckpoint:
+    """
+    Incrementally written ImageJ hyperstack with a sidecar manifest of finished timepoints.
+
+    The output is created as a memory-mapped, uncompressed uint16 TZCYX ImageJ tif and every
+    (timepoint, channel) volume is flushed to disk before it is added to
+    `<output>.manifest.json`, so after a crash the manifest never lists data that is not on
+    disk. Reopening with the same `params` picks up the existing file and manifest; any change
+    in params (or a missing output) starts from scratch.
+    """
+    def __init__(self, output_file_str, shape, mdata, resolution, params):
+        self.output_file_str = output_file_str
+        self.manifest_file_str = output_file_str + '.manifest.json'
+        self.shape = tuple(shape)
+        self.params = _jsonable(params)
+        self.completed = set()
+
+        state = self._load()
+        if state is not None and state['params'] == self.params and os.path.exists(output_file_str):
+            # ImageJ files are read back with singleton axes squeezed out
+            self.out = tifffile.memmap(output_file_str, mode='r+').reshape(self.shape)
+            self.completed = {tuple(tc) for tc in state['completed']}
+            print(f'Resuming {output_file_str}: {len(self.completed)} timepoint/channel volumes already done')
+        else:
+            self.out = tifffile.memmap(output_file_str, shape=self.shape, dtype=np.uint16, imagej=True,
+                                       metadata=mdata, resolution=resolution)
+            self._save()
+
+    def _load(self):
+        if not os.path.exists(self.manifest_file_str):
+            return None
+        with open(self.manifest_file_str) as f:
+            return json.load(f)
+
+    def _save(self):
+        tmp_file_str = self.manifest_file_str + '.tmp'
+        with open(tmp_file_str, 'w') as f:
+            json.dump({'params': self.params, 'shape': self.shape, 'completed': sorted(self.completed)}, f)
+        os.replace(tmp_file_str, self.manifest_file_str)
+
+    def is_done(self, timepoint, channel):
+        return (timepoint, channel) in self.completed
+
+    def first_missing(self):
+        """Return the first timepoint with an unfinished channel, or None when everything is done."""
+        for t in range(self.shape[0]):
+            if any(not self.is_done(t, c) for c in range(self.shape[2])):
+                return t
+        return None
+
+    def write(self, timepoint, channel, volume):
+        self.out[timepoint, :, channel] = volume
+        self.out.flush()
+        self.completed.add((timepoint, channel))
+        self._save()
+
+    def close(self):
+        self.out.flush()
+        del self.out
+
+
+def estimate_file_str(output_file_str):
+    return output_file_str.replace('.tif', '.estimate.npy')
+
+
+class SavedEstimate:
+    """
+    float32 Richardson-Lucy estimates of a run, kept next to its output to continue iterating later.
+
+    `<output>.estimate.npy` is a memory-mapped (timepoint, channel, z, y, x) array of the
+    estimates on the deconvolved block (ROI plus halo, before cropping and deskewing), and
+    `<output>.estimate.json` records the iterations they have had, the run params and the
+    finished volumes. As in TimepointCheckpoint, a volume is flushed before it is recorded, and
+    reopening with the same niter and params picks up the existing estimates.
+    """
+    # Params a continuing run must share with the run that saved the estimates
+    MATCHING_PARAMS = ('timepoints', 'channel_subset', 'roi', 'deskew_angle')
+
+    def __init__(self, output_file_str, shape, niter, params, mode = 'w'):
+        self.estimate_file_str = estimate_file_str(output_file_str)
+        self.info_file_str = self.estimate_file_str.replace('.npy', '.json')
+        if mode == 'r':
+            with open(self.info_file_str) as f:
+                info = json.load(f)
+            self.shape, self.niter, self.params = tuple(info['shape']), info['niter'], info['params']
+            self.completed = {tuple(tc) for tc in info['completed']}
+            self.estimates = np.load(self.estimate_file_str, mmap_mode='r')
+            return
+
+        self.shape, self.niter, self.params = tuple(shape), niter, _jsonable(params)
+        self.completed = set()
+        info = None
+        if os.path.exists(self.info_file_str) and os.path.exists(self.estimate_file_str):
+            with open(self.info_file_str) as f:
+                info = json.load(f)
+        if info is not None and (tuple(info['shape']), info['niter'], info['params']) == (self.shape, niter, self.params):
+            self.estimates = np.load(self.estimate_file_str, mmap_mode='r+')
+            self.completed = {tuple(tc) for tc in info['completed']}
+        else:
+            self.estimates = np.lib.format.open_memmap(self.estimate_file_str, mode='w+', dtype=np.float32, shape=self.shape)
+            self._save()
+
+    @classmethod
+    def load(cls, output_file_str):
+        """Open the estimates saved next to `output_file_str` for reading."""
+        if not os.path.exists(estimate_file_str(output_file_str)):
+            raise FileNotFoundError(f'No saved estimate next to {output_file_str}; run it with save_estimate=True')
+        return cls(output_file_str, None, None, None, mode='r')
+
+    def check(self, shape, params):
+        """Raise ValueError unless every estimate is there and was made for the same volumes as `params`."""
+        params = _jsonable(params)
+        if tuple(shape) != self.shape:
+            raise ValueError(f'Saved estimate has shape {self.shape}, this run needs {tuple(shape)}')
+        for key in self.MATCHING_PARAMS:
+            if self.params.get(key) != params.get(key):
+                raise ValueError(f'Saved estimate was made with {key}={self.params.get(key)}, this run has {params.get(key)}')
+        if len(self.completed) != self.shape[0] * self.shape[1]:
+            raise ValueError(f'Saved estimate is incomplete: {len(self.completed)} of {self.shape[0] * self.shape[1]} volumes')
+
+    def _save(self):
+        tmp_file_str = self.info_file_str + '.tmp'
+        with open(tmp_file_str, 'w') as f:
+            json.dump({'shape': self.shape, 'niter': self.niter, 'params': self.params,
+                       'completed': sorted(self.completed)}, f)
+        os.replace(tmp_file_str, self.info_file_str)
+
+    def read(self, timepoint, channel):
+        return np.array(self.estimates[timepoint, channel])
+
+    def write(self, timepoint, channel, volume):
+        self.estimates[timepoint, channel] = volume
+        self.estimates.flush()
+        self.completed.add((timepoint, channel))
+        self._save()
+
+    def close(self):
+        if self.estimates.mode != 'r':
+            self.estimates.flush()
+        del self.estimates
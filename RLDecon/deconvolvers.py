@@ -0,0 +1,63 @@
+import threading
+
+from .rl import DEFAULT_TV_REGULARIZATION, RichardsonLucy
+from .wiener import DEFAULT_REGULARIZATION, WienerDeconvolver
+
+_pool = {}
+_lock = threading.Lock()
+
+
+def get_deconvolver(mode = 'rl', ndim = 3, pad_amount = 16, regularization = None, cutoff = None, backend = None,
+                    coarse_factor = None, coarse_iterations = None):
+    """
+    Initialised deconvolver for these settings, built once and kept warm for the life of the process.
+
+    flowdec builds its TensorFlow graph in initialize() with free dimensions, so one instance
+    serves every file, volume shape and iteration count with the same padding; only the session
+    is created per run. Instances are shared between threads (runs only read the graph).
+
+    mode is 'rl' (flowdec), 'preview' (wiener.WienerDeconvolver) or 'rfft' (rl.RichardsonLucy
+    on `backend`). regularization applies to the latter two and defaults to each engine's own
+    default; cutoff and the coarse-to-fine start (coarse_factor, coarse_iterations) only apply
+    to 'rfft'.
+    """
+    if regularization is None and mode != 'rl':
+        regularization = DEFAULT_REGULARIZATION if mode == 'preview' else DEFAULT_TV_REGULARIZATION
+    key = (mode, ndim, pad_amount) + ((regularization, cutoff, backend) if mode != 'rl' else ())
+    if mode == 'rfft':
+        key += (coarse_factor, coarse_iterations)
+    with _lock:
+        if key not in _pool:
+            if mode == 'preview':
+                _pool[key] = WienerDeconvolver(pad_amount, regularization).initialize()
+            elif mode == 'rfft':
+                _pool[key] = RichardsonLucy(pad_amount, regularization, cutoff, backend, coarse_factor,
+                                             coarse_iterations).initialize()
+            else:
+                from flowdec import restoration as fd_restoration
+                _pool[key] = fd_restoration.RichardsonLucyDeconvolver(
+                    ndim, pad_mode='none', pad_min=[pad_amount]*ndim).initialize()
+        return _pool[key]
+
+
+def clear_pool():
+    """Drop every warm deconvolver (and its graph or cached filters)."""
+    with _lock:
+        for algo in _pool.values():
+            if hasattr(algo, 'clear_cache'):
+                algo.clear_cache()
+        _pool.clear()
+
+
+def session_config(intra_op_threads = None, inter_op_threads = None):
+    """
+    TensorFlow session options for flowdec runs, or None for TensorFlow's defaults.
+
+    intra_op_threads parallelise a single op such as an FFT; inter_op_threads run independent
+    ops side by side. 0 means one per core.
+    """
+    if intra_op_threads is None and inter_op_threads is None:
+        return None
+    import tensorflow as tf
+    return tf.compat.v1.ConfigProto(intra_op_parallelism_threads=intra_op_threads or 0,
+                                    inter_op_parallelism_threads=inter_op_threads or 0)
@@ -0,0 +1,115 @@
+import argparse
+
+import numpy as np
+from scipy import ndimage
+
+from .kernels import kernel_shape, voxel_covariance
+from .writer import add_write_arguments, write_options_from_args
+
+# Light-sheet angle of the Warwick LLSM; the deskewed z spacing is spacing*cos(angle)
+DEFAULT_ANGLE = 57.2
+
+
+def pixel_size(x_res):
+    """Lateral pixel size in microns from a tif XResolution (pixels per micron as a rational)."""
+    return x_res[1] / x_res[0]
+
+
+def deskew_geometry(z_spacing, pixel_size, angle = DEFAULT_ANGLE):
+    """
+    Deskewed z spacing and per-frame lateral shift of a stage-scan stack.
+
+    Parameters:
+    - z_spacing: float, stage step in microns x 10 (the convention of the input dialogs).
+    - pixel_size: float, lateral pixel size in microns.
+    - angle: float, light-sheet angle in degrees.
+
+    Returns:
+    - (deskewed z spacing in microns x 10, shift of frame k+1 relative to frame k along x in pixels)
+    """
+    theta = np.deg2rad(angle)
+    step = z_spacing / 10
+    return z_spacing * np.cos(theta), step * np.sin(theta) / pixel_size
+
+
+def shear_covariance(cov, shift):
+    """
+    Express a deskewed-frame (z, y, x) covariance in the raw skewed frame.
+
+    Raw voxel (k, y, x) sits at (k, y, x + shift*k) in the deskewed frame, i.e. p_deskewed = A p_raw;
+    a Gaussian with covariance cov there has covariance A^-1 cov A^-T in raw coordinates.
+    """
+    inverse = np.array([[1, 0, 0], [0, 1, 0], [-shift, 0, 1]], dtype=np.float64)
+    return inverse @ cov @ inverse.T
+
+
+def get_skewed_kernel(psf, z_spacing, shift):
+    """
+    Kernel for deconvolving raw stage-scan frames with a fitted PSF covariance.
+
+    `z_spacing` is the deskewed z spacing (x 10) so the covariance is in deskewed voxels before
+    it is sheared. The sheared Gaussian is narrower than a voxel along z at fixed x, so unlike
+    kernels.get_kernel it is sampled in real space: the inverse FFT of its OTF would alias along z
+    and ring negative. The box grows with the shear (see kernels.kernel_shape).
+    """
+    cov = shear_covariance(voxel_covariance(psf, z_spacing), shift)
+    shape = kernel_shape(cov)
+    coords = np.stack(np.meshgrid(*[np.arange(n) - n//2 for n in shape], indexing='ij'), -1)
+    kernel = np.exp(-0.5 * np.einsum('...a,ab,...b->...', coords, np.linalg.inv(cov), coords))
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def deskewed_shape(shape, shift):
+    """(z, y, x) shape of a raw volume after deskewing."""
+    nz, ny, nx = shape[-3:]
+    return (nz, ny, nx + int(np.ceil(abs(shift) * (nz - 1))))
+
+
+def deskew(volume, shift, order = 1):
+    """
+    Deskew a raw (z, y, x) volume in one resampling pass.
+
+    Every frame is shifted along x by shift*k with linear interpolation; the output is wide
+    enough to hold the sheared volume and the wedges outside it are zero.
+    """
+    nz = volume.shape[0]
+    # Keep every output x >= 0 for either scan direction
+    origin = max(0.0, -shift * (nz - 1))
+    matrix = np.array([[1, 0, 0], [0, 1, 0], [-shift, 0, 1]], dtype=np.float64)
+    return ndimage.affine_transform(volume, matrix, offset=(0, 0, -origin), output_shape=deskewed_shape(volume.shape, shift),
+                                    output=np.float32, order=order, mode='constant', cval=0.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Deconvolve raw stage-scan LLSM stacks in the skewed frame and deskew the result',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input', type=str, nargs='+', required=True)
+    parser.add_argument('--psf', type=str, nargs='+', required=True, help='one fitted .csv (or raw-frame .tif) PSF per channel')
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--niter', type=int, default=10)
+    parser.add_argument('--pad_amount', type=int, default=16)
+    parser.add_argument('--mode', type=str, default='rl', choices=['rl', 'preview', 'rfft'],
+                        help='preview: one-shot Wiener filter, rfft: numpy Richardson-Lucy')
+    parser.add_argument('--angle', type=float, default=DEFAULT_ANGLE, help='light-sheet angle in degrees')
+    parser.add_argument('--z_spacing', type=float, required=False, help='stage step x 10, defaults to 10x the spacing in the file metadata')
+    add_write_arguments(parser)
+    args = parser.parse_args()
+
+    # Imported here so that --help works without TensorFlow
+    from .run_decon import run_5d_decon
+    from .utils import make_mdata, read_image, read_psf
+
+    psfs = [read_psf(psf_file) for psf_file in args.psf[:args.channels]]
+    suffix = '_deskewed_preview.tif' if args.mode == 'preview' else f'_deskewed_{args.mode}{args.niter}.tif'
+    for input_file_str in args.input:
+        dat, mdata, x_res, y_res = read_image(input_file_str)
+        z_spacing = args.z_spacing or (mdata or {}).get('spacing', 0.2705078)*10
+        if mdata is None:
+            mdata = make_mdata(dat.shape, args.channels, z_spacing/10)
+        run_5d_decon(input_file_str, dat, mdata, psfs, x_res, y_res, z_spacing, args.niter, args.pad_amount,
+                     args.channels, output_file_str=input_file_str.replace('.tif', suffix),
+                     deskew_angle=args.angle, write_options=write_options_from_args(args), mode=args.mode)
+
+
+if __name__ == '__main__':
+    main()
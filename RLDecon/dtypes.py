@@ -0,0 +1,17 @@
+import numpy as np
+
+# Volumes, kernels and work buffers are float32 and spectra complex64 from load to write.
+# float64 is only ever used where a caller asks for it (precise=True), e.g. to accumulate a
+# result over many iterations, or for small parameter arrays such as covariances.
+FLOAT = np.float32
+COMPLEX = np.complex64
+
+
+def work_dtype(precise = False):
+    """dtype of volume-sized work and result buffers: float32, or float64 when asked for."""
+    return np.float64 if precise else FLOAT
+
+
+def as_float(array, xp = np):
+    """View or copy an array as float32 on numpy or cupy (`xp`), without going through float64."""
+    return xp.asarray(array, dtype=FLOAT)
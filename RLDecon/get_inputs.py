@@ -14,6 +14,7 @@ import tensorflow as tf
 import tkinter as tk
 from tkinter import simpledialog, messagebox, filedialog
 from .utils import get_mdata
+from .psf import prepare_psf_file
 
 
 def choose_image_file(root, default_folder = '../', title_message ='Open an image file', csv = False):
@@ -225,18 +226,14 @@ def get_inputs():
             if ".csv" in psf_ch1_file_str:
                 psfs.append(np.genfromtxt(psf_ch1_file_str, delimiter=','))
             elif ".tif" in psf_ch1_file_str:
-                with tifffile.TiffFile(psf_ch1_file_str) as psf1_tif:
-                    psf_ch1 = psf1_tif.asarray()
-                    psfs.append(psf_ch1)
+                psfs.append(prepare_psf_file(psf_ch1_file_str))
 
             if channels == 2:
                 psf_ch2_file_str = file_inputs['psf_ch2']
                 if ".csv" in psf_ch2_file_str:
                     psfs.append(np.genfromtxt(psf_ch2_file_str, delimiter=','))
                 elif ".tif" in psf_ch2_file_str:
-                    with tifffile.TiffFile(psf_ch2_file_str) as psf2_tif:
-                        psf_ch2 = psf2_tif.asarray()
-                        psfs.append(psf_ch2)
+                    psfs.append(prepare_psf_file(psf_ch2_file_str))
                     
             with tifffile.TiffFile(input_file_str) as tif:
                     if 'ome.tif' in input_file_str:
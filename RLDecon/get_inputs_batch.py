@@ -13,7 +13,8 @@ from tqdm import tqdm
 import tensorflow as tf
 import tkinter as tk
 from tkinter import simpledialog, messagebox, filedialog, Listbox
-from .utils import get_mdata
+from .index import header_mdata, index_files
+from .psf import prepare_psf_file
 
 
 
@@ -250,13 +251,16 @@ def get_multiple_numeric_inputs(master, title, defaults):
     dialog = MultipleInputNumericDialog(master, title, defaults=defaults)
     return dialog.result
 
-def get_inputs_batch():
+def get_inputs_batch(root = None):
+    # root: an existing Tk root (e.g. the job window) to open the dialogs on; it is left open
     
     print("Num GPUs Available: ", len(tf.config.experimental.list_physical_devices('GPU')))
 
     
-    root = tk.Tk()
-    root.withdraw()  # Optionally hide the root window
+    own_root = root is None
+    if own_root:
+        root = tk.Tk()
+        root.withdraw()  # Optionally hide the root window
     valid = False
     psfs = []
     
@@ -266,7 +270,8 @@ def get_inputs_batch():
             file_inputs, root = get_multiple_file_inputs(root, "File Inputs", default_inputs)
             if file_inputs is None:
                 print('Cancelled.')
-                root.destroy()
+                if own_root:
+                    root.destroy()
                 return
             
             channels = int(file_inputs['channels'])
@@ -279,44 +284,23 @@ def get_inputs_batch():
             if ".csv" in psf_ch1_file_str:
                 psfs.append(np.genfromtxt(psf_ch1_file_str, delimiter=','))
             elif ".tif" in psf_ch1_file_str:
-                with tifffile.TiffFile(psf_ch1_file_str) as psf1_tif:
-                    psf_ch1 = psf1_tif.asarray()
-                    psfs.append(psf_ch1)
+                psfs.append(prepare_psf_file(psf_ch1_file_str))
 
             if channels == 2:
                 psf_ch2_file_str = file_inputs['psf_ch2']
                 if ".csv" in psf_ch2_file_str:
                     psfs.append(np.genfromtxt(psf_ch2_file_str, delimiter=','))
                 elif ".tif" in psf_ch2_file_str:
-                    with tifffile.TiffFile(psf_ch2_file_str) as psf2_tif:
-                        psf_ch2 = psf2_tif.asarray()
-                        psfs.append(psf_ch2)
+                    psfs.append(prepare_psf_file(psf_ch2_file_str))
                     
-            with tifffile.TiffFile(input_file_str) as tif:
-                    if 'ome.tif' in input_file_str:
-                        xml_data = tif.ome_metadata
-                        mdata = get_mdata(xml_data)
-                    else:
-                        mdata = tif.imagej_metadata
-
-                    if tif.pages is not None:
-                        tags = tif.pages[0].tags
-                        y_res = tags['YResolution'].value
-                        x_res = tags['XResolution'].value
-                    else:
-                        # is 0.104 microns per pixel
-                        y_res = (9615384, 1000000)
-                        x_res = (9615384, 1000000)
-                        
-                    dat = tif.asarray()
+            # Shapes, metadata and resolutions come from the cached header index of the folder,
+            # so only new or changed files are opened; pixels are read when each job runs
+            headers = index_files(input_files)
+            header = headers[input_file_str]
+            mdata = header_mdata(header)
+            x_res, y_res = tuple(header['x_res']), tuple(header['y_res'])
+            dat_shape = tuple(header['shape'])
             valid = True
-            dats = []
-
-            for file_str in input_files:
-                with tifffile.TiffFile(file_str) as tif:
-                     
-                    image_data = tif.asarray()
-                    dats.append(image_data)
             
         except OSError as e:
                 # Handle the error (e.g., log it, inform the user)
@@ -335,7 +319,8 @@ def get_inputs_batch():
     numeric_inputs = get_multiple_numeric_inputs(root, "Numeric Inputs", numeric_defaults)
     if numeric_inputs is None:
         print('Cancelled.')
-        root.destroy()
+        if own_root:
+            root.destroy()
         return
     
     z_spacing = numeric_inputs['z_spacing']
@@ -344,12 +329,12 @@ def get_inputs_batch():
 
     if mdata is None:
         print("No metadata found, generating metadata, please check")
-        frames = dat.shape[0]
-        slices = dat.shape[1]
+        frames = dat_shape[0]
+        slices = dat_shape[1]
             
-        if (len(dat.shape) == 4 and channels > 1) or len(dat.shape) == 3:
+        if (len(dat_shape) == 4 and channels > 1) or len(dat_shape) == 3:
             frames = 1
-            slices = dat.shape[0]      
+            slices = dat_shape[0]      
         
         mdata = {
             'images': int(slices*frames*channels),
@@ -361,7 +346,8 @@ def get_inputs_batch():
             'loop': False
         }
     
-    root.destroy()
-    return [input_files, dats, mdata, psfs, x_res, y_res, z_spacing, niter, pad_amount, channels]
+    if own_root:
+        root.destroy()
+    return [input_files, [headers[f] for f in input_files], mdata, psfs, x_res, y_res, z_spacing, niter, pad_amount, channels]
 
 
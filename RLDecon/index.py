@@ -0,0 +1,165 @@
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import tifffile
+
+from .utils import ome_pixels_attributes
+
+INDEX_NAME = 'rldecon_index.json'
+
+
+def read_header(file_str):
+    """
+    Read shape, dtype, T/Z/C sizes, z spacing and XY resolution of a tif from its tags only.
+
+    tifffile builds ImageJ and OME series from the first page and the metadata, so no pixel
+    data is decoded; what is read is the header, including the OME-XML, which can itself run
+    to megabytes for long acquisitions. That is why scan_folder caches the result.
+    """
+    stat = os.stat(file_str)
+    with tifffile.TiffFile(file_str) as tif:
+        series = tif.series[0]
+        entry = {'shape': list(series.shape), 'dtype': str(series.dtype), 'axes': series.axes,
+                 'frames': 1, 'slices': 1, 'channels': 1, 'spacing': None,
+                 'mtime': stat.st_mtime, 'size': stat.st_size}
+
+        if tif.is_ome:
+            pixels = ome_pixels_attributes(tif.ome_metadata)
+            entry.update(frames=int(pixels.get('SizeT', 1)), slices=int(pixels.get('SizeZ', 1)),
+                         channels=int(pixels.get('SizeC', 1)))
+            if 'PhysicalSizeZ' in pixels:
+                entry['spacing'] = float(pixels['PhysicalSizeZ'])
+        elif tif.is_imagej:
+            mdata = tif.imagej_metadata or {}
+            entry.update(frames=int(mdata.get('frames', 1)), slices=int(mdata.get('slices', 1)),
+                         channels=int(mdata.get('channels', 1)), spacing=mdata.get('spacing'))
+        else:
+            sizes = dict(zip(series.axes, series.shape))
+            # Plain tifs come back as 'QYX'; treat the unknown axis as z
+            entry.update(frames=sizes.get('T', 1), slices=sizes.get('Z', sizes.get('Q', 1)), channels=sizes.get('C', 1))
+
+        tags = tif.pages[0].tags
+        if 'XResolution' in tags:
+            entry['x_res'] = list(tags['XResolution'].value)
+            entry['y_res'] = list(tags['YResolution'].value)
+        else:
+            # is 0.104 microns per pixel
+            entry['x_res'] = entry['y_res'] = [9615384, 1000000]
+    return entry
+
+
+def list_tifs(folder, recursive = True):
+    for dirpath, dirnames, filenames in os.walk(folder):
+        for f in sorted(filenames):
+            if f.endswith('.tif') or f.endswith('.tiff'):
+                yield os.path.join(dirpath, f)
+        if not recursive:
+            break
+
+
+def scan_folder(folder, index_file_str = None, recursive = True, workers = 16):
+    """
+    Index every tif under `folder` and return {path: header entry}.
+
+    Entries are cached in a JSON index (default `<folder>/rldecon_index.json`) and only files
+    whose size or modification time changed are reread; headers are read on `workers` threads,
+    since on a network share the time goes into round trips rather than CPU. Files that cannot
+    be parsed get an entry with an 'error' key.
+    """
+    folder = os.path.abspath(folder)
+    if index_file_str is None:
+        index_file_str = os.path.join(folder, INDEX_NAME)
+    index = {}
+    if os.path.exists(index_file_str):
+        with open(index_file_str) as f:
+            index = json.load(f)
+
+    files = list(list_tifs(folder, recursive))
+    stale = []
+    for file_str in files:
+        stat = os.stat(file_str)
+        cached = index.get(file_str)
+        if cached is None or cached.get('mtime') != stat.st_mtime or cached.get('size') != stat.st_size:
+            stale.append(file_str)
+
+    def read(file_str):
+        try:
+            return read_header(file_str)
+        except Exception as e:
+            stat = os.stat(file_str)
+            return {'error': str(e), 'mtime': stat.st_mtime, 'size': stat.st_size}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for file_str, entry in zip(stale, executor.map(read, stale)):
+            index[file_str] = entry
+
+    # Drop files that have disappeared since the last scan; a non-recursive scan keeps the
+    # entries of subfolders that still exist
+    scanned = set(files)
+    index = {file_str: entry for file_str, entry in index.items()
+             if file_str in scanned or (not recursive and os.path.dirname(file_str) != folder and os.path.exists(file_str))}
+    tmp_file_str = index_file_str + '.tmp'
+    with open(tmp_file_str, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_file_str, index_file_str)
+    print(f'Indexed {len(files)} files ({len(stale)} read, {len(files) - len(stale)} from cache)')
+    return index
+
+
+def index_files(files, workers = 16):
+    """
+    Header entries of `files`, from the index of each of their folders (see scan_folder).
+
+    Only the folders themselves are scanned, not their subfolders. Raises OSError for a file
+    whose header cannot be read.
+    """
+    entries = {}
+    for folder in sorted({os.path.dirname(os.path.abspath(f)) for f in files}):
+        entries.update(scan_folder(folder, recursive=False, workers=workers))
+    headers = {}
+    for file_str in files:
+        entry = entries.get(os.path.abspath(file_str))
+        if entry is None or 'error' in entry:
+            raise OSError(f'Cannot read the header of {file_str}: {(entry or {}).get("error", "not a tif")}')
+        headers[file_str] = entry
+    return headers
+
+
+def header_mdata(entry):
+    """ImageJ hyperstack metadata for an indexed file, like utils.get_mdata, or None if it has no z spacing."""
+    if entry['spacing'] is None:
+        return None
+    sizes = dict(zip(entry['axes'], entry['shape']))
+    return {
+        'images': int(sizes.get('X', 1) * sizes.get('Y', 1) * entry['slices'] * entry['frames'] * entry['channels']),
+        'slices': entry['slices'],
+        'frames': entry['frames'],
+        'hyperstack': True,
+        'unit': 'micron',
+        'spacing': entry['spacing'],
+        'loop': False
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index tif headers in a folder tree without decoding pixels',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--folder', type=str, required=True)
+    parser.add_argument('--index', type=str, required=False, help=f'defaults to <folder>/{INDEX_NAME}')
+    parser.add_argument('--no_recursive', action='store_true')
+    parser.add_argument('--workers', type=int, default=16)
+    args = parser.parse_args()
+
+    index = scan_folder(args.folder, args.index, not args.no_recursive, args.workers)
+    for file_str, entry in index.items():
+        if 'error' in entry:
+            print(f'{file_str}: {entry["error"]}')
+        else:
+            print(f'{file_str}: {entry["axes"]} {tuple(entry["shape"])} {entry["dtype"]} '
+                  f'T={entry["frames"]} Z={entry["slices"]} C={entry["channels"]} spacing={entry["spacing"]}')
+
+
+if __name__ == '__main__':
+    main()
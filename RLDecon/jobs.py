@@ -0,0 +1,193 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tkinter as tk
+from tkinter import messagebox, ttk
+
+
+class Job:
+    """One queued deconvolution: its progress, state and the event used to cancel it."""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = 'queued'
+        self.done = 0
+        self.total = 0
+        self.error = None
+        self.cancel_event = threading.Event()
+        self.future = None
+        self.started = None
+        # (time, done) the ETA is measured from; volumes skipped on resume are not counted
+        self._start = None
+
+    def update(self, done, total):
+        if self._start is None:
+            # The first report follows exactly one new volume, everything before it was already done
+            self._start = (self.started, done - 1)
+        self.done, self.total = done, total
+
+    def eta(self):
+        """Seconds left, extrapolated from the rate since the job started, or None before the first volume."""
+        if self._start is None or self.done <= self._start[1]:
+            return None
+        start_time, start_done = self._start
+        rate = (time.perf_counter() - start_time) / (self.done - start_done)
+        return rate * (self.total - self.done)
+
+
+class JobRunner:
+    """
+    Run deconvolutions on a background worker so the Tk UI stays responsive.
+
+    Jobs run on a thread pool (one worker by default, since each deconvolution already uses the
+    whole GPU); threads rather than processes, so the images already loaded by the dialogs are
+    not copied. The worker never touches Tk: progress and state changes are put on `events`
+    and the UI drains them from its own thread (see ProgressWindow).
+    """
+
+    def __init__(self, workers = 1):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.events = queue.Queue()
+        self.jobs = []
+
+    def submit(self, name, func, *args, **kwargs):
+        """Queue func(*args, progress=..., cancel_event=..., **kwargs) and return its Job."""
+        job = Job(name)
+        self.jobs.append(job)
+
+        def run():
+            if job.cancel_event.is_set():
+                job.state = 'cancelled'
+                self.events.put(job)
+                return
+            job.state = 'running'
+            job.started = time.perf_counter()
+            self.events.put(job)
+
+            def progress(done, total):
+                job.update(done, total)
+                self.events.put(job)
+
+            # Imported here so that the window can open before TensorFlow is loaded
+            from .run_decon import DeconvolutionCancelled
+            try:
+                func(*args, progress=progress, cancel_event=job.cancel_event, **kwargs)
+                job.state = 'finished'
+            except DeconvolutionCancelled:
+                job.state = 'cancelled'
+            except Exception as e:
+                job.state = 'failed'
+                job.error = e
+                print(f'{job.name} failed: {e!r}')
+            self.events.put(job)
+
+        job.future = self.executor.submit(run)
+        self.events.put(job)
+        return job
+
+    def cancel_all(self):
+        for job in self.jobs:
+            job.cancel_event.set()
+
+    def busy(self):
+        return any(job.state in ('queued', 'running') for job in self.jobs)
+
+    def shutdown(self):
+        from .deconvolvers import clear_pool
+        self.cancel_all()
+        # Queued behind the jobs, so the warm deconvolvers are released once they have stopped
+        self.executor.submit(clear_pool)
+        self.executor.shutdown(wait=False)
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return '--:--'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes}:{seconds:02d}'
+
+
+class ProgressWindow:
+    """
+    Tk window listing the queued jobs with a progress bar, ETA and Cancel button each.
+
+    `add_jobs` is called (on the Tk thread) when "Add datasets" is pressed and should submit new
+    jobs to the runner. Cancelling stops a job between timepoints.
+    """
+
+    def __init__(self, root, runner, add_jobs = None, poll_ms = 200):
+        self.root = root
+        self.runner = runner
+        self.poll_ms = poll_ms
+        self.rows = {}
+
+        root.title('RLDecon jobs')
+        root.protocol('WM_DELETE_WINDOW', self.close)
+        self.frame = tk.Frame(root, padx=8, pady=8)
+        self.frame.grid(row=0, column=0, sticky='nsew')
+        buttons = tk.Frame(root, padx=8, pady=8)
+        buttons.grid(row=1, column=0, sticky='ew')
+        if add_jobs is not None:
+            tk.Button(buttons, text='Add datasets', command=add_jobs).pack(side='left')
+        tk.Button(buttons, text='Cancel all', command=runner.cancel_all).pack(side='left')
+        tk.Button(buttons, text='Close', command=self.close).pack(side='right')
+
+        self.poll()
+
+    def add_row(self, job):
+        row = len(self.rows)
+        name = tk.Label(self.frame, text=os.path.basename(job.name), anchor='w', width=50)
+        bar = ttk.Progressbar(self.frame, length=250, mode='determinate')
+        status = tk.Label(self.frame, anchor='w', width=30)
+        cancel = tk.Button(self.frame, text='Cancel', command=job.cancel_event.set)
+        for column, widget in enumerate([name, bar, status, cancel]):
+            widget.grid(row=row, column=column, sticky='w', padx=4, pady=2)
+        self.rows[job] = (bar, status, cancel)
+
+    def refresh(self, job):
+        if job not in self.rows:
+            self.add_row(job)
+        bar, status, cancel = self.rows[job]
+        bar['maximum'] = max(job.total, 1)
+        bar['value'] = job.done
+        if job.state == 'running' and job.cancel_event.is_set():
+            text = 'cancelling...'
+        elif job.state == 'running':
+            text = f'{job.done}/{job.total}  ETA {format_seconds(job.eta())}' if job.total else 'starting...'
+        elif job.state == 'failed':
+            text = f'failed: {job.error}'
+        else:
+            text = job.state
+        status['text'] = text
+        if job.state in ('finished', 'cancelled', 'failed'):
+            cancel['state'] = 'disabled'
+
+    def poll(self):
+        # Drain the worker events on the Tk thread; several events for one job refresh it once
+        updated = []
+        while True:
+            try:
+                job = self.runner.events.get_nowait()
+            except queue.Empty:
+                break
+            if job not in updated:
+                updated.append(job)
+        for job in updated:
+            self.refresh(job)
+        # The ETA changes with time, not only with events
+        for job in self.runner.jobs:
+            if job.state == 'running' and job not in updated:
+                self.refresh(job)
+        self.root.after(self.poll_ms, self.poll)
+
+    def close(self):
+        if self.runner.busy():
+            if not messagebox.askyesno('RLDecon', 'Jobs are still queued or running. Cancel them and quit?'):
+                return
+            # The running job stops after its current timepoint
+        self.runner.shutdown()
+        self.root.destroy()
@@ -0,0 +1,123 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import scipy.fft
+
+from .dtypes import COMPLEX, FLOAT
+
+# Fitted PSF csvs hold the 3x3 Gaussian covariance with rows/columns in the order used by the
+# bead fitting (index 0 -> image axis 1, index 1 -> image axis 2, index 2 -> z); z is in the same
+# units as the lateral axes, so it is divided by the z spacing to get z pixels.
+CSV_TO_AXES = [2, 0, 1]
+
+# Kernels are never cropped tighter than the historical 25^3 box
+MIN_KERNEL_SIZE = 25
+
+# Spectra each engine keeps; volume shapes change with every ROI, tile, slab and file, so only
+# the most recently used few are kept
+KERNEL_CACHE_SIZE = 4
+
+
+def voxel_covariance(psf, z_spacing = 2.705078):
+    """Convert a fitted 3x3 PSF covariance (csv order) to a covariance in (z, y, x) pixels."""
+    cov = np.asarray(psf, dtype=np.float64)[np.ix_(CSV_TO_AXES, CSV_TO_AXES)]
+    scale = np.array([1/z_spacing, 1, 1])
+    return cov * np.outer(scale, scale)
+
+
+def gaussian_otf(cov, shape):
+    """
+    Evaluate the Fourier transform of a Gaussian PSF directly on the rfftn grid of `shape`.
+
+    The PSF is centred on the origin (as expected by an `irfftn(rfftn(x) * otf)` convolution),
+    so the OTF is real: exp(-2 pi^2 k^T cov k), with k in cycles per pixel and the full
+    covariance including the off-diagonal terms. It sums to one in real space and is returned as
+    float32, half the size of a complex64 spectrum.
+
+    Parameters:
+    - cov: 3x3 array, covariance in (z, y, x) pixels (see voxel_covariance).
+    - shape: tuple, real-space shape of the (padded) volume.
+    """
+    ndim = len(shape)
+    freqs = [np.fft.fftfreq(n) for n in shape[:-1]] + [np.fft.rfftfreq(shape[-1])]
+    grids = [f.astype(np.float32).reshape([-1 if i == axis else 1 for i in range(ndim)]) for axis, f in enumerate(freqs)]
+    # Accumulate in place: each term is only an outer product of two axes, so the one full-size
+    # float32 array is the output itself
+    otf = np.zeros([len(f) for f in freqs], dtype=np.float32)
+    for a in range(ndim):
+        for b in range(a, ndim):
+            weight = cov[a, b] if a == b else cov[a, b] + cov[b, a]
+            if weight != 0:
+                otf += np.float32(-2 * np.pi**2 * weight) * grids[a] * grids[b]
+    return np.exp(otf, out=otf)
+
+
+def kernel_shape(cov, truncate = 4.0):
+    """Odd kernel shape covering +-truncate standard deviations along every axis."""
+    sigmas = np.sqrt(np.diag(cov))
+    return tuple(int(max(MIN_KERNEL_SIZE, 2*np.ceil(truncate*s) + 1)) for s in sigmas)
+
+
+def get_kernel(psf, z_spacing = 2.705078):
+    """
+    Build a centred spatial kernel from a fitted PSF covariance.
+
+    The kernel is the inverse FFT of the analytic OTF, so it includes the off-diagonal covariance
+    terms, and its box grows with the PSF instead of truncating at 25^3.
+    """
+    cov = voxel_covariance(psf, z_spacing)
+    shape = kernel_shape(cov)
+    # scipy.fft stays in single precision for the float32 OTF
+    kernel = scipy.fft.irfftn(gaussian_otf(cov, shape), shape)
+    # Move the centre from the origin to the middle of the box, where flowdec expects it
+    return np.fft.fftshift(kernel).astype(FLOAT, copy=False)
+
+
+def kernel_to_otf(kernel, shape):
+    """
+    rfftn of a centred spatial kernel (from get_kernel or a measured PSF) zero-padded to `shape`.
+
+    The kernel's middle voxel is moved to the origin, so multiplying a spectrum by the result
+    convolves without shifting. Returned as complex64.
+    """
+    padded = np.zeros(shape, dtype=FLOAT)
+    padded[tuple(slice(0, n) for n in kernel.shape)] = kernel
+    padded = np.roll(padded, [-(n // 2) for n in kernel.shape], axis=tuple(range(kernel.ndim)))
+    return scipy.fft.rfftn(padded).astype(COMPLEX, copy=False)
+
+
+class KernelCache:
+    """
+    Least-recently-used cache of arrays derived from a kernel for a volume shape (OTFs, filters).
+
+    Keyed by the kernel object and shape; the kernel is kept in the entry so its id cannot be
+    reused while the entry exists. At most `size` entries are kept, so a long-lived engine that
+    sees many shapes does not hold a full-size spectrum for each of them. Safe to share between
+    threads.
+    """
+    def __init__(self, size = KERNEL_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, kernel, shape, make):
+        """Cached value for (kernel, shape), computing it with make() on a miss."""
+        key = (id(kernel), tuple(shape))
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][1]
+        value = make()
+        with self._lock:
+            self._entries[key] = (kernel, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
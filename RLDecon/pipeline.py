@@ -0,0 +1,81 @@
+import queue
+import threading
+
+_DONE = object()
+
+
+def _put(q, value, stop):
+    # Block like q.put, but give up once the consumer has stopped so a failed stage never hangs the others
+    while not stop.is_set():
+        try:
+            q.put(value, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def run_pipelined(items, read, compute, write, depth = 2):
+    """
+    Run read -> compute -> write over `items` with the three stages overlapped.
+
+    read(item) runs on a reader thread and write(item, result) on a writer thread, while
+    compute(item, data) runs on the calling thread (where the TensorFlow/GPU work belongs). The
+    stages are joined by queues holding at most `depth` items, so item t+1 is read and item t-1
+    written while item t is computed, without reading ahead of what memory allows.
+
+    If compute raises (e.g. on cancellation) the reader stops, but results already computed are
+    still written before the exception is re-raised; an exception in the reader or writer stops
+    the pipeline and is re-raised here.
+    """
+    read_q = queue.Queue(maxsize=depth)
+    write_q = queue.Queue(maxsize=depth)
+    stop_reading = threading.Event()
+    main_stopped = threading.Event()
+    writer_stopped = threading.Event()
+    errors = []
+
+    def reader():
+        try:
+            for item in items:
+                if stop_reading.is_set() or not _put(read_q, (item, read(item)), main_stopped):
+                    return
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            _put(read_q, _DONE, main_stopped)
+
+    def writer():
+        try:
+            while True:
+                entry = write_q.get()
+                if entry is _DONE:
+                    return
+                write(*entry)
+        except BaseException as e:
+            errors.append(e)
+            stop_reading.set()
+        finally:
+            writer_stopped.set()
+
+    # Named so the sampling profiler can tell the stages apart
+    threads = [threading.Thread(target=reader, name='rldecon-read', daemon=True),
+               threading.Thread(target=writer, name='rldecon-write', daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        while not errors:
+            entry = read_q.get()
+            if entry is _DONE:
+                break
+            item, data = entry
+            if not _put(write_q, (item, compute(item, data)), writer_stopped):
+                break
+    finally:
+        stop_reading.set()
+        main_stopped.set()
+        _put(write_q, _DONE, writer_stopped)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
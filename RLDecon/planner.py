@@ -0,0 +1,220 @@
+import ctypes
+import functools
+import subprocess
+import sys
+
+import numpy as np
+
+from .kernels import KERNEL_CACHE_SIZE
+
+# Padded-volume sized float32 buffers each engine holds while it runs: flowdec keeps the data,
+# estimate, OTF and conjugate OTF (complex, so two floats each), the blurred estimate, the ratio
+# and the FFT temporaries; the Wiener filter keeps the padded volume, its spectrum, the filter
+# and the result; rl.RichardsonLucy keeps the data, estimate, two half-spectrum OTFs and its
+# temporaries
+ENGINE_COPIES = {'rl': 12, 'preview': 4, 'rfft': 8}
+
+# The Wiener and rl.py engines also cache the filter/OTF of the last few volume shapes (tiles,
+# slabs, files); each is a half spectrum, about one padded float32 volume
+CACHED_COPIES = {'rl': 0, 'preview': KERNEL_CACHE_SIZE - 1, 'rfft': KERNEL_CACHE_SIZE - 1}
+
+# Never plan tiles smaller than this along y/x; below it the halo dominates the work
+MIN_TILE = 64
+
+MAX_PIPELINE_DEPTH = 4
+
+
+def available_memory_mb():
+    """Host memory available to a new allocation in MB, or None if it cannot be read."""
+    try:
+        import psutil
+        return psutil.virtual_memory().available / 1e6
+    except ImportError:
+        pass
+    if sys.platform == 'win32':
+        class MemoryStatus(ctypes.Structure):
+            _fields_ = [('length', ctypes.c_ulong), ('load', ctypes.c_ulong), ('total_phys', ctypes.c_ulonglong),
+                        ('avail_phys', ctypes.c_ulonglong), ('total_page', ctypes.c_ulonglong),
+                        ('avail_page', ctypes.c_ulonglong), ('total_virtual', ctypes.c_ulonglong),
+                        ('avail_virtual', ctypes.c_ulonglong), ('avail_extended', ctypes.c_ulonglong)]
+        status = MemoryStatus()
+        status.length = ctypes.sizeof(MemoryStatus)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.avail_phys / 1e6
+        return None
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1e3
+    except OSError:
+        pass
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def gpu_memory_mb():
+    """
+    Free memory of the first GPU in MB from nvidia-smi, or None without a (visible) NVIDIA GPU.
+
+    Asked once per process: later runs in a process (batches, the watcher) would otherwise pay
+    for a subprocess each, and would see the memory TensorFlow and cupy keep pooled after the
+    first run as used.
+    """
+    try:
+        output = subprocess.run(['nvidia-smi', '--query-gpu=memory.free', '--format=csv,noheader,nounits'],
+                                capture_output=True, text=True, timeout=10).stdout
+        return float(output.split()[0])
+    except (OSError, ValueError, IndexError, subprocess.SubprocessError):
+        return None
+
+
+def split_volumes(shape, channels):
+    """(number of timepoints, (z, y, x)) of an image as run_5d_decon reads it."""
+    if len(shape) == 3:
+        return 1, tuple(shape)
+    if len(shape) == 4:
+        return (shape[0], tuple(shape[1:])) if channels == 1 else (1, (shape[0],) + tuple(shape[2:]))
+    return shape[0], (shape[1],) + tuple(shape[3:])
+
+
+def padded_shape(shape, pad_amount):
+    return tuple(n + 2*pad_amount for n in shape)
+
+
+def tile_block_shape(volume_shape, tile_shape, halo):
+    """Largest block deconvolved for one (y, x) tile, including its halo."""
+    if tile_shape is None:
+        return tuple(volume_shape)
+    return (volume_shape[0],) + tuple(min(n, t + 2*h) for n, t, h in zip(volume_shape[1:], tile_shape, halo[1:]))
+
+
+def estimate_memory(volume_shape, n_volumes, channels = 1, dtype = np.uint16, pad_amount = 16, mode = 'rl',
+                    pipeline_depth = 2, tile_shape = None, halo = (12, 12, 12), resume = False,
+                    input_in_memory = True, output_shape = None, result_dtype = np.float32):
+    """
+    Estimate the peak memory of one run_5d_decon call, in MB per component.
+
+    Parameters:
+    - volume_shape: (z, y, x) of the block read per timepoint (the ROI plus its halo).
+    - n_volumes: number of timepoints written.
+    - output_shape: (z, y, x) stored per volume (ROI, deskewed), defaults to volume_shape.
+    - tile_shape: (y, x) tile deconvolved at a time, or None for whole volumes.
+
+    Returns:
+    - dict with 'input', 'output', 'pipeline', 'write' (host), 'engine' (on the GPU when the
+      engine runs on one, see plan_run, otherwise host too) and 'host' (their host total).
+    """
+    mb = 1e6
+    itemsize = np.dtype(dtype).itemsize
+    output_shape = tuple(output_shape or volume_shape)
+    volume = int(np.prod(volume_shape))
+    out_volume = int(np.prod(output_shape))
+    total_out = n_volumes * channels * out_volume
+
+    estimate = {}
+    # dat stays resident unless it is a memmap
+    estimate['input'] = n_volumes * channels * volume * itemsize / mb if input_in_memory else 0.0
+    # Result array (float32 unless run_5d_decon is asked to be precise), or nothing when volumes
+    # go straight into a resumable memmap
+    estimate['output'] = 0.0 if resume else total_out * np.dtype(result_dtype).itemsize / mb
+    # Volumes in flight: read queue (input copies), the one being computed, write queue (float32)
+    estimate['pipeline'] = ((pipeline_depth + 1) * volume * itemsize + (pipeline_depth + 1) * out_volume * 4) / mb
+    # write_output converts the whole result to uint16 once
+    estimate['write'] = 0.0 if resume else total_out * 2 / mb
+    block = tile_block_shape(volume_shape, tile_shape, halo)
+    estimate['engine'] = (ENGINE_COPIES[mode] + CACHED_COPIES[mode]) * int(np.prod(padded_shape(block, pad_amount))) * 4 / mb
+    estimate['host'] = estimate['input'] + estimate['output'] + estimate['pipeline'] + estimate['write']
+    return estimate
+
+
+def engine_on_gpu(mode, backend = None):
+    """Whether the engine of `mode` runs on a GPU when there is one: flowdec (TensorFlow) or rl.py on cupy."""
+    return mode == 'rl' or (mode == 'rfft' and backend == 'cupy')
+
+
+def plan_run(volume_shape, n_volumes, channels = 1, dtype = np.uint16, pad_amount = 16, mode = 'rl',
+             halo = (12, 12, 12), resume = False, input_in_memory = True, output_shape = None, result_dtype = np.float32,
+             memory_budget = None, device_budget = None, workers = 1, tile_shape = None, pipeline_depth = None,
+             auto_tile = True, backend = None):
+    """
+    Choose tile size, pipeline depth and worker count so a run fits in memory.
+
+    memory_budget (host) and device_budget (GPU) are in MB and default to what is free now. The
+    engine is charged to the GPU when the engine the run uses can run there (see engine_on_gpu;
+    `backend` is the rl.py backend of mode 'rfft') and a GPU is found, otherwise to the host. Tiles
+    are halved along the longer of y and x until the engine fits, the pipeline is made as deep as
+    the host allows (up to MAX_PIPELINE_DEPTH) and `workers` is capped at the number of such runs
+    that fit side by side. With auto_tile=False `tile_shape` is used as given (None for whole
+    volumes), and a given pipeline_depth is kept, so the plan just reports whether they fit.
+
+    Returns:
+    - dict with 'tile_shape', 'pipeline_depth', 'workers', 'fits' and the 'estimate' of one run.
+    """
+    if memory_budget is None:
+        memory_budget = available_memory_mb()
+    on_gpu = engine_on_gpu(mode, backend)
+    if device_budget is None and on_gpu:
+        device_budget = gpu_memory_mb()
+    engine_on_host = not on_gpu or device_budget is None
+
+    def estimate(tile_shape, depth):
+        return estimate_memory(volume_shape, n_volumes, channels, dtype, pad_amount, mode, depth, tile_shape,
+                               halo, resume, input_in_memory, output_shape, result_dtype)
+
+    def fits(e):
+        host = e['host'] + (e['engine'] if engine_on_host else 0)
+        return ((memory_budget is None or host <= memory_budget) and
+                (engine_on_host or e['engine'] <= device_budget))
+
+    # Tile until the engine fits where it runs, next to the shallowest pipeline on the host
+    if engine_on_host:
+        engine_budget = None if memory_budget is None else memory_budget - estimate(None, 1)['host']
+    else:
+        engine_budget = device_budget
+    if auto_tile and tile_shape is None and engine_budget is not None and estimate(None, 1)['engine'] > engine_budget:
+        tile_shape = list(volume_shape[1:])
+        while estimate(tuple(tile_shape), 1)['engine'] > engine_budget and max(tile_shape) > MIN_TILE:
+            axis = int(np.argmax(tile_shape))
+            tile_shape[axis] = max(MIN_TILE, (tile_shape[axis] + 1) // 2)
+        tile_shape = tuple(tile_shape)
+    elif tile_shape is not None:
+        tile_shape = tuple(tile_shape)
+
+    if pipeline_depth is not None:
+        depth = pipeline_depth
+    elif memory_budget is None:
+        # Keep the default depth when nothing is known about the budget
+        depth = 2
+    else:
+        depth = 1
+        while depth < MAX_PIPELINE_DEPTH and fits(estimate(tile_shape, depth + 1)):
+            depth += 1
+    e = estimate(tile_shape, depth)
+
+    per_run_host = e['host'] + (e['engine'] if engine_on_host else 0)
+    max_workers = workers
+    if memory_budget is not None:
+        max_workers = min(max_workers, int(memory_budget // max(per_run_host, 1e-6)))
+    if not engine_on_host:
+        max_workers = min(max_workers, int(device_budget // max(e['engine'], 1e-6)))
+
+    return {'tile_shape': tile_shape, 'pipeline_depth': depth, 'workers': max(1, max_workers), 'fits': fits(e),
+            'estimate': e, 'memory_budget': memory_budget, 'device_budget': device_budget,
+            'engine_on_host': engine_on_host}
+
+
+def format_plan(plan):
+    e = plan['estimate']
+    where = 'host' if plan['engine_on_host'] else 'GPU'
+    budget = lambda value: 'unknown' if value is None else f'{value:.0f} MB'
+    lines = [f"Memory plan: host {e['host'] + (e['engine'] if plan['engine_on_host'] else 0):.0f} MB of "
+             f"{budget(plan['memory_budget'])}, engine {e['engine']:.0f} MB on the {where}"
+             + ('' if plan['engine_on_host'] else f" of {budget(plan['device_budget'])}"),
+             f"  input {e['input']:.0f} MB, output {e['output']:.0f} MB, pipeline {e['pipeline']:.0f} MB, "
+             f"write {e['write']:.0f} MB",
+             f"  tiles {plan['tile_shape'] or 'whole volumes'}, pipeline depth {plan['pipeline_depth']}, "
+             f"workers {plan['workers']}"]
+    if not plan['fits']:
+        lines.append('  WARNING: this run does not fit in the memory budget')
+    return '\n'.join(lines)
@@ -0,0 +1,147 @@
+import hashlib
+import os
+
+import numpy as np
+import tifffile
+from scipy import ndimage
+from scipy.interpolate import interp1d
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.rldecon', 'psf_cache')
+
+# Part of the cache key; bump whenever prepare_psf changes its output
+PREPARE_VERSION = 2
+
+
+def estimate_background(psf, border = 4):
+    """Median and standard deviation of the outer `border` voxels, which only hold background."""
+    mask = np.ones(psf.shape, dtype=bool)
+    mask[tuple(slice(border, n - border) for n in psf.shape)] = False
+    shell = psf[mask]
+    return np.median(shell), np.std(shell)
+
+
+def centroid(psf, threshold = 0.0):
+    """Sub-pixel intensity-weighted centre of the voxels above `threshold`."""
+    weights = np.where(psf > threshold, psf, 0)
+    total = weights.sum()
+    return np.array([np.sum(weights.sum(axis=tuple(a for a in range(psf.ndim) if a != axis)) * np.arange(n)) / total
+                     for axis, n in enumerate(psf.shape)])
+
+
+def peak_component(psf):
+    """
+    Zero everything but the connected nonzero region around the PSF's peak.
+
+    After thresholding, noise above the floor is scattered through the whole stack in small
+    specks; together they hold enough energy to make any energy-based crop nearly the full
+    stack. The peak is found on a lightly smoothed copy so a single hot pixel cannot win.
+    """
+    labels, count = ndimage.label(psf > 0)
+    if count <= 1:
+        return psf
+    peak = np.unravel_index(np.argmax(ndimage.gaussian_filter(psf, 1.0)), psf.shape)
+    label = labels[peak]
+    if label == 0:
+        # The smoothed peak fell between components; take the brightest one
+        label = int(np.argmax(ndimage.sum(psf, labels, index=np.arange(1, count + 1)))) + 1
+    return np.where(labels == label, psf, 0).astype(psf.dtype)
+
+
+def fourier_shift(psf, shift):
+    """Shift a volume by a sub-pixel amount with a phase ramp on its rfftn grid."""
+    freqs = [np.fft.fftfreq(n) for n in psf.shape[:-1]] + [np.fft.rfftfreq(psf.shape[-1])]
+    spectrum = np.fft.rfftn(psf)
+    for axis, (f, s) in enumerate(zip(freqs, shift)):
+        ramp = np.exp(-2j * np.pi * f * s).astype(spectrum.dtype)
+        spectrum *= ramp.reshape([-1 if i == axis else 1 for i in range(psf.ndim)])
+    return np.fft.irfftn(spectrum, psf.shape, axes=tuple(range(psf.ndim)))
+
+
+def energy_crop(psf, fraction = 0.99):
+    """
+    Crop a centred PSF to the smallest box around its centre holding `fraction` of its energy.
+
+    The box keeps the PSF's aspect ratio (half-widths proportional to its standard deviation
+    along each axis), never reaches past the nonzero voxels (so side lobes that inflate one
+    axis's standard deviation cannot grow it beyond the PSF) and has odd sides, so the centre
+    stays on the middle voxel.
+    """
+    centre = np.array(psf.shape) // 2
+    total = psf.sum()
+    coords = [np.arange(n) - c for n, c in zip(psf.shape, centre)]
+    sigmas = np.array([np.sqrt(np.sum(psf.sum(axis=tuple(a for a in range(psf.ndim) if a != axis)) * x**2) / total)
+                       for axis, x in enumerate(coords)])
+    sigmas = np.maximum(sigmas, 0.5)
+    # Half-widths that already hold every nonzero voxel
+    extent = np.array([np.max(np.abs(np.flatnonzero(np.any(psf != 0, axis=tuple(a for a in range(psf.ndim) if a != axis)))
+                                     - c), initial=0) for axis, c in enumerate(centre)])
+    limit = np.minimum(extent, centre)
+
+    def box(scale):
+        half = np.minimum(np.ceil(scale * sigmas).astype(int), limit)
+        return tuple(slice(c - h, c + h + 1) for c, h in zip(centre, half))
+
+    # Binary search the smallest scale (in standard deviations) that holds enough energy
+    low, high = 0.0, float(np.max(limit / sigmas)) + 1
+    for _ in range(30):
+        mid = 0.5 * (low + high)
+        if psf[box(mid)].sum() >= fraction * total:
+            high = mid
+        else:
+            low = mid
+    return psf[box(high)]
+
+
+def prepare_psf(psf, energy = 0.99, border = 4, noise_floor = 3.0):
+    """
+    Clean up a measured bead PSF for deconvolution.
+
+    Subtracts the background estimated from the border of the stack and zeroes everything
+    within `noise_floor` standard deviations of it, and keeps only the connected region around
+    the peak (otherwise noise in the tails carries a large share of the energy). Then recentres
+    the PSF on its sub-pixel centroid, crops it to the smallest box holding `energy` of the
+    total and normalises it to sum to one. Returns a float32 array with odd sides and the
+    centre on the middle voxel.
+    """
+    psf = np.asarray(psf, dtype=np.float32)
+    bkgd, bkgd_std = estimate_background(psf, border)
+    psf = psf - bkgd
+    psf[psf < noise_floor * bkgd_std] = 0
+    psf = peak_component(psf)
+
+    # Pad to odd sides so the array centre is a voxel, then move the centroid onto it
+    psf = np.pad(psf, [(0, 1 - n % 2) for n in psf.shape])
+    shift = np.array(psf.shape) // 2 - centroid(psf)
+    psf = fourier_shift(psf, shift)
+    # The phase ramp rings faintly over the whole stack; clean up again
+    psf[psf < noise_floor * bkgd_std] = 0
+    psf = peak_component(psf)
+
+    psf = energy_crop(psf, energy)
+    return (psf / psf.sum()).astype(np.float32)
+
+
+def resample_psf_z(psf, original_z_spacing, target_z_spacing):
+    """Cubic-interpolate a PSF to a new z spacing, keeping the centre slice in place (vectorised over x, y)."""
+    centre = psf.shape[0] // 2
+    half = int(np.floor(centre * original_z_spacing / target_z_spacing))
+    original_z_positions = (np.arange(psf.shape[0]) - centre) * original_z_spacing
+    new_z_positions = np.arange(-half, half + 1) * target_z_spacing
+    interp_function = interp1d(original_z_positions, psf, kind='cubic', axis=0, bounds_error=False, fill_value=0.0)
+    return interp_function(new_z_positions).astype(np.float32)
+
+
+def prepare_psf_file(psf_file_str, energy = 0.99, border = 4, noise_floor = 3.0, cache_dir = CACHE_DIR):
+    """Load a measured PSF .tif and run prepare_psf, caching the result keyed by file content and settings."""
+    psf = tifffile.imread(psf_file_str)
+    key = hashlib.sha1(psf.tobytes() + repr((psf.shape, str(psf.dtype), energy, border, noise_floor, PREPARE_VERSION)).encode()).hexdigest()
+    cache_file_str = os.path.join(cache_dir, key + '.npy') if cache_dir else None
+    if cache_file_str and os.path.exists(cache_file_str):
+        return np.load(cache_file_str)
+
+    prepared = prepare_psf(psf, energy, border, noise_floor)
+    print(f'Prepared PSF {psf_file_str}: {psf.shape} -> {prepared.shape}')
+    if cache_file_str:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.save(cache_file_str, prepared)
+    return prepared
@@ -0,0 +1,152 @@
+import argparse
+import glob
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tifffile
+
+
+def load_psfs(psf_files, workers = 8):
+    """Read PSF stacks on a thread pool and stack them into one float32 (N, z, y, x) array."""
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        psfs = list(executor.map(tifffile.imread, psf_files))
+    shapes = {psf.shape for psf in psfs}
+    if len(shapes) != 1:
+        raise ValueError(f'All PSFs must have the same shape, got {sorted(shapes)}')
+    return np.stack(psfs).astype(np.float32)
+
+
+def _half_spectrum_weights(shape):
+    # rfftn stores only non-negative last-axis frequencies; every bin other than 0 (and Nyquist
+    # for even lengths) stands for itself and its complex conjugate
+    weights = np.full(shape[-1] // 2 + 1, 2.0)
+    weights[0] = 1.0
+    if shape[-1] % 2 == 0:
+        weights[-1] = 1.0
+    return weights
+
+
+def register_psfs(spectra, shape, upsample_factor = 10):
+    """
+    Find the shift that registers every PSF to the first one by cross-correlation.
+
+    `spectra` are the rfftn of all PSFs, computed together, so the reference spectrum is shared
+    and every correlation is a real FFT. The cross-power spectrum is not normalised to phase
+    only: a PSF's spectrum falls below float32 precision well before Nyquist, and giving those
+    bins the same weight as the rest moves the peak by several tenths of a pixel.
+
+    The integer peak of each correlation is refined to 1/upsample_factor of a pixel with a
+    matrix DFT evaluated only in a 1.5 pixel neighbourhood of the peak (as in skimage's
+    phase_cross_correlation), batched over all PSFs.
+
+    Returns:
+    - (N, ndim) array: shift to apply to each PSF, zero for the reference.
+    """
+    ndim = len(shape)
+    axes = tuple(range(1, ndim + 1))
+    cross = spectra[:1] * np.conj(spectra)
+    corr = np.fft.irfftn(cross, shape, axes=axes)
+
+    peaks = np.array(np.unravel_index(corr.reshape(len(corr), -1).argmax(axis=1), shape)).T.astype(np.float64)
+    shape_arr = np.array(shape)
+    peaks = np.where(peaks > shape_arr // 2, peaks - shape_arr, peaks)
+    if upsample_factor <= 1:
+        return peaks
+
+    # Evaluate the correlation on a fine grid around each peak: C(x) = Re sum_k w(k) R(k) exp(2 pi i k.x)
+    region = int(np.ceil(upsample_factor * 1.5))
+    offsets = (np.arange(region) - region // 2) / upsample_factor
+    freqs = [np.fft.fftfreq(n) for n in shape[:-1]] + [np.fft.rfftfreq(shape[-1])]
+    fine = cross * _half_spectrum_weights(shape)
+    for axis in range(ndim):
+        positions = peaks[:, axis, None] + offsets[None, :]
+        kernel = np.exp(2j * np.pi * positions[:, :, None] * freqs[axis][None, None, :])
+        # Contract the first remaining frequency axis; its position axis goes to the end
+        fine = np.einsum('nk...,nrk->n...r', fine, kernel)
+    fine = fine.real
+
+    best = np.array(np.unravel_index(fine.reshape(len(fine), -1).argmax(axis=1), fine.shape[1:])).T
+    shifts = peaks + offsets[best]
+    shifts[0] = 0
+    return shifts
+
+
+def shift_spectra(spectra, shifts, shape):
+    """Apply sub-pixel shifts to a batch of rfftn spectra with phase ramps (no extra FFTs)."""
+    freqs = [np.fft.fftfreq(n) for n in shape[:-1]] + [np.fft.rfftfreq(shape[-1])]
+    shifted = spectra.copy()
+    for axis, f in enumerate(freqs):
+        ramp = np.exp(-2j * np.pi * shifts[:, axis, None] * f[None, :]).astype(spectra.dtype)
+        shifted *= ramp.reshape([len(spectra)] + [-1 if i == axis else 1 for i in range(len(shape))])
+    return shifted
+
+
+def average_psfs(psf_files, weights = None, upsample_factor = 10, workers = 8):
+    """
+    Register PSFs to the first one and return their weighted average.
+
+    All PSFs are transformed with one batched rfftn, registered against the shared reference
+    spectrum, shifted in Fourier space and averaged there, so the average needs a single
+    inverse FFT. Returns (averaged_psf, shifts).
+    """
+    stack = load_psfs(psf_files, workers)
+    shape = stack.shape[1:]
+    axes = tuple(range(1, stack.ndim))
+    spectra = np.fft.rfftn(stack, axes=axes).astype(np.complex64)
+    del stack
+
+    shifts = register_psfs(spectra, shape, upsample_factor)
+    for psf_file, shift in zip(psf_files, shifts):
+        print(f'{psf_file}: shift {np.round(shift, 2)}')
+
+    weights = np.ones(len(psf_files)) if weights is None else np.asarray(weights, dtype=np.float64)
+    weights = (weights / weights.sum()).astype(np.float32)
+    shifted = shift_spectra(spectra, shifts, shape)
+    mean_spectrum = np.tensordot(weights, shifted, axes=1)
+    return np.fft.irfftn(mean_spectrum, shape, axes=tuple(range(len(shape)))).astype(np.float32), shifts
+
+
+def average_covariances(csv_files, weights = None):
+    """Weighted element-wise average of fitted PSF covariance csvs."""
+    arrays = [np.genfromtxt(csv_file, delimiter=',') for csv_file in csv_files]
+    return np.average(arrays, axis=0, weights=weights)
+
+
+def expand_paths(patterns):
+    # Windows shells do not expand wildcards, so do it here
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches if matches else [pattern])
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Register and average bead PSFs and fitted PSF covariances',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--psf', type=str, nargs='+', required=False, help='PSF .tif files or wildcards, the first is the reference')
+    parser.add_argument('--output', type=str, default='PSFs/averaged_psf.tif')
+    parser.add_argument('--csv', type=str, nargs='+', required=False, help='fitted PSF covariance .csv files or wildcards')
+    parser.add_argument('--output_csv', type=str, default='average.csv')
+    parser.add_argument('--weights', type=float, nargs='+', required=False, help='one weight per file')
+    parser.add_argument('--upsample_factor', type=int, default=10)
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    if not args.psf and not args.csv:
+        parser.error('Give --psf and/or --csv files to average')
+
+    if args.psf:
+        psf_files = expand_paths(args.psf)
+        averaged_psf, _ = average_psfs(psf_files, args.weights, args.upsample_factor, args.workers)
+        tifffile.imwrite(args.output, averaged_psf)
+        print(f'Averaged {len(psf_files)} PSFs into {args.output}')
+
+    if args.csv:
+        csv_files = expand_paths(args.csv)
+        np.savetxt(args.output_csv, average_covariances(csv_files, args.weights), delimiter=',', fmt='%f')
+        print(f'Averaged {len(csv_files)} covariances into {args.output_csv}')
+
+
+if __name__ == '__main__':
+    main()
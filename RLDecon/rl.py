@@ -0,0 +1,194 @@
+import contextlib
+
+import numpy as np
+from scipy import ndimage
+
+from .dtypes import FLOAT, as_float
+from .kernels import KernelCache, kernel_to_otf
+from .threads import fft_workers
+
+# Plain Richardson-Lucy unless asked; total-variation weights around 0.002 suit noisy LLSM stacks
+DEFAULT_TV_REGULARIZATION = 0.0
+
+# Floor on the blurred estimate so empty (zero) voxels never divide by zero
+EPSILON = 1e-6
+
+# Downsampling factors for coarse-to-fine starts; y and x only, z is already coarsely sampled
+COARSE_FACTORS = (2, 4)
+
+
+def get_backend(backend = None):
+    """
+    (array module, fft module) for 'numpy' (the default) or 'cupy'.
+
+    numpy runs its FFTs through scipy.fft, which keeps float32 in single precision (numpy.fft
+    before 2.0 always returns double) and runs each transform on threads.fft_workers() threads.
+    """
+    if backend in (None, 'numpy'):
+        import scipy.fft
+        return np, scipy.fft
+    if backend == 'cupy':
+        import cupy
+        return cupy, cupy.fft
+    raise ValueError(f"backend must be 'numpy' or 'cupy': {backend}")
+
+
+def cutoff_mask(shape, cutoff, xp = np):
+    """
+    Low-pass mask on the rfftn grid of `shape`.
+
+    Keeps frequencies inside the ellipsoid reaching `cutoff` x Nyquist along every axis, so it
+    is the same fraction of the resolution along z as laterally. Returned as float32, the size
+    of a half spectrum.
+    """
+    ndim = len(shape)
+    freqs = [xp.fft.fftfreq(n) for n in shape[:-1]] + [xp.fft.rfftfreq(shape[-1])]
+    radius = xp.zeros([len(f) for f in freqs], dtype=FLOAT)
+    for axis, f in enumerate(freqs):
+        radius += as_float((f / 0.5)**2, xp).reshape([-1 if i == axis else 1 for i in range(ndim)])
+    return as_float(radius <= cutoff**2, xp)
+
+
+def downsample(volume, factor):
+    """Mean over (factor, factor) blocks in y and x; rows and columns past the last whole block are dropped."""
+    z, y, x = volume.shape
+    y, x = y // factor, x // factor
+    return as_float(volume)[:, :y*factor, :x*factor].reshape(z, y, factor, x, factor).mean(axis=(2, 4))
+
+
+def downsample_kernel(kernel, factor):
+    """
+    Kernel for a volume downsampled by `downsample`: the kernel convolved in y and x with the
+    triangle that is two coarse-pixel boxes convolved (1/2, 1, 1/2 for factor 2), taken every
+    `factor` pixels out from its middle voxel and normalised to sum 1. The triangle is centred,
+    so the coarse kernel has the same centre as the fine one and the coarse estimate is not
+    shifted against the data.
+    """
+    box = np.ones(factor, dtype=FLOAT)
+    triangle = np.convolve(box, box) / factor
+    summed = as_float(kernel)
+    for axis in (1, 2):
+        summed = ndimage.correlate1d(summed, triangle, axis=axis, mode='constant')
+    index = [slice(None)]
+    for n in kernel.shape[1:]:
+        half = min(n // 2, n - 1 - n // 2) // factor * factor
+        index.append(slice(n // 2 - half, n // 2 + half + 1, factor))
+    coarse = summed[tuple(index)]
+    return coarse / coarse.sum()
+
+
+def upsample(volume, factor, shape):
+    """Linear interpolation of a downsampled volume back to `shape`, edge values repeated into dropped rows/columns."""
+    fine = ndimage.zoom(volume, (1, factor, factor), order=1, mode='nearest', grid_mode=True)
+    return np.pad(fine, [(0, n - m) for n, m in zip(shape, fine.shape)], mode='edge')
+
+
+def tv_divergence(estimate, xp = np):
+    """div(grad u / |grad u|), the total-variation term of the regularised RL update."""
+    gradients = xp.gradient(estimate)
+    norm = xp.sqrt(sum(g*g for g in gradients)) + EPSILON
+    return sum(xp.gradient(g / norm, axis=axis) for axis, g in enumerate(gradients))
+
+
+class RichardsonLucy:
+    """
+    Richardson-Lucy deconvolution on half spectra, on numpy or cupy.
+
+    Every convolution is an rfftn/irfftn pair, so each spectrum (and the OTF) is half the size
+    of a full complex FFT, and everything is float32/complex64. The OTF of each kernel and
+    volume shape is computed once and the last few are kept (see kernels.KernelCache), with
+    the optional low-pass `cutoff` (a fraction of Nyquist, see cutoff_mask) folded into it.
+    `regularization` > 0 adds total-variation regularisation (Dey et al. 2006), which damps the
+    noise amplification of late iterations. Volumes are reflect-padded by `pad_amount` on every
+    side against wrap-around and the estimate starts from the input, like flowdec, or from
+    `start`, an earlier estimate of the same volume, to continue iterating where a previous run
+    stopped.
+
+    With `coarse_factor` (2 or 4) and no `start`, the estimate instead starts from
+    `coarse_iterations` (default half of niter) iterations on the volume downsampled by that
+    factor in y and x, with the matching downsampled kernel, interpolated back to full size; only
+    the remaining iterations run at full resolution. The coarse iterations cost about
+    1/factor**2 as much and recover the low frequencies that early full-size iterations spend
+    their time on.
+
+    Has the same run(acquisition, niter) interface as flowdec's RichardsonLucyDeconvolver, so it
+    can stand in for it in run_5d_decon.
+    """
+    def __init__(self, pad_amount = 16, regularization = DEFAULT_TV_REGULARIZATION, cutoff = None, backend = None,
+                 coarse_factor = None, coarse_iterations = None):
+        if coarse_factor is not None and coarse_factor not in COARSE_FACTORS:
+            raise ValueError(f'coarse_factor must be one of {COARSE_FACTORS}: {coarse_factor}')
+        self.pad_amount = pad_amount
+        self.regularization = regularization
+        self.cutoff = cutoff
+        self.coarse_factor = coarse_factor
+        self.coarse_iterations = coarse_iterations
+        self.xp, self.fft = get_backend(backend)
+        self._otfs = KernelCache()
+        self._coarse_kernels = KernelCache()
+
+    def initialize(self):
+        return self
+
+    def get_otf(self, kernel, shape, cutoff = None):
+        def make():
+            otf = self.xp.asarray(kernel_to_otf(kernel / kernel.sum(), shape))
+            if cutoff is not None:
+                otf *= cutoff_mask(shape, cutoff, self.xp)
+            return otf
+        return self._otfs.get(kernel, shape, make)
+
+    def get_coarse_kernel(self, kernel):
+        return self._coarse_kernels.get(kernel, (), lambda: downsample_kernel(kernel, self.coarse_factor))
+
+    def clear_cache(self):
+        self._otfs.clear()
+        self._coarse_kernels.clear()
+
+    def coarse_start(self, volume, kernel, niter):
+        """Start estimate from RL on the downsampled volume, and the iterations left for full resolution."""
+        factor = self.coarse_factor
+        coarse_niter = min(niter - 1, niter // 2 if self.coarse_iterations is None else self.coarse_iterations)
+        # The coarse grid has little of the noise the cutoff is for, so it runs without one
+        coarse = self.iterate(downsample(volume, factor), self.get_coarse_kernel(kernel), coarse_niter, None,
+                              self.pad_amount // factor, None)
+        return upsample(coarse, factor, volume.shape), niter - coarse_niter
+
+    def deconvolve(self, volume, kernel, niter, start = None):
+        # Volumes (or tiles) only a few coarse pixels across are not worth a coarse pass
+        if start is None and self.coarse_factor and niter > 1 and min(volume.shape[1:]) >= 4*self.coarse_factor:
+            start, niter = self.coarse_start(volume, kernel, niter)
+        return self.iterate(volume, kernel, niter, start, self.pad_amount, self.cutoff)
+
+    def iterate(self, volume, kernel, niter, start, pad, cutoff):
+        xp, fft = self.xp, self.fft
+        data = as_float(volume)
+        if pad:
+            data = np.pad(data, pad, mode='reflect')
+        shape = data.shape
+        otf = self.get_otf(kernel, shape, cutoff)
+        otf_conj = xp.conj(otf)
+        data = xp.asarray(data)
+        if start is None:
+            estimate = data.copy()
+        else:
+            # Padded the same way as the data, so the border carries on from the same values
+            estimate = as_float(start)
+            estimate = xp.asarray(np.pad(estimate, pad, mode='reflect') if pad else estimate.copy())
+        # scipy.fft runs single-threaded unless told otherwise; cupy has no such setting
+        with fft.set_workers(fft_workers()) if xp is np else contextlib.nullcontext():
+            for _ in range(niter):
+                blurred = fft.irfftn(fft.rfftn(estimate) * otf, shape)
+                ratio = data / xp.maximum(blurred, EPSILON)
+                estimate *= fft.irfftn(fft.rfftn(ratio) * otf_conj, shape)
+                if self.regularization:
+                    estimate /= xp.maximum(1 - self.regularization * tv_divergence(estimate, xp), EPSILON)
+                xp.maximum(estimate, 0, out=estimate)
+        if pad:
+            estimate = estimate[tuple(slice(pad, n - pad) for n in shape)]
+        estimate = as_float(estimate, xp)
+        return estimate.get() if xp is not np else estimate
+
+    def run(self, acquisition, niter, session_config=None, start=None):
+        return type(acquisition)(data=self.deconvolve(acquisition.data, acquisition.kernel, niter, start),
+                                 kernel=acquisition.kernel)
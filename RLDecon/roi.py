@@ -0,0 +1,147 @@
+import numpy as np
+
+
+def parse_roi(text):
+    """
+    Parse a 'z0:z1,y0:y1,x0:x1' region of interest into a tuple of three slices.
+
+    Empty bounds mean the start/end of the axis, so ':,100:300,100:300' keeps every slice.
+    """
+    parts = text.split(',')
+    if len(parts) != 3:
+        raise ValueError(f'ROI must have z, y and x ranges: {text}')
+    roi = []
+    for part in parts:
+        bounds = part.split(':')
+        if len(bounds) != 2:
+            raise ValueError(f'ROI ranges must look like start:stop: {text}')
+        roi.append(slice(*[int(b) if b.strip() else None for b in bounds]))
+    return tuple(roi)
+
+
+def parse_indices(text):
+    """Parse '0,5,10:20' into a sorted list of indices (ranges exclude their stop, like python)."""
+    indices = set()
+    for part in text.split(','):
+        if ':' in part:
+            start, stop = part.split(':')
+            indices.update(range(int(start), int(stop)))
+        else:
+            indices.add(int(part))
+    return sorted(indices)
+
+
+def kernel_halo(kernel_shapes):
+    """Voxels of context needed around an ROI on each side: half the largest kernel along each axis."""
+    return tuple(int(max(shape[axis] for shape in kernel_shapes) // 2) for axis in range(3))
+
+
+def padded_roi(roi, halo, shape):
+    """
+    Grow a (z, y, x) ROI by `halo` voxels per side, clipped to the volume.
+
+    Returns:
+    - block: tuple of slices to cut out of the volume and deconvolve.
+    - crop: tuple of slices that cut the ROI back out of the deconvolved block.
+    """
+    block, crop = [], []
+    for s, h, n in zip(roi, halo, shape):
+        start, stop, _ = s.indices(n)
+        if stop <= start:
+            raise ValueError(f'Empty ROI {roi} for a volume of shape {shape}')
+        block_start, block_stop = max(0, start - h), min(n, stop + h)
+        block.append(slice(block_start, block_stop))
+        crop.append(slice(start - block_start, stop - block_start))
+    return tuple(block), tuple(crop)
+
+
+def _extent(rows):
+    indices = np.flatnonzero(rows.any(axis=0))
+    return slice(int(indices[0]), int(indices[-1]) + 1) if indices.size else None
+
+
+def nonzero_slabs(volume, halo, max_slabs = 8):
+    """
+    Cover the nonzero voxels of a (z, y, x) volume with z slabs, each with its own tight (y, x) box.
+
+    Deskewed stacks are parallelograms in x-z surrounded by zero wedges, so a few slabs follow
+    the shear far more closely than one bounding box. The number of slabs (up to `max_slabs`) is
+    the one with the smallest total block volume, halos included; one slab is the plain
+    bounding box.
+
+    Returns a list of (core, block, crop) like iter_tiles: deconvolve volume[block], keep
+    result[crop] and store it at core. Everything outside the cores is zero. The list is empty
+    for an all-zero volume.
+    """
+    mask = volume != 0
+    # Per z slice, which y rows and x columns hold data
+    rows, columns = mask.any(axis=2), mask.any(axis=1)
+    z_indices = np.flatnonzero(rows.any(axis=1))
+    if z_indices.size == 0:
+        return []
+    z_start, z_stop = int(z_indices[0]), int(z_indices[-1]) + 1
+
+    best, best_cost = None, None
+    for count in range(1, max_slabs + 1):
+        edges = np.linspace(z_start, z_stop, count + 1).round().astype(int)
+        slabs = []
+        for z0, z1 in zip(edges[:-1], edges[1:]):
+            y, x = _extent(rows[z0:z1]), _extent(columns[z0:z1])
+            if z1 > z0 and y is not None:
+                core = (slice(int(z0), int(z1)), y, x)
+                slabs.append((core,) + padded_roi(core, halo, volume.shape))
+        cost = sum(np.prod([s.stop - s.start for s in block]) for _, block, _ in slabs)
+        if best_cost is None or cost < best_cost:
+            best, best_cost = slabs, cost
+    return best
+
+
+def iter_tiles(shape, tile_shape, halo):
+    """
+    Split a (z, y, x) volume into (y, x) tiles of at most `tile_shape`, each with its halo.
+
+    Yields (tile, block, crop) like padded_roi: deconvolve volume[block], keep result[crop] and
+    store it at tile. Tiles span all of z.
+    """
+    for y0 in range(0, shape[1], tile_shape[0]):
+        for x0 in range(0, shape[2], tile_shape[1]):
+            tile = (slice(0, shape[0]), slice(y0, min(y0 + tile_shape[0], shape[1])),
+                    slice(x0, min(x0 + tile_shape[1], shape[2])))
+            block, crop = padded_roi(tile, halo, shape)
+            yield tile, block, crop
+
+
+def roi_shape(roi, shape):
+    return tuple(len(range(*s.indices(n))) for s, n in zip(roi, shape))
+
+
+def roi_to_list(roi):
+    # Slices are not JSON serialisable; used for checkpoint parameters and telemetry
+    return None if roi is None else [[s.start, s.stop] for s in roi]
+
+
+def select_volume(image, axes, timepoint = 0, channel = 0):
+    """Pick one timepoint and channel out of a tifffile series (using its axes string), leaving (z, y, x)."""
+    for axis, index in (('T', timepoint), ('C', channel)):
+        if axis in axes:
+            image = np.take(image, index, axis=axes.index(axis))
+            axes = axes.replace(axis, '')
+    return image
+
+
+def read_volume(tif, timepoint = 0, channel = 0):
+    """
+    Read one timepoint and channel of the first series of an open TiffFile as (z, y, x).
+
+    Only the pages of that volume are decoded, so one volume of a long time series costs one
+    volume of reading. Series whose pages do not map one to one onto their leading axes are
+    read whole and cut with select_volume.
+    """
+    series = tif.series[0]
+    page_axes = series.axes[:len(series.shape) - len(series.keyframe.shape)]
+    page_shape = series.shape[:len(page_axes)]
+    if len(series.pages) != int(np.prod(page_shape)):
+        return select_volume(series.asarray(), series.axes, timepoint, channel)
+    pages = select_volume(np.arange(len(series.pages)).reshape(page_shape), page_axes, timepoint, channel)
+    volume = tif.asarray(key=pages.ravel().tolist(), series=0)
+    return volume.reshape(pages.shape + series.keyframe.shape)
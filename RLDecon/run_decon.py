@@ -5,8 +5,10 @@ import numpy as np
 import tifffile
 import sys
 import argparse
+import hashlib
 import os
 import logging
+import time
 import tensorflow as tf
 from skimage import exposure#, external
 from scipy import ndimage, signal, stats
@@ -15,73 +17,352 @@ from flowdec import data as fd_data
 from flowdec import psf as fd_psf
 from flowdec import restoration as fd_restoration
 from tqdm import tqdm
+from .kernels import get_kernel
+from .writer import write_output
+from .deskew import deskew, deskew_geometry, deskewed_shape, get_skewed_kernel, pixel_size
+from .checkpoint import SavedEstimate, TimepointCheckpoint
+from .pipeline import run_pipelined
+from .deconvolvers import get_deconvolver, session_config
+from .threads import current_policy
+from .autotune import autotune
+from .shard import shard_file_str, shard_range
+from .dtypes import FLOAT, work_dtype
+from .roi import iter_tiles, kernel_halo, nonzero_slabs, padded_roi, roi_shape, roi_to_list
+from .planner import format_plan, plan_run
+from .telemetry import Telemetry, profiled, profile_from_env
 
 
-def get_kernel(psf, z_spacing = 2.705078):
-    kernel_shape = (51,51,51)
-    kernel_shape = (25,25,25)
-    kernel = np.zeros(kernel_shape) #(51,51,51)) #Note may not work if this size is too big relative to the image
-    for offset in [0,1]:
-        kernel[tuple((np.array(kernel.shape) - offset) // 2)] = 1
-    #assume bead image at different resolution in z to actual data, and difference is a factor of 3.08 (308nm versus 100nm)
-    #estimated and stored 3d psf, but assume here diagonal psf. Could adjust this, but already very close to diagonal
-    kernel = ndimage.gaussian_filter(kernel, sigma=[np.sqrt(psf[2,2])/z_spacing,np.sqrt(psf[0,0]),np.sqrt(psf[1,1])])
-    return kernel
-
-def run_3d_decon(timepoint, kernel, niter, algo):
-    nonzero = timepoint[np.where(timepoint>0)]
-    bkgd_mode = stats.mode(nonzero)[0][0]
-    bkgd_std = stats.tstd(nonzero)
-    indz,indy,indx = np.where(timepoint==0)
-    timepoint[indz, indy, indx] = bkgd_mode + bkgd_std*np.random.randn(len(indz))
-    return algo.run(fd_data.Acquisition(data=timepoint, kernel=kernel), niter=niter).data
-
-def run_5d_decon(input_file_str, dat, mdata, psfs, x_res, y_res, z_spacing, niter, pad_amount, channels):
+class DeconvolutionCancelled(Exception):
+    """Raised by run_5d_decon when its cancel_event is set; with resume=True finished timepoints stay in the checkpoint."""
+
+
+MODES = ['rl', 'preview', 'rfft', 'auto']
+
+def default_output_file_str(input_file_str, niter, pad_amount, channels, mode='rl'):
+    if mode == 'preview':
+        suffix = f"wienerPreview_padding{pad_amount}_channels{channels}.tif"
+    elif mode == 'rfft':
+        suffix = f"rfftRL_iter{niter}_padding{pad_amount}_channels{channels}.tif"
+    else:
+        suffix = f"flowdecRL_iter{niter}_padding{pad_amount}_channels{channels}.tif"
+    return input_file_str.replace(".tif", suffix)
+
+def fill_zeros(timepoint, telemetry=None):
+    # Replace zero voxels (e.g. deskew wedges) in place with noise around the background mode
+    telemetry = telemetry or Telemetry()
+    with telemetry.timer('elementwise'):
+        nonzero = timepoint[np.where(timepoint>0)]
+        bkgd_mode = stats.mode(nonzero)[0][0]
+        bkgd_std = nonzero.std(ddof=1, dtype=FLOAT)
+        indz,indy,indx = np.where(timepoint==0)
+    with telemetry.timer('rng'):
+        noise = np.random.default_rng().standard_normal(len(indz), dtype=FLOAT)
+    with telemetry.timer('elementwise'):
+        timepoint[indz, indy, indx] = FLOAT(bkgd_mode) + FLOAT(bkgd_std)*noise
+    return timepoint
+
+def deconvolve(timepoint, kernel, niter, algo, telemetry=None, config=None, start=None):
+    telemetry = telemetry or Telemetry()
+    acquisition = fd_data.Acquisition(data=timepoint, kernel=kernel)
+    # flowdec runs the whole RL loop (FFTs and elementwise updates) inside one TensorFlow call
+    with telemetry.timer('deconvolution'):
+        if start is None:
+            return algo.run(acquisition, niter=niter, session_config=config).data
+        # Only the rl.py engine can start from an earlier estimate
+        return algo.run(acquisition, niter=niter, session_config=config, start=start).data
+
+def run_3d_decon(timepoint, kernel, niter, algo, telemetry=None, config=None):
+    return deconvolve(fill_zeros(timepoint, telemetry), kernel, niter, algo, telemetry, config)
+
+def run_5d_decon(input_file_str, dat, mdata, psfs, x_res, y_res, z_spacing, niter, pad_amount, channels,
+                 output_file_str=None, telemetry=None, profile=None, resume=False, progress=None, cancel_event=None,
+                 deskew_angle=None, write_options=None, pipeline_depth=2, roi=None, timepoints=None,
+                 channel_subset=None, mode='rl', regularization=None, memory_budget=None,
+                 tile_shape=None, intra_op_threads=None, inter_op_threads=None, cutoff=None, backend=None,
+                 precise=False, autocrop=False, shard=None, save_estimate=False, continue_from=None,
+                 coarse_factor=None, coarse_iterations=None, output_dir=None):
+    # output_dir: folder for the default-named output (named after the engine actually used, also
+    #   with mode='auto'), default next to the input; ignored when output_file_str is given
+    # resume: write each timepoint straight into the output file and record it in a sidecar
+    #   manifest (see checkpoint.TimepointCheckpoint); rerunning with resume=True skips finished timepoints
+    # telemetry: Telemetry writing one JSON line per timepoint/channel, defaults to RLDECON_TELEMETRY
+    # profile: (mode, output) passed to telemetry.profiled, defaults to RLDECON_PROFILE
+    # progress: called as progress(done, total) with the number of finished timepoint/channel volumes
+    # cancel_event: threading.Event checked between volumes; when set, DeconvolutionCancelled is raised
+    # deskew_angle: light-sheet angle of raw stage-scan data; each volume is deconvolved in the raw
+    #   skewed frame with a sheared kernel and deskewed once afterwards (see deskew.py)
+    # write_options: writer.write_output options (compression, level, tile, rowsperstrip, maxworkers);
+    #   resumable outputs are written in place and stay uncompressed
+    # pipeline_depth: volumes queued between the read, deconvolution and write stages, which run on
+    #   separate threads (see pipeline.run_pipelined); dat can be a memmap, it is read a timepoint at a time
+    # roi: (z, y, x) slices; only this block, grown by the kernel half-width on each side, is
+    #   deconvolved and the output holds just the ROI (see roi.parse_roi)
+    # timepoints, channel_subset: lists of the timepoints/channels to deconvolve, default all
+    # mode: 'rl' for flowdec Richardson-Lucy, or 'preview' for a one-shot Wiener filter with the same
+    #   kernels (see wiener.WienerDeconvolver; niter is ignored and regularization sets its strength),
+    #   or 'rfft' for the half-spectrum RL engine in rl.py on backend 'numpy' or 'cupy', with optional
+    #   total-variation regularization and a low-pass cutoff (fraction of Nyquist), or 'auto' to
+    #   benchmark the engines, backends and paddings on the first volume and use the fastest accurate
+    #   one (see autotune.autotune; the choice is cached per host and shape)
+    # memory_budget: host MB this run may use; tiles and pipeline_depth are chosen to fit it (see
+    #   planner.plan_run) and MemoryError is raised before starting if nothing does. Without a budget
+    #   the plan for the given settings is still printed, with a warning if it exceeds free memory
+    # tile_shape: (y, x); deconvolve each volume in tiles of this size, each with a kernel-sized halo
+    # autocrop: deconvolve only the nonzero part of each volume, skipping the zero wedges of deskewed
+    #   data: z slabs with tight (y, x) boxes grown by the kernel half-width (see roi.nonzero_slabs);
+    #   zeros are written back outside them
+    # shard: (index, count); deconvolve only this shard's contiguous share of the timepoints into a
+    #   resumable partial output, to be assembled by shard.merge_shards (see shard.py)
+    # save_estimate: keep the float32 estimate of every volume next to the output (see
+    #   checkpoint.SavedEstimate), so a later run can continue iterating from it
+    # continue_from: output of an earlier run saved with save_estimate; run niter more iterations from
+    #   its estimates instead of from the data (mode 'rfft' only, flowdec always starts from the data).
+    #   Same timepoints, channels, ROI and deskewing; outputs are named by the total iterations
+    # coarse_factor: 2 or 4; start each volume from coarse_iterations (default niter // 2) RL iterations
+    #   on it downsampled by this factor in y and x and run only the rest at full resolution (mode
+    #   'rfft', or 'auto', which then only tries the rl.py engine; see rl.RichardsonLucy)
+    # precise: keep the result array in float64 instead of float32 (see dtypes.py)
+    # intra_op_threads, inter_op_threads: TensorFlow thread pools for the flowdec session, default the
+    #   applied threads.ThreadPolicy or else TF's own
+    if mode not in MODES:
+        raise ValueError(f'mode must be one of {MODES}: {mode}')
+    if continue_from is not None and mode != 'rfft':
+        raise ValueError(f"Continuing from a saved estimate needs mode='rfft', {mode} always starts from the data")
+    if shard is not None and mode == 'auto':
+        # Array tasks autotune on their own hosts and could pick different engines for one output
+        raise ValueError("Sharded runs need a fixed engine; run mode='auto' once on a sample and pass the chosen mode")
+    if coarse_factor is not None and mode not in ('rfft', 'auto'):
+        raise ValueError(f"Coarse-to-fine starts need mode='rfft', {mode} always starts from the data")
+    if save_estimate and mode == 'preview':
+        raise ValueError('The preview Wiener filter is not iterative, it has no estimate to save')
+    if telemetry is None:
+        telemetry = Telemetry.from_env()
+    if profile is None:
+        profile = profile_from_env()
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # FATAL
     logging.getLogger('tensorflow').setLevel(logging.FATAL)
     print(dat.shape)
-    data = np.copy(dat) 
-    res = np.zeros(data.shape)
+    # Timepoints are copied one at a time by the read stage, so dat itself is never modified.
+    # Bring it to TZCYX; ImageJ files come back with singleton axes squeezed out
+    data = dat
+    if data.ndim == 3:
+        data = data[None, :, None]
+    elif data.ndim == 4:
+        data = data[:, :, None] if channels == 1 else data[None]
+
+    if deskew_angle is not None:
+        deskewed_z_spacing, shift = deskew_geometry(z_spacing, pixel_size(x_res), deskew_angle)
+
+    def make_kernel(psf):
+        if len(psf.shape) != 2:
+            # Measured PSFs are used as given, so they must be in the same frame as the data
+            return psf
+        if deskew_angle is not None:
+            return get_skewed_kernel(psf, deskewed_z_spacing, shift)
+        return get_kernel(psf, z_spacing)
+
+    kernels = [make_kernel(psf) for psf in psfs[:channels]]
+
+    timepoint_ids = list(range(data.shape[0])) if timepoints is None else list(timepoints)
+    all_timepoint_ids = timepoint_ids
+    if shard is not None:
+        timepoint_ids = [all_timepoint_ids[k] for k in shard_range(len(all_timepoint_ids), *shard)]
+        if not timepoint_ids:
+            print(f'Shard {shard[0]}/{shard[1]} of {input_file_str} has no timepoints')
+            return None
+        # Parts are written as they go, so a requeued task picks up where it stopped
+        resume = True
+    channel_ids = list(range(channels)) if channel_subset is None else list(channel_subset)
+    volume_shape = data.shape[1:2] + data.shape[3:]
+    if roi is None:
+        roi = tuple(slice(None) for _ in range(3))
+    halo = kernel_halo([kernels[c].shape for c in channel_ids])
+    block, crop = padded_roi(roi, halo, volume_shape)
+    out_shape = roi_shape(roi, volume_shape)
+    if out_shape != volume_shape:
+        print(f'Deconvolving a {roi_shape(block, volume_shape)} block around the {out_shape} ROI')
+    res_shape = (len(timepoint_ids), out_shape[0], len(channel_ids)) + out_shape[1:]
+    estimate_shape = (len(timepoint_ids), len(channel_ids)) + roi_shape(block, volume_shape)
+    params = {'input': input_file_str, 'shape': res_shape, 'niter': niter, 'pad_amount': pad_amount,
+              'channels': channels, 'z_spacing': z_spacing, 'deskew_angle': deskew_angle, 'roi': roi_to_list(roi),
+              'timepoints': timepoint_ids, 'channel_subset': channel_ids, 'mode': mode}
+
+    previous = None
+    total_niter = niter
+    if continue_from is not None:
+        # Sharded runs keep an estimate per part
+        previous = SavedEstimate.load(continue_from if shard is None else shard_file_str(continue_from, *shard))
+        previous.check(estimate_shape, params)
+        total_niter = previous.niter + niter
+        params.update(niter=total_niter, continue_from=continue_from)
+        print(f'Continuing from {previous.niter} iterations of {continue_from}, {niter} more')
+
+    if mode == 'auto':
+        first = fill_zeros(np.array(data[timepoint_ids[0], block[0], channel_ids[0], block[1], block[2]]))
+        choice = autotune(first, kernels[channel_ids[0]], niter, pad_amount, regularization=regularization, cutoff=cutoff,
+                          coarse_factor=coarse_factor, coarse_iterations=coarse_iterations)
+        mode, backend, pad_amount = choice['mode'], choice['backend'], choice['pad_amount']
 
-    
+    if deskew_angle is not None:
+        # res_shape is TZCYX; the shear grows x by the shift over all z slices
+        res_shape = res_shape[:-1] + deskewed_shape(out_shape, shift)[-1:]
+        mdata['spacing'] = deskewed_z_spacing/10
 
-    if len(data.shape) == 3:
-        res = np.expand_dims(res, 0)
-        data = np.expand_dims(data, 0)
+    plan = plan_run(roi_shape(block, volume_shape), len(timepoint_ids), len(channel_ids), dat.dtype, pad_amount, mode,
+                    halo, resume, not isinstance(dat, np.memmap), res_shape[1:2] + res_shape[3:], work_dtype(precise),
+                    memory_budget=memory_budget, tile_shape=tile_shape,
+                    pipeline_depth=None if memory_budget is not None else pipeline_depth,
+                    auto_tile=memory_budget is not None and tile_shape is None, backend=backend)
+    print(format_plan(plan))
+    if memory_budget is not None:
+        if not plan['fits']:
+            raise MemoryError(f'{input_file_str} does not fit in {memory_budget} MB even in tiles of {plan["tile_shape"]}')
+        tile_shape, pipeline_depth = plan['tile_shape'], plan['pipeline_depth']
+    telemetry.record('plan', file=input_file_str, tile_shape=tile_shape, pipeline_depth=pipeline_depth,
+                     **{f'{k}_mb': round(v, 1) for k, v in plan['estimate'].items()})
 
-    if len(psfs[0].shape) == 2:
-        kernel488 = get_kernel(psfs[0], z_spacing)
+    if output_file_str is None:
+        output_file_str = default_output_file_str(input_file_str, total_niter, pad_amount, channels, mode)
+        if len(all_timepoint_ids) != data.shape[0] or len(channel_ids) != channels or out_shape != volume_shape:
+            # Keep subsets from overwriting the full result
+            output_file_str = output_file_str.replace('.tif', '_subset.tif')
+        if output_dir is not None:
+            os.makedirs(output_dir, exist_ok=True)
+            output_file_str = os.path.join(output_dir, os.path.basename(output_file_str))
+    mdata['channels'] = len(channel_ids)
+    if shard is not None:
+        output_file_str = shard_file_str(output_file_str, *shard)
+
+    # Autotuning may have changed the engine and padding, deskewing the output shape
+    params.update(shape=res_shape, pad_amount=pad_amount, mode=mode, regularization=regularization, cutoff=cutoff,
+                  backend=backend, coarse_factor=coarse_factor, coarse_iterations=coarse_iterations,
+                  kernels=[hashlib.sha1(np.ascontiguousarray(kernels[c]).tobytes()).hexdigest()[:16] for c in channel_ids])
+    if resume:
+        if write_options and write_options.get('compression') not in (None, 'none'):
+            print('Resumable outputs are written uncompressed, ignoring compression')
+        if shard is not None:
+            params.update(shard=list(shard), all_timepoints=all_timepoint_ids)
+        checkpoint = TimepointCheckpoint(output_file_str, res_shape, mdata, (x_res, y_res), params)
+        if checkpoint.first_missing() is not None:
+            print(f'Starting from timepoint {checkpoint.first_missing()}')
     else:
-        kernel488 = psfs[0]
-
-    
-    if channels == 1:
-        
-        
-        if len(data.shape) == 5:
-            res = res[:, :, 0]
-        res = np.expand_dims(res, 2)
-        data = np.expand_dims(data, 2)
-        
-    
-    if channels == 2:
-        if len(psfs[1].shape) == 2:
-            kernel640 = get_kernel(psfs[1], z_spacing)
-        else:
-            kernel640 = psfs[1]
-        
-    
+        checkpoint = None
+        res = np.zeros(res_shape, dtype=work_dtype(precise))
+    estimate = SavedEstimate(output_file_str, estimate_shape, total_niter, params) if save_estimate else None
+
     ndim = 3 #data.ndim 
-    algo = fd_restoration.RichardsonLucyDeconvolver(ndim, pad_mode='none', pad_min=[pad_amount,pad_amount,pad_amount]).initialize() 
-    
-    for i,image in tqdm(enumerate(data), total=data.shape[0], desc='Deconvolving: '):
-        res[i, :, 0] = run_3d_decon(image[:,0], kernel488, niter, algo)  
-        if channels ==2:
-            res[i, :, 1] = run_3d_decon(image[:,0], kernel640, niter, algo)
-    
-    suffix = f"flowdecRL_iter{niter}_padding{pad_amount}_channels{channels}.tif"
-    output_file_str = input_file_str.replace(".tif", suffix)
-    mdata['channels'] = channels
-
-    tifffile.imwrite(output_file_str, res.astype(np.uint16), imagej = True, metadata=mdata, resolution=(x_res, y_res))
-    print('All finished\n')
\ No newline at end of file
+    # Warm instances are shared by every file and iteration count in the process (see deconvolvers.py)
+    algo = get_deconvolver(mode, ndim, pad_amount, regularization, cutoff, backend, coarse_factor, coarse_iterations)
+    if intra_op_threads is None and inter_op_threads is None and current_policy() is not None:
+        config = current_policy().session_config()
+    else:
+        config = session_config(intra_op_threads, inter_op_threads)
+
+    # Items index the output; timepoint_ids/channel_ids map them back to the input
+    total = len(timepoint_ids) * len(channel_ids)
+    todo = [(i, c) for i in range(len(timepoint_ids)) for c in range(len(channel_ids))
+            if checkpoint is None or not checkpoint.is_done(i, c)]
+    done = total - len(todo)
+    progress_bar = tqdm(total=total, initial=done, desc='Deconvolving: ')
+
+    def read(item):
+        i, c = item
+        with telemetry.timer('io'):
+            timepoint = np.array(data[timepoint_ids[i], block[0], channel_ids[c], block[1], block[2]])
+        slabs = None
+        if autocrop:
+            with telemetry.timer('elementwise'):
+                slabs = nonzero_slabs(timepoint, halo)
+        if slabs != []:
+            fill_zeros(timepoint, telemetry)
+        initial = None
+        if previous is not None:
+            with telemetry.timer('io'):
+                initial = previous.read(i, c)
+        telemetry.record('read', file=input_file_str, timepoint=timepoint_ids[i], channel=channel_ids[c],
+                         slabs=None if slabs is None else len(slabs),
+                         fraction=1.0 if slabs is None else sum(timepoint[block].size for _, block, _ in slabs) / timepoint.size)
+        return timepoint, slabs, initial
+
+    def deconvolve_block(timepoint, kernel, initial):
+        if tile_shape is None:
+            return deconvolve(timepoint, kernel, niter, algo, telemetry, config, initial)
+        volume = np.empty(timepoint.shape, dtype=FLOAT)
+        for tile, tile_block, tile_crop in iter_tiles(timepoint.shape, tile_shape, halo):
+            tile_initial = None if initial is None else initial[tile_block]
+            volume[tile] = deconvolve(timepoint[tile_block], kernel, niter, algo, telemetry, config, tile_initial)[tile_crop]
+        return volume
+
+    def compute(item, entry):
+        i, c = item
+        timepoint, slabs, initial = entry
+        if cancel_event is not None and cancel_event.is_set():
+            raise DeconvolutionCancelled(f'{input_file_str} cancelled after {progress_bar.n} of {total} volumes')
+        start = time.perf_counter()
+        kernel = kernels[channel_ids[c]]
+        if slabs is None:
+            volume = deconvolve_block(timepoint, kernel, initial)
+            saved = volume
+        else:
+            # Zeros outside the data, each slab's core from its own block
+            volume = np.zeros(timepoint.shape, dtype=FLOAT)
+            # The estimate to save must not be zero next to the data, or RL restarted from it
+            # blows up there: around the cores it holds each slab's own estimate of its halo,
+            # and the (noise-filled) data where no slab reached, which is where a new run starts
+            saved = np.array(timepoint, dtype=FLOAT) if estimate is not None else None
+            for core, slab_block, slab_crop in slabs:
+                slab_initial = None if initial is None else initial[slab_block]
+                result = deconvolve_block(timepoint[slab_block], kernel, slab_initial)
+                volume[core] = result[slab_crop]
+                if saved is not None:
+                    saved[slab_block] = result
+            if saved is not None:
+                for core, _, _ in slabs:
+                    saved[core] = volume[core]
+        telemetry.record('timepoint', file=input_file_str, timepoint=timepoint_ids[i], channel=channel_ids[c], niter=niter,
+                         wall_s=time.perf_counter() - start)
+        return volume, saved
+
+    def write(item, entry):
+        i, c = item
+        volume, saved = entry
+        if estimate is not None:
+            with telemetry.timer('io'):
+                estimate.write(i, c, saved)
+        volume = volume[crop]
+        if deskew_angle is not None:
+            with telemetry.timer('deskew'):
+                volume = deskew(volume, shift)
+        if checkpoint is None:
+            res[i, :, c] = volume
+        else:
+            with telemetry.timer('io'):
+                checkpoint.write(i, c, volume)
+        telemetry.record('store', file=input_file_str, timepoint=timepoint_ids[i], channel=channel_ids[c])
+        progress_bar.update(1)
+        if progress is not None:
+            progress(progress_bar.n, total)
+
+    try:
+        with profiled(*profile):
+            run_pipelined(todo, read, compute, write, pipeline_depth)
+    except DeconvolutionCancelled:
+        if checkpoint is not None:
+            checkpoint.close()
+        raise
+    finally:
+        progress_bar.close()
+        if estimate is not None:
+            estimate.close()
+        if previous is not None:
+            previous.close()
+
+    start = time.perf_counter()
+    with telemetry.timer('io'):
+        if checkpoint is None:
+            write_output(output_file_str, res, mdata, (x_res, y_res), **(write_options or {}))
+        else:
+            checkpoint.close()
+    telemetry.record('write', file=output_file_str, wall_s=time.perf_counter() - start)
+    print('All finished\n')
+    return output_file_str
\ No newline at end of file
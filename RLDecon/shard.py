@@ -0,0 +1,181 @@
+import argparse
+import glob
+import json
+import os
+import re
+
+import numpy as np
+import tifffile
+
+# ImageJ metadata tifffile derives from the array shape when writing
+_DERIVED_KEYS = {'ImageJ', 'images', 'channels', 'slices', 'frames', 'hyperstack', 'mode'}
+
+# Run parameters that legitimately differ between the parts of one sharded run
+_PER_SHARD_PARAMS = {'shard', 'timepoints', 'shape'}
+
+
+def parse_shard(text):
+    """Parse an 'i/N' shard spec (0 <= i < N, e.g. '$SLURM_ARRAY_TASK_ID/64') into (i, N)."""
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', text)
+    if match is None:
+        raise ValueError(f'Shard must look like i/N: {text}')
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f'Shard index must be in 0..N-1: {text}')
+    return index, count
+
+
+def shard_range(n, index, count):
+    """Contiguous share of range(n) for shard `index` of `count`; shard sizes differ by at most one."""
+    return range(n * index // count, n * (index + 1) // count)
+
+
+def shard_file_str(output_file_str, index, count):
+    """Partial output written by one shard, e.g. out.tif -> out_shard003of064.tif."""
+    width = len(str(count - 1))
+    return output_file_str.replace('.tif', f'_shard{index:0{width}d}of{count}.tif')
+
+
+def find_shards(output_file_str):
+    """Partial outputs of `output_file_str` on disk, in shard order."""
+    pattern = glob.escape(output_file_str.replace('.tif', '')) + '_shard*of*.tif'
+    return sorted(glob.glob(pattern), key=lambda f: int(re.search(r'_shard(\d+)of\d+\.tif$', f).group(1)))
+
+
+def read_manifest(part_file_str):
+    with open(part_file_str + '.manifest.json') as f:
+        return json.load(f)
+
+
+def merge_shards(output_file_str, part_files = None, remove_parts = False):
+    """
+    Assemble the partial outputs of a sharded run into one TZCYX ImageJ hyperstack.
+
+    Every part must be complete (all its timepoint/channel volumes in its manifest), made with
+    the same settings (engine, iterations, padding, kernels, ...; everything in the manifest
+    params but the shard and its timepoints) and the parts together must cover every timepoint
+    of the run. Pages are streamed from the memory-mapped
+    parts straight into the output, so the merge needs no more memory than one plane, and is
+    written under a temporary name and renamed when complete.
+    """
+    part_files = list(part_files or find_shards(output_file_str))
+    if not part_files:
+        raise FileNotFoundError(f'No shards of {output_file_str} found')
+
+    parts = []
+    for part_file_str in part_files:
+        manifest = read_manifest(part_file_str)
+        shape = tuple(manifest['shape'])
+        if len(manifest['completed']) != shape[0] * shape[2]:
+            raise ValueError(f'{part_file_str} is incomplete: {len(manifest["completed"])} of {shape[0] * shape[2]} volumes')
+        parts.append((manifest['params']['shard'][0], part_file_str, shape, manifest['params']))
+    parts.sort()
+
+    params = parts[0][3]
+    expected = params['all_timepoints']
+    if [p[3]['shard'][1] for p in parts].count(params['shard'][1]) != len(parts):
+        raise ValueError('Shards come from runs with different shard counts')
+    settings = {k: v for k, v in params.items() if k not in _PER_SHARD_PARAMS}
+    for _, part_file_str, _, part_params in parts[1:]:
+        differing = sorted(k for k in set(settings) | set(part_params)
+                           if k not in _PER_SHARD_PARAMS and part_params.get(k) != settings.get(k))
+        if differing:
+            raise ValueError(f'{part_file_str} was made with different settings than {parts[0][1]}: '
+                             + ', '.join(f'{k}={part_params.get(k)!r} vs {settings.get(k)!r}' for k in differing))
+    timepoints = [t for _, _, _, p in parts for t in p['timepoints']]
+    if timepoints != expected:
+        missing = sorted(set(expected) - set(timepoints))
+        raise ValueError(f'Shards do not cover every timepoint, missing {missing[:10]}{"..." if len(missing) > 10 else ""}')
+    if len({shape[1:] for _, _, shape, _ in parts}) != 1:
+        raise ValueError('Shards have different volume shapes')
+
+    shape = (sum(shape[0] for _, _, shape, _ in parts),) + parts[0][2][1:]
+    with tifffile.TiffFile(parts[0][1]) as tif:
+        mdata = {k: v for k, v in (tif.imagej_metadata or {}).items() if k not in _DERIVED_KEYS}
+        tags = tif.pages[0].tags
+        resolution = (tags['XResolution'].value, tags['YResolution'].value)
+
+    def pages():
+        # ImageJ stores TZCYX planes in T, Z, C order
+        for _, part_file_str, part_shape, _ in parts:
+            part = tifffile.memmap(part_file_str, mode='r').reshape(part_shape)
+            for t in range(part_shape[0]):
+                for z in range(part_shape[1]):
+                    for c in range(part_shape[2]):
+                        yield part[t, z, c]
+            del part
+
+    tmp_file_str = output_file_str + '.tmp'
+    tifffile.imwrite(tmp_file_str, pages(), shape=shape, dtype=np.uint16, imagej=True, metadata=mdata,
+                     resolution=resolution)
+    os.replace(tmp_file_str, output_file_str)
+    print(f'Merged {len(parts)} shards into {output_file_str} {shape}')
+    if remove_parts:
+        for _, part_file_str, _, _ in parts:
+            os.remove(part_file_str)
+            os.remove(part_file_str + '.manifest.json')
+    return output_file_str
+
+
+def run_shard(input_files, psf_files, index, count, over = 'timepoints', channels = 1, niter = 10, pad_amount = 16,
+              mode = 'rl', z_spacing = None, output_dir = None):
+    """
+    Deconvolve shard `index` of `count` of a batch, for one task of a cluster array job.
+
+    over='files' gives each shard a contiguous share of the files, deconvolved whole; over=
+    'timepoints' gives it a share of the timepoints of every file, written to a resumable
+    partial output (see shard_file_str) for merge_shards. A requeued task continues where it
+    stopped.
+    """
+    from .run_decon import run_5d_decon
+    from .utils import make_mdata, read_image, read_psf
+
+    psfs = [read_psf(psf_file) for psf_file in psf_files[:channels]]
+    files = list(input_files)
+    if over == 'files':
+        files = [files[k] for k in shard_range(len(files), index, count)]
+    outputs = []
+    for input_file_str in files:
+        dat, mdata, x_res, y_res = read_image(input_file_str, lazy=True)
+        file_z_spacing = z_spacing or (mdata or {}).get('spacing', 0.2705078)*10
+        if mdata is None:
+            mdata = make_mdata(dat.shape, channels, file_z_spacing/10)
+        outputs.append(run_5d_decon(input_file_str, dat, mdata, psfs, x_res, y_res, file_z_spacing, niter, pad_amount,
+                                    channels, output_dir=output_dir, mode=mode,
+                                    shard=(index, count) if over == 'timepoints' else None,
+                                    resume=over == 'files'))
+    return outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Deconvolve one shard of a batch (e.g. a cluster array task), or merge shards',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    run.add_argument('--input', type=str, nargs='+', required=True)
+    run.add_argument('--psf', type=str, nargs='+', required=True, help='one .csv or .tif PSF per channel')
+    run.add_argument('--shard', type=str, required=True, help='i/N, this task is shard i (0-based) of N')
+    run.add_argument('--over', type=str, default='timepoints', choices=['timepoints', 'files'])
+    run.add_argument('--channels', type=int, default=1)
+    run.add_argument('--niter', type=int, default=10)
+    run.add_argument('--pad_amount', type=int, default=16)
+    run.add_argument('--mode', type=str, default='rl', choices=['rl', 'preview', 'rfft'],
+                     help='a fixed engine, so every shard runs the same one')
+    run.add_argument('--z_spacing', type=float, required=False, help='defaults to 10x the spacing in the file metadata')
+    run.add_argument('--output_dir', type=str, required=False, help='defaults to next to each input')
+    merge = commands.add_parser('merge', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    merge.add_argument('--output', type=str, required=True, help='final file; its _shard*of*.tif parts are merged')
+    merge.add_argument('--parts', type=str, nargs='+', required=False, help='merge these parts instead')
+    merge.add_argument('--remove_parts', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        index, count = parse_shard(args.shard)
+        run_shard(args.input, args.psf, index, count, args.over, args.channels, args.niter, args.pad_amount,
+                  args.mode, args.z_spacing, args.output_dir)
+    else:
+        merge_shards(args.output, args.parts, args.remove_parts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+import argparse
+import csv
+import itertools
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from .deconvolvers import clear_pool
+from .planner import plan_run, split_volumes
+from .utils import make_mdata, read_image, read_psf
+from .run_decon import MODES, get_kernel, run_5d_decon
+from .roi import parse_indices, parse_roi
+from .threads import add_thread_arguments, current_policy, policy_from_args
+from .writer import add_write_arguments, write_options_from_args
+
+
+def psf_label(index, psf_files):
+    """Short name for a PSF set used in output file names, e.g. 'psf0-average' or 'psf1-488PSF_sigma+640PSF_sigma'."""
+    # The index keeps labels unique when daily PSFs share a file name in different folders
+    return f'psf{index}-' + '+'.join(os.path.basename(f).split('.')[0] for f in psf_files)
+
+
+class SweepKernels:
+    """
+    Load each PSF file once and build each fitted kernel once per z spacing.
+
+    The same kernel objects are handed to every run, so the deconvolvers' OTF caches (keyed by
+    kernel, see kernels.KernelCache) are hit across configurations.
+    """
+    def __init__(self):
+        self._psfs = {}
+        self._kernels = {}
+
+    def psf(self, psf_file):
+        if psf_file not in self._psfs:
+            self._psfs[psf_file] = read_psf(psf_file)
+        return self._psfs[psf_file]
+
+    def kernels(self, psf_files, z_spacing):
+        kernels = []
+        for psf_file in psf_files:
+            psf = self.psf(psf_file)
+            if len(psf.shape) == 2:
+                key = (psf_file, z_spacing)
+                if key not in self._kernels:
+                    self._kernels[key] = get_kernel(psf, z_spacing)
+                kernels.append(self._kernels[key])
+            else:
+                kernels.append(psf)
+        return kernels
+
+
+def expand_grid(psf_sets, niters, pad_amounts):
+    """Every combination of PSF set, iteration count and padding as a list of config dicts."""
+    return [{'psf_label': psf_label(index, psf_files), 'psf_files': list(psf_files), 'niter': niter, 'pad_amount': pad_amount}
+            for (index, psf_files), niter, pad_amount in itertools.product(enumerate(psf_sets), niters, pad_amounts)]
+
+
+def run_sweep(input_files, psf_sets, niters, pad_amounts, channels=1, z_spacing=None, output_dir=None,
+              workers=1, table_file_str=None, write_options=None, roi=None, timepoints=None, memory_budget=None,
+              mode='rl'):
+    """
+    Deconvolve every input file with every combination of PSF set, iteration count and padding.
+
+    Each input is read once and shared by all of its configurations, each PSF is loaded and
+    turned into a kernel once, and the configurations for an input run on `workers` threads.
+    Outputs are labelled with the PSF, iteration count and padding; one row per run (including
+    failures) is written to the results table, which defaults to sweep_results.csv in output_dir.
+
+    Parameters:
+    - input_files: list of str, images to deconvolve.
+    - psf_sets: list of lists of str, one PSF file (.csv or .tif) per channel in each set.
+    - niters, pad_amounts: lists of int.
+    - z_spacing: float or None, defaults to 10x the spacing in each file's metadata.
+    - write_options: dict or None, writer.write_output options such as compression.
+    - roi, timepoints: passed to run_5d_decon to sweep on a small block and a few timepoints only.
+    - memory_budget: host MB for the whole sweep; workers are capped at the number of runs that
+      fit (see planner.plan_run) and each run plans its tiles within its share.
+    - mode: run_5d_decon engine for every run; outputs of engines other than 'rl' are labelled
+      with it.
+
+    Returns:
+    - list of dict: the rows of the results table.
+    """
+    configs = expand_grid(psf_sets, niters, pad_amounts)
+    kernel_cache = SweepKernels()
+    rows = []
+
+    # The next input is read while the current one is deconvolved
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        pending = reader.submit(read_image, input_files[0]) if input_files else None
+        for k, input_file_str in enumerate(input_files):
+            out_dir = output_dir or os.path.dirname(os.path.abspath(input_file_str))
+            os.makedirs(out_dir, exist_ok=True)
+            dat, mdata, x_res, y_res = pending.result()
+            if k + 1 < len(input_files):
+                pending = reader.submit(read_image, input_files[k + 1])
+            spacing = 0.2705078 if mdata is None else mdata['spacing']
+            file_z_spacing = z_spacing or spacing*10
+            if mdata is None:
+                mdata = make_mdata(dat.shape, channels, file_z_spacing/10)
+            name = os.path.basename(input_file_str).replace('.tif', '')
+
+            def run_config(config, run_budget):
+                label = config['psf_label']
+                engine = '' if mode == 'rl' else f'_{mode}'
+                output_file_str = os.path.join(
+                    out_dir, f"{name}_sweep_{label}{engine}_iter{config['niter']}_padding{config['pad_amount']}.tif")
+                row = {'input': input_file_str, 'psf': label, 'psf_files': ','.join(config['psf_files']), 'niter': config['niter'],
+                       'pad_amount': config['pad_amount'], 'mode': mode, 'output': output_file_str}
+                start = time.perf_counter()
+                try:
+                    kernels = kernel_cache.kernels(config['psf_files'][:channels], file_z_spacing)
+                    run_5d_decon(input_file_str, dat, dict(mdata), kernels, x_res, y_res, file_z_spacing,
+                                 config['niter'], config['pad_amount'], channels, output_file_str=output_file_str,
+                                 write_options=write_options, roi=roi, timepoints=timepoints, memory_budget=run_budget,
+                                 mode=mode)
+                    row['status'] = 'done'
+                except Exception as e:
+                    traceback.print_exc()
+                    row['status'] = f'failed: {e}'
+                row['seconds'] = round(time.perf_counter() - start, 3)
+                return row
+
+            # Kernels are built up front so worker threads only ever read the cache
+            for psf_files in psf_sets:
+                kernel_cache.kernels(psf_files[:channels], file_z_spacing)
+
+            file_workers, run_budget = workers, None
+            if memory_budget is not None:
+                # Plan for the largest padding; the input itself is shared by all runs
+                n_timepoints, volume_shape = split_volumes(dat.shape, channels)
+                # 'auto' may pick flowdec, the hungriest engine
+                plan = plan_run(volume_shape, len(timepoints) if timepoints else n_timepoints, channels, dat.dtype,
+                                max(pad_amounts), 'rl' if mode == 'auto' else mode, memory_budget=memory_budget,
+                                workers=workers)
+                file_workers = plan['workers']
+                run_budget = memory_budget / file_workers
+                if file_workers < workers:
+                    print(f'Running {file_workers} of {workers} workers to stay within {memory_budget} MB')
+
+            def run_budgeted(config):
+                return run_config(config, run_budget)
+
+            policy = current_policy()
+            with ThreadPoolExecutor(max_workers=file_workers, initializer=policy.pin if policy else None) as executor:
+                rows.extend(executor.map(run_budgeted, configs))
+    # The sweep's kernels and the OTFs built for them are not needed by anything after it
+    clear_pool()
+
+    if table_file_str is None:
+        table_file_str = os.path.join(output_dir or '.', 'sweep_results.csv')
+    with open(table_file_str, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['input', 'psf', 'psf_files', 'niter', 'pad_amount', 'mode', 'status', 'seconds', 'output'])
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f'Results written to {table_file_str}')
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Deconvolve files over a grid of parameters',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--input', type=str, nargs='+', required=True)
+    parser.add_argument('--psf', type=str, action='append', required=True,
+                        help='PSF set to try, comma separated per channel; repeat for each set')
+    parser.add_argument('--niter', type=int, nargs='+', default=[10])
+    parser.add_argument('--pad_amount', type=int, nargs='+', default=[16])
+    parser.add_argument('--mode', type=str, default='rl', choices=MODES,
+                        help='engine for every run; rfft shares OTFs between runs, preview is a one-shot Wiener filter')
+    parser.add_argument('--channels', type=int, default=1, choices=[1, 2])
+    parser.add_argument('--z_spacing', type=float, required=False, help='defaults to 10x the spacing in the file metadata')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--output_dir', type=str, required=False, help='defaults to next to each input')
+    parser.add_argument('--table', type=str, required=False, help='defaults to sweep_results.csv in the output folder')
+    parser.add_argument('--roi', type=str, required=False, help='z0:z1,y0:y1,x0:x1 block to deconvolve, e.g. ":,200:456,200:456"')
+    parser.add_argument('--timepoints', type=str, required=False, help='timepoints to deconvolve, e.g. "0,10:12"')
+    parser.add_argument('--memory_budget', type=float, required=False,
+                        help='host memory in MB for the whole sweep; caps workers and tiles volumes to fit')
+    add_thread_arguments(parser)
+    add_write_arguments(parser)
+    args = parser.parse_args()
+    print(policy_from_args(args, args.workers))
+
+    psf_sets = [psf.split(',') for psf in args.psf]
+    if any(len(psf_files) < args.channels for psf_files in psf_sets):
+        parser.error('Every --psf set needs one file per channel')
+
+    run_sweep(args.input, psf_sets, args.niter, args.pad_amount, channels=args.channels, z_spacing=args.z_spacing,
+              output_dir=args.output_dir, workers=args.workers, table_file_str=args.table,
+              write_options=write_options_from_args(args), roi=parse_roi(args.roi) if args.roi else None,
+              timepoints=parse_indices(args.timepoints) if args.timepoints else None, memory_budget=args.memory_budget,
+              mode=args.mode)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+
+def peak_memory_mb():
+    """Return the memory high-water mark of this process in MB, or None if it cannot be read."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is reported in bytes on macOS and in kilobytes on Linux
+        return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        # peak_wset only exists on Windows
+        return getattr(info, 'peak_wset', info.rss) / 1e6
+    except ImportError:
+        return None
+
+
+def _to_builtin(value):
+    # numpy/cupy scalars and 0-d arrays
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+class Telemetry:
+    """
+    Collect per-iteration and per-timepoint timings and write them as JSON lines.
+
+    Wrap the parts of a loop in `timer(category)` (e.g. 'fft', 'elementwise', 'rng', 'io');
+    each call to `record` writes one line holding the time spent in every category since the
+    previous record on the same thread, plus the memory high-water mark. A Telemetry without a
+    path is disabled and its timers cost nothing, so it can be passed around unconditionally.
+
+    Parameters:
+    - path: str or None, the JSON-lines file to append to.
+    - sync: callable or None, called before a timer stops (e.g. to synchronise a GPU stream so
+      asynchronous kernels are charged to the right category).
+    """
+    def __init__(self, path=None, sync=None):
+        self.path = path
+        self.sync = sync
+        self.enabled = path is not None
+        self._file = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @classmethod
+    def from_env(cls, sync=None):
+        """Enable telemetry when RLDECON_TELEMETRY names an output file."""
+        return cls(os.environ.get('RLDECON_TELEMETRY'), sync=sync)
+
+    def _times(self):
+        if not hasattr(self._local, 'times'):
+            self._local.times = defaultdict(float)
+        return self._local.times
+
+    @contextmanager
+    def timer(self, category):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.sync is not None:
+                self.sync()
+            self._times()[category] += time.perf_counter() - start
+
+    def record(self, event, **fields):
+        if not self.enabled:
+            return
+        times = self._times()
+        line = {'event': event, 'time': time.time()}
+        line.update(fields)
+        line['timings'] = {category: round(seconds, 6) for category, seconds in times.items()}
+        line['peak_memory_mb'] = peak_memory_mb()
+        times.clear()
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(json.dumps(line, default=_to_builtin) + '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class StackSampler:
+    """
+    Sampling profiler: periodically records the stacks of every thread (or only `thread_id`) as
+    collapsed stacks, each rooted at its thread's name so pipeline stages show up separately.
+    """
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rldecon-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self._thread.ident or (self.thread_id is not None and ident != self.thread_id):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s:%s:%d' % (os.path.basename(code.co_filename), code.co_name, frame.f_lineno))
+                    frame = frame.f_back
+                if stack:
+                    stack.append(names.get(ident, 'thread-%d' % ident))
+                    self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def dump(self, output):
+        # One "stack count" line per unique stack, readable by flamegraph.pl and speedscope
+        with open(output, 'w') as f:
+            for stack, count in self.samples.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+
+def profile_from_env():
+    """Read RLDECON_PROFILE as 'mode' or 'mode:output', e.g. 'cprofile:run.prof' or 'sample'."""
+    value = os.environ.get('RLDECON_PROFILE')
+    if not value:
+        return None, None
+    mode, _, output = value.partition(':')
+    return mode, output or None
+
+
+@contextmanager
+def profiled(mode=None, output=None, interval=0.005):
+    """
+    Profile the enclosed block when `mode` is given.
+
+    'cprofile' writes cProfile stats (open with pstats or snakeviz) for the calling thread only,
+    so the read and write stages of run_5d_decon's pipeline are not in them; 'sample' writes
+    collapsed stacks of every thread from a StackSampler, which also has far lower overhead on
+    long runs.
+    """
+    if mode is None:
+        yield
+        return
+    if mode == 'cprofile':
+        output = output or 'rldecon.prof'
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output)
+            print('Profile written to %s' % output)
+    elif mode == 'sample':
+        output = output or 'rldecon_stacks.txt'
+        sampler = StackSampler(interval)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            sampler.dump(output)
+            print('Profile written to %s' % output)
+    else:
+        raise ValueError("Unknown profile mode %r, expected 'cprofile' or 'sample'" % mode)
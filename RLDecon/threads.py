@@ -0,0 +1,118 @@
+import itertools
+import os
+import sys
+import threading
+
+# Read by OpenMP, the BLAS builds numpy/scipy ship with, numexpr and TensorFlow when they start up
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                   'NUMEXPR_NUM_THREADS', 'TF_NUM_INTRAOP_THREADS']
+
+_policy = None
+
+
+def cpu_count():
+    """Cores this process may run on (respects taskset/cgroup affinity on Linux)."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class ThreadPolicy:
+    """
+    How many threads each library may use so that `workers` parallel runs share the cores.
+
+    Every worker gets `threads` cores (default cores // workers) for TensorFlow's intra-op pool,
+    BLAS, OpenMP and the scipy.fft transforms of the rl.py and Wiener engines (see fft_workers),
+    and TensorFlow runs at most two independent ops at once. With affinity=True
+    each worker thread is pinned to its own block of cores when it starts (see pin).
+    """
+    def __init__(self, workers = 1, threads = None, affinity = False):
+        self.workers = max(1, workers)
+        self.threads = threads or max(1, cpu_count() // self.workers)
+        self.inter_op_threads = min(2, self.threads)
+        self.affinity = affinity
+        self._next_worker = itertools.count()
+        self._cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(cpu_count()))
+
+    @classmethod
+    def from_env(cls):
+        """Policy from RLDECON_WORKERS, RLDECON_THREADS and RLDECON_AFFINITY (1 to pin workers)."""
+        return cls(int(os.environ.get('RLDECON_WORKERS', 1)), int(os.environ.get('RLDECON_THREADS', 0)) or None,
+                   os.environ.get('RLDECON_AFFINITY', '0') not in ('', '0'))
+
+    def __repr__(self):
+        return (f'ThreadPolicy(workers={self.workers}, threads={self.threads}, '
+                f'inter_op_threads={self.inter_op_threads}, affinity={self.affinity})')
+
+    def apply(self):
+        """
+        Make this the process-wide policy.
+
+        The environment variables only take effect for libraries that have not started yet, so
+        call this before numpy and TensorFlow are imported where possible (RLDecon/__init__.py does
+        when RLDECON_THREADS or RLDECON_WORKERS is set). BLAS pools already running are limited
+        through threadpoolctl when it is installed; without it a warning says the limit is not
+        applied to them.
+        """
+        global _policy
+        for var in THREAD_ENV_VARS:
+            os.environ[var] = str(self.threads)
+        os.environ['TF_NUM_INTEROP_THREADS'] = str(self.inter_op_threads)
+        if 'numpy' in sys.modules:
+            try:
+                from threadpoolctl import threadpool_limits
+                threadpool_limits(self.threads)
+            except ImportError:
+                print(f'threadpoolctl is not installed: BLAS/OpenMP pools numpy has already started are not '
+                      f'limited to {self.threads} threads; set RLDECON_THREADS before starting instead')
+        if 'tensorflow' in sys.modules:
+            import tensorflow as tf
+            try:
+                tf.config.threading.set_intra_op_parallelism_threads(self.threads)
+                tf.config.threading.set_inter_op_parallelism_threads(self.inter_op_threads)
+            except RuntimeError:
+                # TensorFlow has already started; flowdec sessions still get session_config()
+                pass
+        _policy = self
+        return self
+
+    def session_config(self):
+        from .deconvolvers import session_config
+        return session_config(self.threads, self.inter_op_threads)
+
+    def pin(self, index = None):
+        """
+        Pin the calling thread to the block of cores of worker `index` (the next free one by default).
+
+        Threads it starts afterwards inherit the mask. Only Linux can pin single threads; elsewhere
+        this is a no-op.
+        """
+        if not self.affinity or not hasattr(os, 'sched_setaffinity'):
+            return None
+        if index is None:
+            index = next(self._next_worker)
+        start = (index % self.workers) * self.threads % len(self._cores)
+        cores = set(self._cores[start:start + self.threads]) or set(self._cores)
+        os.sched_setaffinity(threading.get_native_id(), cores)
+        return cores
+
+
+def current_policy():
+    """The policy applied last in this process, or None."""
+    return _policy
+
+
+def fft_workers():
+    """Threads for each scipy.fft transform: the applied policy's threads, or every core (-1) without one."""
+    return -1 if _policy is None else _policy.threads
+
+
+def add_thread_arguments(parser):
+    parser.add_argument('--threads', type=int, required=False,
+                        help='threads per worker for TensorFlow, BLAS, OpenMP and FFTs, defaults to cores / workers')
+    parser.add_argument('--affinity', action='store_true', help='pin each worker to its own cores (Linux)')
+
+
+def policy_from_args(args, workers = 1):
+    """Apply the policy given by add_thread_arguments options for `workers` parallel runs."""
+    return ThreadPolicy(workers, args.threads, args.affinity).apply()
@@ -1,20 +1,25 @@
-import xml.etree.ElementTree as ET
+import re
+import numpy as np
+import tifffile
+from .psf import prepare_psf_file
+
+
+def ome_pixels_attributes(xml_data):
+    """Attributes of the first OME Pixels element, found without parsing the whole (possibly huge) XML."""
+    match = re.search(r'<(?:\w+:)?Pixels\s([^>]*)>', xml_data)
+    if match is None:
+        raise ValueError('No Pixels element in OME metadata')
+    return dict(re.findall(r'(\w+)="([^"]*)"', match.group(1)))
+
 
 def get_mdata(xml_data):
-    # Parse the XML string
-    root = ET.fromstring(xml_data)
-    
-    # Define the XML namespace to access the elements properly
-    namespace = {'ome': 'http://www.openmicroscopy.org/Schemas/OME/2016-06'}
-    
-    # Find the 'Pixels' element
-    pixels_element = root.find('.//ome:Pixels', namespaces=namespace)
+    pixels = ome_pixels_attributes(xml_data)
     
     # Extracting metadata
-    slices = int(pixels_element.attrib['SizeZ'])
-    frames = int(pixels_element.attrib['SizeT'])
-    spacing = float(pixels_element.attrib['PhysicalSizeZ'])
-    images = int(pixels_element.attrib['SizeX']) * int(pixels_element.attrib['SizeY']) * slices * frames * int(pixels_element.attrib['SizeC'])
+    slices = int(pixels['SizeZ'])
+    frames = int(pixels['SizeT'])
+    spacing = float(pixels['PhysicalSizeZ'])
+    images = int(pixels['SizeX']) * int(pixels['SizeY']) * slices * frames * int(pixels['SizeC'])
     
     # Constructing the metadata dictionary
     mdata = {
@@ -28,3 +33,70 @@ def get_mdata(xml_data):
     }
     
     return mdata
+
+
+def make_mdata(shape, channels, spacing):
+    """Build ImageJ hyperstack metadata for data that was saved without any."""
+    frames = shape[0]
+    slices = shape[1]
+
+    if (len(shape) == 4 and channels > 1) or len(shape) == 3:
+        frames = 1
+        slices = shape[0]
+
+    return {
+        'images': int(slices*frames*channels),
+        'slices': slices,
+        'frames': frames,
+        'hyperstack': True,
+        'unit': 'micron',
+        'spacing': spacing,
+        'loop': False
+    }
+
+
+def read_psf(psf_file_str, prepare=True):
+    """Load a fitted PSF covariance (.csv) or a measured PSF stack (.tif), cleaned up by psf.prepare_psf_file."""
+    if ".csv" in psf_file_str:
+        return np.genfromtxt(psf_file_str, delimiter=',')
+    elif ".tif" in psf_file_str:
+        if prepare:
+            return prepare_psf_file(psf_file_str)
+        with tifffile.TiffFile(psf_file_str) as psf_tif:
+            return psf_tif.asarray()
+    raise ValueError(f"PSF file must be a .csv or .tif file: {psf_file_str}")
+
+
+def read_image(input_file_str, lazy=False):
+    """
+    Load an image the same way the input dialogs do, returning (dat, mdata, x_res, y_res).
+
+    With lazy=True, uncompressed files are memory-mapped instead of read, so run_5d_decon's read
+    stage loads one timepoint at a time; other files are read in full as before.
+    """
+    with tifffile.TiffFile(input_file_str) as tif:
+        if 'ome.tif' in input_file_str:
+            xml_data = tif.ome_metadata
+            mdata = get_mdata(xml_data)
+        else:
+            mdata = tif.imagej_metadata
+
+        if tif.pages is not None:
+            tags = tif.pages[0].tags
+            y_res = tags['YResolution'].value
+            x_res = tags['XResolution'].value
+        else:
+            # is 0.104 microns per pixel
+            y_res = (9615384, 1000000)
+            x_res = (9615384, 1000000)
+
+        dat = None
+        if lazy:
+            try:
+                dat = tifffile.memmap(input_file_str, mode='r')
+            except ValueError:
+                # Compressed or non-contiguous data cannot be mapped
+                pass
+        if dat is None:
+            dat = tif.asarray()
+    return dat, mdata, x_res, y_res
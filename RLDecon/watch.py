@@ -0,0 +1,258 @@
+import argparse
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import tifffile
+
+from .utils import make_mdata, read_image, read_psf
+from .deconvolvers import clear_pool
+from .run_decon import MODES, get_kernel, run_5d_decon
+from .threads import add_thread_arguments, current_policy, policy_from_args
+
+MANIFEST_NAME = 'rldecon_manifest.json'
+
+
+class Manifest:
+    """JSON record of every file the watcher has finished with, keyed by path relative to the watched folder."""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self.entries
+
+    def update(self, key, **entry):
+        with self._lock:
+            self.entries[key] = entry
+            # Write to a temporary file and swap it in so a crash never leaves a truncated manifest
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp_path, self.path)
+
+
+def is_readable_tif(file_str):
+    """Check the TIFF header and page chain can be parsed, i.e. the writer has finished."""
+    try:
+        with tifffile.TiffFile(file_str) as tif:
+            return len(tif.series) > 0 and tif.series[0].shape is not None
+    except Exception:
+        return False
+
+
+class FolderWatcher:
+    """
+    Poll an acquisition folder and deconvolve every new, fully written .tif file.
+
+    A file is considered fully written once its size and modification time have not changed for
+    `settle` seconds and tifffile can parse it. Files are deconvolved on a pool of `workers`
+    threads with the PSFs and parameters given here; finished (or failed) files are recorded in
+    the manifest in the output folder so they are never processed twice, also across restarts.
+    A file that was interrupted part way through continues from its first missing timepoint.
+    A file that stays unchanged for `settle` + `timeout` seconds but still cannot be parsed is
+    recorded as failed (error 'unreadable') and picked up again if it changes; with once=True,
+    files still changing after that long are left for a later run.
+    """
+    def __init__(self, folder, psf_files, channels=1, niter=10, pad_amount=16, z_spacing=None,
+                 output_dir=None, workers=1, settle=30.0, recursive=False, retry_failed=False, mode='rl',
+                 memory_budget=None, autocrop=False, timeout=300.0):
+        self.folder = os.path.abspath(folder)
+        # Previews get their own folder (and manifest) so a preview and a full watcher can run side by side
+        default_dir = 'preview' if mode == 'preview' else 'deconvolved'
+        self.output_dir = os.path.abspath(output_dir or os.path.join(self.folder, default_dir))
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.channels = channels
+        self.niter = niter
+        self.pad_amount = pad_amount
+        self.z_spacing = z_spacing
+        self.settle = settle
+        self.timeout = timeout
+        self.recursive = recursive
+        self.retry_failed = retry_failed
+        self.mode = mode
+        self.autocrop = autocrop
+        # Each worker plans its tiles within an equal share of the budget
+        self.run_budget = None if memory_budget is None else memory_budget / workers
+        self.psfs = [read_psf(psf_file) for psf_file in psf_files[:channels]]
+        self.manifest = Manifest(os.path.join(self.output_dir, MANIFEST_NAME))
+        policy = current_policy()
+        self.executor = ThreadPoolExecutor(max_workers=workers, initializer=policy.pin if policy else None)
+        # path -> ((size, mtime), unchanged since), and when each file was first listed
+        self._seen = {}
+        self._first_seen = {}
+        # Files queued or running; updated by the scan loop and by the workers as they finish
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+        self._kernels = {}
+
+    def candidate_files(self):
+        for dirpath, dirnames, filenames in os.walk(self.folder):
+            # Never pick up our own outputs
+            dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) != self.output_dir]
+            for f in sorted(filenames):
+                if f.endswith('.tif'):
+                    yield os.path.join(dirpath, f)
+            if not self.recursive:
+                break
+
+    def file_state(self, file_str):
+        """
+        'ready' once a file has been unchanged for `settle` seconds and parses, 'unreadable' once
+        it has been unchanged for `settle` + `timeout` seconds and still does not, else 'waiting'.
+        """
+        try:
+            stat = os.stat(file_str)
+        except OSError:
+            # Moved or deleted since the folder was listed
+            return 'waiting'
+        signature = (stat.st_size, stat.st_mtime)
+        now = time.time()
+        self._first_seen.setdefault(file_str, now)
+        last_signature, since = self._seen.get(file_str, (None, now))
+        if signature != last_signature:
+            self._seen[file_str] = (signature, now)
+            return 'waiting'
+        if now - since < self.settle:
+            return 'waiting'
+        if is_readable_tif(file_str):
+            return 'ready'
+        return 'unreadable' if now - since >= self.settle + self.timeout else 'waiting'
+
+    def changed_since(self, file_str, entry):
+        """Whether a file recorded as unreadable has been rewritten since."""
+        try:
+            stat = os.stat(file_str)
+        except OSError:
+            return False
+        return [stat.st_size, stat.st_mtime] != entry.get('signature')
+
+    def get_kernels(self, z_spacing):
+        # Fitted PSFs only depend on the z spacing, so build each kernel once for the whole session
+        if z_spacing not in self._kernels:
+            self._kernels[z_spacing] = [get_kernel(psf, z_spacing) if len(psf.shape) == 2 else psf for psf in self.psfs]
+        return self._kernels[z_spacing]
+
+    def process(self, file_str, key):
+        try:
+            dat, mdata, x_res, y_res = read_image(file_str, lazy=True)
+            spacing = 0.2705078 if mdata is None else mdata['spacing']
+            z_spacing = self.z_spacing or spacing*10
+            if mdata is None:
+                mdata = make_mdata(dat.shape, self.channels, z_spacing/10)
+            # Named by run_5d_decon, after the engine autotuning picked with mode='auto'
+            output_file_str = run_5d_decon(file_str, dat, mdata, self.get_kernels(z_spacing), x_res, y_res,
+                                           z_spacing, self.niter, self.pad_amount, self.channels,
+                                           output_dir=self.output_dir, resume=True, mode=self.mode,
+                                           memory_budget=self.run_budget, autocrop=self.autocrop)
+            self.manifest.update(key, status='done', output=output_file_str, finished=time.time())
+            print(f'Finished {file_str}')
+        except Exception as e:
+            traceback.print_exc()
+            self.manifest.update(key, status='failed', error=str(e), finished=time.time())
+        finally:
+            with self._in_flight_lock:
+                self._in_flight.discard(key)
+
+    def poll(self, once=False):
+        """
+        Queue every new settled file; returns the number of files queued and still settling.
+
+        With once=True, files that have kept changing for `settle` + `timeout` seconds are not
+        counted as settling, so a single pass can finish.
+        """
+        queued = 0
+        waiting = 0
+        for file_str in self.candidate_files():
+            key = os.path.relpath(file_str, self.folder)
+            with self._in_flight_lock:
+                if key in self._in_flight:
+                    continue
+            if key in self.manifest:
+                entry = self.manifest.entries[key]
+                rewritten = entry.get('error') == 'unreadable' and self.changed_since(file_str, entry)
+                if not (rewritten or (self.retry_failed and entry['status'] == 'failed')):
+                    continue
+            state = self.file_state(file_str)
+            if state == 'unreadable':
+                print(f'Giving up on {file_str}: unchanged for {self.settle + self.timeout:.0f} s but cannot be read')
+                self.manifest.update(key, status='failed', error='unreadable', signature=list(self._seen[file_str][0]),
+                                     finished=time.time())
+                continue
+            if state == 'waiting':
+                if once and time.time() - self._first_seen[file_str] >= self.settle + self.timeout:
+                    continue
+                waiting += 1
+                continue
+            with self._in_flight_lock:
+                self._in_flight.add(key)
+            self.executor.submit(self.process, file_str, key)
+            queued += 1
+        return queued, waiting
+
+    def run(self, interval=10.0, once=False):
+        print(f'Watching {self.folder}, writing to {self.output_dir}')
+        try:
+            while True:
+                queued, waiting = self.poll(once)
+                if queued:
+                    print(f'Queued {queued} new file(s)')
+                with self._in_flight_lock:
+                    busy = bool(self._in_flight)
+                if once and not busy and not queued and not waiting:
+                    break
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print('Stopping, waiting for running jobs to finish...')
+        finally:
+            self.executor.shutdown(wait=True)
+            clear_pool()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Deconvolve new acquisitions as they land in a folder',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--folder', type=str, required=True)
+    parser.add_argument('--psf', type=str, nargs='+', required=True, help='one .csv or .tif PSF per channel')
+    parser.add_argument('--output_dir', type=str, required=False, help='defaults to <folder>/deconvolved, or <folder>/preview')
+    parser.add_argument('--channels', type=int, default=1, choices=[1, 2])
+    parser.add_argument('--niter', type=int, default=10)
+    parser.add_argument('--pad_amount', type=int, default=16)
+    parser.add_argument('--mode', type=str, default='rl', choices=MODES, help='preview: one-shot Wiener filter')
+    parser.add_argument('--z_spacing', type=float, required=False, help='defaults to 10x the spacing in the file metadata')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--interval', type=float, default=10.0, help='seconds between folder scans')
+    parser.add_argument('--settle', type=float, default=30.0, help='seconds a file must be unchanged before it is read')
+    parser.add_argument('--timeout', type=float, default=300.0,
+                        help='seconds after settling that a file may stay unreadable before it is recorded as failed')
+    parser.add_argument('--recursive', action='store_true')
+    parser.add_argument('--retry_failed', action='store_true')
+    parser.add_argument('--once', action='store_true', help='process what is there and exit')
+    parser.add_argument('--memory_budget', type=float, required=False,
+                        help='host memory in MB shared by the workers; volumes are tiled to fit')
+    parser.add_argument('--autocrop', action='store_true', help='deconvolve only the nonzero part of each volume, as z slabs with tight (y, x) boxes')
+    add_thread_arguments(parser)
+    args = parser.parse_args()
+    print(policy_from_args(args, args.workers))
+
+    if len(args.psf) < args.channels:
+        parser.error('Need one --psf per channel')
+
+    watcher = FolderWatcher(args.folder, args.psf, channels=args.channels, niter=args.niter,
+                            pad_amount=args.pad_amount, z_spacing=args.z_spacing, output_dir=args.output_dir,
+                            workers=args.workers, settle=args.settle, recursive=args.recursive,
+                            retry_failed=args.retry_failed, mode=args.mode, memory_budget=args.memory_budget,
+                            autocrop=args.autocrop, timeout=args.timeout)
+    watcher.run(interval=args.interval, once=args.once)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import numpy as np
+import scipy.fft
+
+from .dtypes import COMPLEX, as_float
+from .kernels import KernelCache, kernel_to_otf
+from .threads import fft_workers
+
+# Tikhonov weight relative to the OTF's DC term (1 for a normalised kernel); about 1/SNR^2
+DEFAULT_REGULARIZATION = 0.01
+
+
+class WienerDeconvolver:
+    """
+    One-shot Wiener/Tikhonov deconvolution for quick-look previews.
+
+    Estimates x = irfftn(conj(H) Y / (|H|^2 + regularization)), so a volume costs one forward
+    and one inverse real FFT; the filter for each kernel and volume shape is computed once and
+    the last few are cached (see kernels.KernelCache). Volumes are reflect-padded by
+    `pad_amount` on every side against wrap-around.
+
+    Has the same run(acquisition, niter) interface as flowdec's RichardsonLucyDeconvolver, so it
+    can stand in for it in run_5d_decon (niter and session_config are ignored).
+    """
+    def __init__(self, pad_amount=16, regularization=DEFAULT_REGULARIZATION):
+        self.pad_amount = pad_amount
+        self.regularization = regularization
+        self._filters = KernelCache()
+
+    def initialize(self):
+        return self
+
+    def get_filter(self, kernel, shape):
+        def make():
+            otf = kernel_to_otf(kernel / kernel.sum(), shape)
+            wiener = np.conj(otf) / (np.abs(otf)**2 + np.float32(self.regularization))
+            return wiener.astype(COMPLEX)
+        return self._filters.get(kernel, shape, make)
+
+    def clear_cache(self):
+        self._filters.clear()
+
+    def deconvolve(self, volume, kernel):
+        pad = self.pad_amount
+        padded = np.pad(as_float(volume), pad, mode='reflect') if pad else as_float(volume)
+        # scipy.fft keeps float32/complex64 (numpy.fft before 2.0 always returns double)
+        spectrum = scipy.fft.rfftn(padded, workers=fft_workers())
+        spectrum *= self.get_filter(kernel, padded.shape)
+        result = scipy.fft.irfftn(spectrum, padded.shape, workers=fft_workers())
+        if pad:
+            result = result[tuple(slice(pad, n - pad) for n in padded.shape)]
+        return np.clip(result, 0, None, out=result)
+
+    def run(self, acquisition, niter=None, session_config=None):
+        return type(acquisition)(data=self.deconvolve(acquisition.data, acquisition.kernel), kernel=acquisition.kernel)
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+import tifffile
+
+# zlib is built into tifffile; zstd and lzw need the imagecodecs package
+COMPRESSIONS = ['none', 'zlib', 'zstd', 'lzw']
+
+
+def write_output(output_file_str, data, mdata = None, resolution = None, compression = None, level = None,
+                 tile = None, rowsperstrip = None, maxworkers = None):
+    """
+    Write a TZCYX result as an ImageJ hyperstack, optionally compressed.
+
+    Strips (or tiles) are compressed on `maxworkers` threads (all cores by default) and the file
+    is written next to its final name and renamed into place, so a half-written file never
+    appears on the share.
+
+    Parameters:
+    - compression: None/'none', 'zlib', 'zstd' or 'lzw'. Fiji's own opener reads zlib and lzw;
+      zstd needs Bio-Formats.
+    - level: compression level for zlib/zstd.
+    - tile: (y, x) tile shape; tiled files also need Bio-Formats in Fiji.
+    - rowsperstrip: rows per strip for striped files; smaller strips encode in parallel better.
+    """
+    if compression == 'none':
+        compression = None
+    if data.dtype != np.uint16:
+        data = data.astype(np.uint16)
+    options = {}
+    if compression is not None:
+        options['compression'] = compression
+        if level is not None:
+            options['compressionargs'] = {'level': level}
+        options['maxworkers'] = maxworkers or os.cpu_count()
+    if tile is not None:
+        options['tile'] = tuple(tile)
+    elif rowsperstrip is not None:
+        options['rowsperstrip'] = rowsperstrip
+
+    tmp_file_str = output_file_str + '.tmp'
+    tifffile.imwrite(tmp_file_str, data, imagej=True, metadata=mdata, resolution=resolution, **options)
+    os.replace(tmp_file_str, output_file_str)
+    return output_file_str
+
+
+def add_write_arguments(parser):
+    parser.add_argument('--compression', type=str, default='none', choices=COMPRESSIONS)
+    parser.add_argument('--compression_level', type=int, required=False)
+    parser.add_argument('--tile', type=int, nargs=2, required=False, help='tile shape in y x pixels')
+    parser.add_argument('--rowsperstrip', type=int, required=False)
+    parser.add_argument('--write_workers', type=int, required=False, help='compression threads, defaults to all cores')
+
+
+def write_options_from_args(args):
+    """The write_output keyword arguments given by the options from add_write_arguments."""
+    return {'compression': args.compression, 'level': args.compression_level, 'tile': args.tile,
+            'rowsperstrip': args.rowsperstrip, 'maxworkers': args.write_workers}
@@ -1,16 +1,33 @@
 import warnings
 # warnings.simplefilter(action='ignore', category=FutureWarning)
 
-
+import tkinter as tk
 
 from RLDecon.get_inputs_batch import get_inputs_batch
 from RLDecon.get_inputs import get_inputs
+from RLDecon.index import header_mdata
+from RLDecon.jobs import JobRunner, ProgressWindow
 from RLDecon.run_decon_debug import run_decon
 
 batch = True
 debug = False
+
+
+def submit_jobs(runner, variables):
+    # One job per file, so each dataset gets its own progress bar and can be cancelled on its own.
+    # Outputs are resumable, so queueing a cancelled file again continues where it stopped.
+    # Metadata and resolution come from each file's indexed header, its pixels are read by the job
+    [input_files, headers, mdata, psfs, x_res, y_res, z_spacing, niter, pad_amount, channel] = variables
+    for input_file_str, header in zip(input_files, headers):
+        file_mdata = header_mdata(header) or dict(mdata)
+        runner.submit(input_file_str, run_decon, [input_file_str], [None], file_mdata, psfs, tuple(header['x_res']),
+                      tuple(header['y_res']), z_spacing[0], niter[0], pad_amount, channel, debug, resume=True)
+
+
 if batch:
-    variables = get_inputs_batch()
+    root = tk.Tk()
+    root.withdraw()
+    variables = get_inputs_batch(root)
 else:
     variables = get_inputs()
     
@@ -20,7 +37,15 @@ if variables is not None:
     
 
     if batch:
-        [input_files, dats, mdata, psfs, x_res, y_res, z_spacing, niter, pad_amount, channel] = variables
-        run_decon(input_files, dats, mdata, psfs, x_res, y_res, z_spacing[0], niter[0], pad_amount, channel, debug)
+        # Deconvolution runs on a background worker; the window shows progress and can queue more datasets
+        runner = JobRunner()
+        submit_jobs(runner, variables)
+
+        def add_jobs():
+            more = get_inputs_batch(root)
+            if more is not None:
+                submit_jobs(runner, more)
 
-    
\ No newline at end of file
+        ProgressWindow(root, runner, add_jobs)
+        root.deiconify()
+        root.mainloop()
@@ -1,102 +1,46 @@
-import cupy as cp
+import os
+import sys
 
-def richardson_lucy_deconvolution(image, original_psf, iterations, use_otf=True, use_regularization=True, regularization_constant=1e-2, use_cutoff=False, cutoff_frequency=0.5, convergence_ratio=0.25):
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from RLDecon.psf import resample_psf_z
+from RLDecon.rl import RichardsonLucy
+
+
+def richardson_lucy_deconvolution(image, original_psf, iterations, use_regularization=True, regularization_constant=2e-3,
+                                  use_cutoff=False, cutoff_frequency=0.5, psf_z_spacing=None, image_z_spacing=None,
+                                  pad_amount=0, backend='cupy', coarse_factor=None, coarse_iterations=None):
     """
-    Perform Richardson-Lucy deconvolution with options for direct PSF usage, regularization, and high-frequency cutoff.
+    Perform Richardson-Lucy deconvolution with optional regularization and high-frequency cutoff.
+
+    Runs RLDecon.rl.RichardsonLucy: half-spectrum rfftn convolutions in float32 on cupy (or
+    numpy with backend='numpy'), with the cutoff mask precomputed on the rfft grid.
 
     Parameters:
-    - image: CuPy array, the observed (blurred and noisy) image.
-    - psf: CuPy array, the point spread function.
+    - image: numpy or CuPy array, the observed (blurred and noisy) image.
+    - original_psf: numpy array, the measured point spread function, centred.
     - iterations: int, the number of iterations to perform.
-    - use_otf: bool, whether to convert the PSF to the OTF for frequency domain deconvolution.
-    - use_regularization: bool, whether to apply regularization.
-    - regularization_constant: float, to avoid division by zero if regularization is used.
-    - use_cutoff: bool, whether to apply a high-frequency cutoff filter (only applicable if use_otf is True).
+    - use_regularization: bool, whether to apply total-variation regularization.
+    - regularization_constant: float, the total-variation weight if regularization is used.
+    - use_cutoff: bool, whether to apply a high-frequency cutoff filter.
     - cutoff_frequency: float, the cutoff frequency as a fraction of the Nyquist frequency (used if use_cutoff is True).
-    - convergence_ratio: float, the ratio of the change in MSE to its initial value at which to stop the iterations.
+    - psf_z_spacing, image_z_spacing: floats in microns; when both are given the PSF is resampled
+      to the image's z spacing first (e.g. 0.1 -> 0.271).
+    - pad_amount: int, reflect padding on every side against wrap-around.
+    - backend: 'cupy' or 'numpy'.
+    - coarse_factor: 2 or 4 to start from coarse_iterations (default half) iterations on the
+      image downsampled by this factor in y and x; the rest run at full resolution.
 
     Returns:
-    - CuPy array: the deconvolved image.
+    - numpy array: the deconvolved image (float32).
     """
-    # Original and target z spacings
-    original_z_spacing = 0.1
-    target_z_spacing = 0.271
-    
-    # Calculate the new number of z slices, rounded to nearest integer
-    original_z_slices = original_psf.shape[0]
-    z_spacing_ratio = target_z_spacing / original_z_spacing
-    new_z_slices = int(np.round(original_z_slices / z_spacing_ratio))
-    
-    # Create arrays of original and new z positions
-    original_z_positions = np.linspace(0, (original_z_slices - 1) * original_z_spacing, original_z_slices)
-    new_z_positions = np.linspace(0, (new_z_slices - 1) * target_z_spacing, new_z_slices)
-    
-    # Initialize the new PSF array with the new z dimension and same x, y dimensions
-    new_psf = np.zeros((new_z_slices, original_psf.shape[1], original_psf.shape[2]))
-    # Loop through each x, y position
-    for x in range(original_psf.shape[1]):
-        for y in range(original_psf.shape[2]):
-            # Extract the z-axis data for the current x, y position
-            original_psf_z = original_psf[:, x, y]
-    
-            # Create an interpolation function for the current z-axis data
-            interp_function = interp1d(original_z_positions, original_psf_z, kind='cubic', fill_value="extrapolate")
-    
-            # Interpolate the data at the new z positions and store in the new PSF array
-            new_psf[:, x, y] = interp_function(new_z_positions)
-    
-    
-    if use_otf:
-        # Convert the PSF to OTF if using the frequency domain approach
-        otf = cp.fft.fftn(cp.fft.fftshift(psf), s=image.shape)
-        if use_cutoff:
-            # Apply high-frequency cutoff if enabled
-            filter = create_frequency_filter_3d(image.shape, cutoff_frequency)
-            otf *= filter
-        if use_regularization:
-            otf = cp.where(otf == 0, regularization_constant, otf)
-    else:
-        # Use the PSF directly in the spatial domain, only apply regularization in correction factor calculation
-        if use_regularization:
-            psf = cp.where(psf == 0, regularization_constant, psf)
-        # Ensure PSF is normalized for direct use
-        psf /= cp.sum(psf)
-
-    observed = cp.fft.fftn(image)
-    estimate = observed.copy()
-
-    for i in range(iterations):
-        if use_otf:
-            estimated_image = cp.fft.ifftn(estimate).real
-            correction_factor = cp.fft.ifftn(observed / (estimate + (regularization_constant if use_regularization else 0)))
-            estimate = estimate * (cp.fft.fftn(correction_factor.real) / otf)
-        else:
-            # Perform convolution in the spatial domain using the direct PSF
-            estimated_image = cp.signal.fftconvolve(estimate, psf, mode='same')
-            correction_factor = cp.signal.fftconvolve(image / estimated_image, psf[::-1, ::-1], mode='same')
-            estimate *= correction_factor
-
-        # Implement convergence check here if desired
-
-    print(f"Total iterations executed: {i + 1}")
-    return cp.fft.ifftn(estimate).real if use_otf else estimated_image
-
-def create_frequency_filter_3d(shape, cutoff):
-    depth, rows, cols = shape
-    center_depth, center_row, center_col = depth // 2, rows // 2, cols // 2
-    z, y, x = cp.ogrid[:depth, :rows, :cols]
-    distance_from_center = cp.sqrt((x - center_col)**2 + (y - center_row)**2 + (z - center_depth)**2)
-    max_distance = cp.sqrt(center_col**2 + center_row**2 + center_depth**2)
-    filter = cp.where(distance_from_center / max_distance <= cutoff, 1, 0)
-    return filter
-
-
-# Assuming `image` and `psf` are CuPy arrays of the observed image and PSF, respectively
-iterations = 10
-use_regularization = False  # Disable regularization
-use_cutoff = False  # Optionally, disable the cutoff filter as well
-
-deconvolved_image = regularized_richardson_lucy(image, psf, iterations, use_regularization, use_cutoff=use_cutoff)
-
-# Convert back to NumPy array if necessary for further processing/display
-# deconvolved_image_np = cp.asnumpy(deconvolved_image)
+    psf = np.asarray(original_psf, dtype=np.float32)
+    if psf_z_spacing is not None and image_z_spacing is not None:
+        psf = resample_psf_z(psf, psf_z_spacing, image_z_spacing)
+    image = image.get() if hasattr(image, 'get') else image
+    engine = RichardsonLucy(pad_amount, regularization_constant if use_regularization else 0.0,
+                            cutoff_frequency if use_cutoff else None, backend, coarse_factor, coarse_iterations)
+    deconvolved = engine.deconvolve(image, psf, iterations)
+    print(f"Total iterations executed: {iterations}")
+    return deconvolved
@@ -6,22 +6,33 @@
 #
 # Developed in collaboration with Andy York (Calico), Jan Becker (Oxford) and Craig Russell (EMBL EBI)
 
+import os
+import sys
+import json
 import numpy as np
-from scipy.interpolate import interp1d
 import cupy as cp
 import timeit
 import tifffile
 import argparse
 from scipy import ndimage, signal, stats
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from RLDecon.kernels import gaussian_otf, kernel_shape, voxel_covariance
+from RLDecon.psf import prepare_psf, resample_psf_z
+from RLDecon.roi import kernel_halo, padded_roi, parse_roi, read_volume
+from RLDecon.dtypes import FLOAT, work_dtype
+from RLDecon.telemetry import Telemetry, profiled
+
 rng = np.random.default_rng()
+telemetry = Telemetry()
 
 
 def main():
     # Get input arguments
     parser = argparse.ArgumentParser(formatter_class = argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--input', type = str, required = True)
-    parser.add_argument('--psf', type = str, required = True)
+    parser.add_argument('--psf', type = str, required = True, help = 'measured PSF .tif or fitted covariance .csv')
+    parser.add_argument('--z_spacing', type = float, default = 2.705078, help = 'z spacing in the lateral units of a .csv PSF')
     parser.add_argument('--output', type = str, required = True)
     parser.add_argument('--max_iters', type = int, default = 10)
     parser.add_argument('--reblurred', type = str, required = False)
@@ -32,117 +43,89 @@ def main():
     parser.add_argument('--rl_iters_output', type = str, required = False)
     parser.add_argument('--updates_output', type = str, required = False)
     parser.add_argument('--blur_consensus', type = int, default = 1)
+    parser.add_argument('--roi', type = str, required = False, help = 'z0:z1,y0:y1,x0:x1; only this block plus a PSF-sized halo is deconvolved and saved')
+    parser.add_argument('--timepoint', type = int, default = 0, help = 'timepoint of a hyperstack to deconvolve')
+    parser.add_argument('--channel', type = int, default = 0, help = 'channel of a hyperstack to deconvolve')
+    parser.add_argument('--telemetry', type = str, required = False, help = 'JSON-lines file for per-iteration timings')
+    parser.add_argument('--profile', type = str, choices = ['cprofile', 'sample'], required = False)
+    parser.add_argument('--profile_output', type = str, required = False)
+    parser.add_argument('--double', action = 'store_true', help = 'keep the estimates in float64 (everything else stays float32)')
+    parser.add_argument('--save_state', action = 'store_true', help = 'save the float32 estimates and RNG state next to the output, see --continue_from')
+    parser.add_argument('--continue_from', type = str, required = False, help = 'output of an earlier --save_state run; run --max_iters more iterations from its state')
     args = parser.parse_args()
 
+    global telemetry
+    telemetry = Telemetry(args.telemetry, sync = cp.cuda.Stream.null.synchronize)
+    with profiled(args.profile, args.profile_output):
+        run(args)
+    telemetry.close()
+
+
+def run(args):
     # Load data
-    image = tifffile.imread(args.input)
+    with telemetry.timer('io'):
+        with tifffile.TiffFile(args.input) as tif:
+            image = read_volume(tif, args.timepoint, args.channel)
 
     # Add new z-axis if we have 2D data
     if image.ndim == 2:
         image = np.expand_dims(image, axis=0)
 
-    # Load and pad PSF if necessary
-    psf_temp = tifffile.imread(args.psf)
-    
-    # Add new z-axis if we have 2D data
-    if psf_temp.ndim == 2:
-        psf_temp = np.expand_dims(psf_temp, axis=0)
-    
-    # if (args.process_psf):
-        # print("Processing PSF...")
-        # Take upper left 16x16 pixels to estimate noise level and create appropriate fake noise
-        # noisy_region = psf_temp[0:16, 0:16, 0:16]
-        # psf = np.random.normal(np.mean(noisy_region), np.std(noisy_region), image.shape)
-    # else:
+    # Load the PSF first, its support sets the halo around an ROI
+    if args.psf.endswith('.csv'):
+        covariance = np.genfromtxt(args.psf, delimiter=',')
+        cov = voxel_covariance(covariance, args.z_spacing)
+        support = kernel_shape(cov)
+    else:
+        psf_temp = load_psf(args.psf, args.process_psf)
+        support = psf_temp.shape
+
+    if args.roi is not None:
+        block, crop = padded_roi(parse_roi(args.roi), kernel_halo([support]), image.shape)
+        image = np.array(image[block])
+        print(f'Deconvolving a {image.shape} block around the ROI {args.roi}')
+
     timepoint = image
     nonzero = timepoint[np.where(timepoint>0)]
     bkgd_mode = stats.mode(nonzero)[0][0]
     bkgd_std = stats.tstd(nonzero)
     indz,indy,indx = np.where(timepoint==0)
-    timepoint[indz, indy, indx] = bkgd_mode + bkgd_std*np.random.randn(len(indz))
+    # float32 noise and scalars, so the fill does not make a float64 copy of the zeros
+    noise = np.random.default_rng().standard_normal(len(indz), dtype=FLOAT)
+    timepoint[indz, indy, indx] = FLOAT(bkgd_mode) + FLOAT(bkgd_std)*noise
     
     image = timepoint
-    # Assuming original_psf is your original 3D PSF array with shape (101, 121, 121)
-    # For demonstration, let's create a placeholder for the original PSF data
-    
-    original_psf = psf_temp
-
-    # original_psf = np.random.rand(101, 121, 121)  # Original shape
-    
-    # Original and target z spacings
-    original_z_spacing = 0.1
-    target_z_spacing = 0.271
-    
-    # Calculate the new number of z slices, rounded to nearest integer
-    original_z_slices = original_psf.shape[0]
-    z_spacing_ratio = target_z_spacing / original_z_spacing
-    new_z_slices = int(np.round(original_z_slices / z_spacing_ratio))
-    
-    # Create arrays of original and new z positions
-    original_z_positions = np.linspace(0, (original_z_slices - 1) * original_z_spacing, original_z_slices)
-    new_z_positions = np.linspace(0, (new_z_slices - 1) * target_z_spacing, new_z_slices)
-    
-    # Initialize the new PSF array with the new z dimension and same x, y dimensions
-    new_psf = np.zeros((new_z_slices, original_psf.shape[1], original_psf.shape[2]))
-    
-    # Loop through each x, y position
-    for x in range(original_psf.shape[1]):
-        for y in range(original_psf.shape[2]):
-            # Extract the z-axis data for the current x, y position
-            original_psf_z = original_psf[:, x, y]
-    
-            # Create an interpolation function for the current z-axis data
-            interp_function = interp1d(original_z_positions, original_psf_z, kind='cubic', fill_value="extrapolate")
-    
-            # Interpolate the data at the new z positions and store in the new PSF array
-            new_psf[:, x, y] = interp_function(new_z_positions)
-
-    
-    # new_psf now contains the PSF data interpolated to the new z-spacing
-    print(f"New PSF shape: {new_psf.shape}")
-    psf_temp = new_psf
-    
-#     take csv JONATHON FIT
-#     kernel_shape = (51,51,51)
-#     kernel = np.zeros(kernel_shape)
-#     fitted_psf_file_str = "../average.csv"
-#     g_psf = np.genfromtxt(fitted_psf_file_str, delimiter=',')
-    
-#     psf_temp = ndimage.gaussian_filter(kernel, sigma=[np.sqrt(g_psf[2,2])/2.71,np.sqrt(g_psf[0,0]),np.sqrt(g_psf[1,1])])
-
-    psf = np.zeros(image.shape)
-    
-    psf[:psf_temp.shape[0], :psf_temp.shape[1], :psf_temp.shape[2]] = psf_temp
-    for axis, axis_size in enumerate(psf_temp.shape):
-        psf = np.roll(psf, -int(axis_size / 2), axis=axis)
-
-    # if (args.process_psf):
-        # psf = psf - np.mean(noisy_region)
-        # psf[psf < 0] = 0
-
-    # psf = psf_temp
-
-    psf = psf / np.sum(psf)
-
-    # Load data and PSF onto GPU
-    image = cp.array(image, dtype=cp.float32)
-    psf = cp.array(psf, dtype=cp.float32)
 
-    # Calculate OTF and transpose
-    otf = cp.fft.rfftn(psf)
-    psfT = cp.flip(psf, (0, 1, 2))
-    otfT = cp.fft.rfftn(psfT)
+    if args.psf.endswith('.csv'):
+        # Gaussian fit: evaluate the OTF analytically on the rfft grid of the image, with the full
+        # covariance. No spatial kernel or PSF FFT is needed and the PSF is never cropped.
+        otf = cp.array(gaussian_otf(cov, image.shape))
+        # The OTF is real, so the flipped PSF has the same OTF
+        otfT = otf
+        psf_shape = covariance.shape
+    else:
+        psf = cp.array(pad_psf(psf_temp, image.shape), dtype=FLOAT)
+        psf_shape = psf_temp.shape
+
+        # Calculate OTF and transpose
+        otf = cp.fft.rfftn(psf)
+        psfT = cp.flip(psf, (0, 1, 2))
+        otfT = cp.fft.rfftn(psfT)
+
+    # Load data onto GPU
+    image = cp.array(image, dtype=FLOAT)
 
     # Log which files we're working with and the number of iterations
     print('')
     print('Input file: %s' % args.input)
     print('Input shape: %s' % (image.shape, ))
     print('PSF file: %s' % args.psf)
-    print('PSF shape: %s' % (psf_temp.shape, ))
+    print('PSF shape: %s' % (psf_shape, ))
     print('Output file: %s' % args.output)
     print('Maximum number of iterations: %d' % args.max_iters)
     print('PSF processing: %s' % args.process_psf)
     print('')
+    telemetry.record('setup', input = args.input, psf = args.psf, shape = image.shape)
 
     # Get dimensions of data
     num_z = image.shape[0]
@@ -152,17 +135,22 @@ def main():
 
     # Calculate Richardson-Lucy iterations
     HTones = fftconv(cp.ones_like(image), otfT)
-    recon = cp.ones((num_z, num_y, num_x))
-    recon_rl = cp.ones((num_z, num_y, num_x))
+    # Everything is float32 (complex64 spectra) unless --double asks for float64 estimates
+    recon = cp.ones((num_z, num_y, num_x), dtype=work_dtype(args.double))
+    recon_rl = cp.ones((num_z, num_y, num_x), dtype=work_dtype(args.double))
+    first_iter = 0
+    if args.continue_from is not None:
+        recon, recon_rl, first_iter = load_state(args.continue_from, image.shape, work_dtype(args.double))
+        print('Continuing from iteration %d of %s' % (first_iter, args.continue_from))
 
     if (args.iters_output is not None):
-        iters = np.zeros((args.max_iters, num_z, num_y, num_x))
+        iters = np.zeros((args.max_iters, num_z, num_y, num_x), dtype=FLOAT)
 
     if (args.rl_iters_output is not None):
-        rl_iters = np.zeros((args.max_iters, num_z, num_y, num_x))
+        rl_iters = np.zeros((args.max_iters, num_z, num_y, num_x), dtype=FLOAT)
 
     if (args.updates_output is not None):
-        updates = np.zeros((args.max_iters, num_z, num_y, num_x))
+        updates = np.zeros((args.max_iters, num_z, num_y, num_x), dtype=FLOAT)
 
     num_iters = 0
     for iter in range(args.max_iters):
@@ -170,43 +158,51 @@ def main():
 
         # Split recorded image into 50:50 images
         # TODO: make this work on the GPU (for some reason, we get repeating blocks with a naive conversion to cupy)
-        split1 = rng.binomial(image.get().astype('int64'), p=0.5)
-        split1 = cp.array(split1)
-        split2 = image - split1
+        with telemetry.timer('rng'):
+            split1 = rng.binomial(image.get().astype('int64'), p=0.5)
+            # Counts come back as int64; mixing them with float32 would promote every ratio to float64
+            split1 = cp.array(split1, dtype=FLOAT)
+        with telemetry.timer('elementwise'):
+            split2 = image - split1
 
         # Calculate prediction
         Hu = fftconv(recon, otf)
 
         # Calculate updates for split images and full images (H^T (d / Hu))
-        ratio1 = split1 / (0.5 * (Hu + 1E-12))
-        ratio2 = split2 / (0.5 * (Hu + 1E-12))
+        with telemetry.timer('elementwise'):
+            ratio1 = split1 / (0.5 * (Hu + 1E-12))
+            ratio2 = split2 / (0.5 * (Hu + 1E-12))
         HTratio1 = fftconv(ratio1, otfT)
         HTratio2 = fftconv(ratio2, otfT)
-        ratio = image / (Hu + 1E-12)
+        with telemetry.timer('elementwise'):
+            ratio = image / (Hu + 1E-12)
         HTratio = fftconv(ratio, otfT)
-        HTratio = HTratio / HTones
+        with telemetry.timer('elementwise'):
+            HTratio = HTratio / HTones
 
-        # Normalise update steps by H^T(1) and only update pixels in full estimate where split updates agree in 'sign'
-        update1 = HTratio1 / HTones
-        update2 = HTratio2 / HTones
+            # Normalise update steps by H^T(1) and only update pixels in full estimate where split updates agree in 'sign'
+            update1 = HTratio1 / HTones
+            update2 = HTratio2 / HTones
         if (args.blur_consensus != 0):
             shouldNotUpdate = fftconv(fftconv((update1 - 1) * (update2 - 1), otf), otfT) < 0
         else:
             shouldNotUpdate = (update1 - 1) * (update2 - 1) < 0
-        HTratio[shouldNotUpdate] = 1
+        with telemetry.timer('elementwise'):
+            HTratio[shouldNotUpdate] = 1
 
-        # Save previous estimate to check we're not wasting our time updating small values
-        previous_recon = recon
+            # Save previous estimate to check we're not wasting our time updating small values
+            previous_recon = recon
 
-        # Update estimate
-        recon = recon * HTratio
+            # Update estimate
+            recon = recon * HTratio
 
         # Add to full iterations output if asked to by user
-        if (args.iters_output is not None):
-            iters[iter, :, :, :] = recon.get()
+        with telemetry.timer('io'):
+            if (args.iters_output is not None):
+                iters[iter, :, :, :] = recon.get()
 
-        if (args.updates_output is not None):
-            updates[iter, :, :, :] = HTratio.get()
+            if (args.updates_output is not None):
+                updates[iter, :, :, :] = HTratio.get()
 
         # Also calculate normal RL update if asked to by user
         if args.rl_output is not None:
@@ -220,7 +216,10 @@ def main():
         calc_time = timeit.default_timer() - start_time
         num_updated = num_pixels - cp.sum(shouldNotUpdate)
         max_relative_delta = cp.max((recon - previous_recon) / cp.max(recon))
-        print("Iteration %03d completed in %1.3f s. %1.2f %% of image updated. Update range: %1.2f to %1.2f. Largest relative delta = %1.3f" % (iter + 1, calc_time, 100 * num_updated / num_pixels, cp.min(HTratio), cp.max(HTratio), max_relative_delta))
+        telemetry.record('iteration', iteration = first_iter + iter + 1, wall_s = calc_time,
+                         fraction_updated = num_updated / num_pixels, max_relative_delta = max_relative_delta,
+                         gpu_pool_mb = cp.get_default_memory_pool().total_bytes() / 1e6)
+        print("Iteration %03d completed in %1.3f s. %1.2f %% of image updated. Update range: %1.2f to %1.2f. Largest relative delta = %1.3f" % (first_iter + iter + 1, calc_time, 100 * num_updated / num_pixels, cp.min(HTratio), cp.max(HTratio), max_relative_delta))
 
         num_iters = num_iters + 1
 
@@ -231,35 +230,107 @@ def main():
             break
 
     # Reblur, collect from GPU and save if argument given
-    if args.reblurred is not None:
-        reblurred = fftconv(recon, otf)
-        reblurred = reblurred.get()
-        tifffile.imwrite(args.reblurred, reblurred, bigtiff=True)
+    with telemetry.timer('io'):
+        if args.reblurred is not None:
+            reblurred = fftconv(recon, otf)
+            reblurred = reblurred.get()
+            if args.roi is not None:
+                reblurred = reblurred[crop]
+            tifffile.imwrite(args.reblurred, reblurred, bigtiff=True)
+
+        if args.save_state:
+            # The whole block, before the ROI is cut out, so a later run continues on the same data
+            save_state(args.output, recon, recon_rl, first_iter + num_iters)
+
+        if args.roi is not None:
+            # Cut the ROI back out of the deconvolved block
+            recon = recon[crop]
+            recon_rl = recon_rl[crop]
+            if (args.iters_output is not None):
+                iters = iters[(slice(None),) + crop]
+            if (args.rl_iters_output is not None):
+                rl_iters = rl_iters[(slice(None),) + crop]
+            if (args.updates_output is not None):
+                updates = updates[(slice(None),) + crop]
 
-    # Collect reconstruction from GPU and save
-    recon = recon.get()
-    tifffile.imwrite(args.output, recon, bigtiff=True)
+        # Collect reconstruction from GPU and save
+        recon = recon.get()
+        tifffile.imwrite(args.output, recon, bigtiff=True)
 
-    # Save RL output if argument given
-    if args.rl_output is not None:
-        recon_rl = recon_rl.get()
-        tifffile.imwrite(args.rl_output, recon_rl, bigtiff=True)
+        # Save RL output if argument given
+        if args.rl_output is not None:
+            recon_rl = recon_rl.get()
+            tifffile.imwrite(args.rl_output, recon_rl, bigtiff=True)
 
-    # Save full iterations if argument given
-    if (args.iters_output is not None):
-        tifffile.imwrite(args.iters_output, iters[0:num_iters, :, :, :], bigtiff=True)
+        # Save full iterations if argument given
+        if (args.iters_output is not None):
+            tifffile.imwrite(args.iters_output, iters[0:num_iters, :, :, :], bigtiff=True)
 
-    # Save full RL iterations if argument given
-    if (args.rl_iters_output is not None):
-        tifffile.imwrite(args.rl_iters_output, rl_iters[0:num_iters, :, :, :], bigtiff=True)
+        # Save full RL iterations if argument given
+        if (args.rl_iters_output is not None):
+            tifffile.imwrite(args.rl_iters_output, rl_iters[0:num_iters, :, :, :], bigtiff=True)
 
-    # Save full updates if argument given
-    if (args.updates_output is not None):
-        tifffile.imwrite(args.updates_output, updates, bigtiff=True)
+        # Save full updates if argument given
+        if (args.updates_output is not None):
+            tifffile.imwrite(args.updates_output, updates, bigtiff=True)
+    telemetry.record('write', output = args.output)
+
+
+def state_file_str(output_file):
+    return output_file.replace('.tif', '') + '.state.npz'
+
+
+def save_state(output_file, recon, recon_rl, num_iters):
+    # float32 estimates, the iterations they have had and the state of the splitting RNG
+    np.savez(state_file_str(output_file), recon = recon.get().astype(FLOAT), recon_rl = recon_rl.get().astype(FLOAT),
+             iterations = num_iters, rng_state = json.dumps(rng.bit_generator.state))
+
+
+def load_state(output_file, shape, dtype):
+    # Restores the RNG too, so the continued run draws the splits the longer run would have
+    with np.load(state_file_str(output_file)) as state:
+        if state['recon'].shape != tuple(shape):
+            raise ValueError('Saved state has shape %s, the image is %s' % (state['recon'].shape, tuple(shape)))
+        rng.bit_generator.state = json.loads(str(state['rng_state']))
+        return cp.array(state['recon'], dtype = dtype), cp.array(state['recon_rl'], dtype = dtype), int(state['iterations'])
+
+
+def load_psf(psf_file, process_psf = True):
+    # Load the PSF
+    with telemetry.timer('io'):
+        psf_temp = tifffile.imread(psf_file)
+    
+    # Add new z-axis if we have 2D data
+    if psf_temp.ndim == 2:
+        psf_temp = np.expand_dims(psf_temp, axis=0)
+
+    if process_psf:
+        # Subtract the background, recentre on the centroid and crop to the PSF's support
+        print("Processing PSF...")
+        psf_temp = prepare_psf(psf_temp)
+
+    # Beads are imaged at 0.1 um z spacing, the data at 0.271 um
+    psf_temp = resample_psf_z(psf_temp, 0.1, 0.271)
+    print(f"New PSF shape: {psf_temp.shape}")
+    return psf_temp
+
+
+def pad_psf(psf_temp, shape):
+    # Pad the PSF to the image shape with its centre on the origin
+    psf = np.zeros(shape, dtype=FLOAT)
+    
+    psf[:psf_temp.shape[0], :psf_temp.shape[1], :psf_temp.shape[2]] = psf_temp
+    for axis, axis_size in enumerate(psf_temp.shape):
+        psf = np.roll(psf, -int(axis_size / 2), axis=axis)
+
+    psf = psf / np.sum(psf)
+
+    return psf
 
 
 def fftconv(x, H):
-    return cp.fft.irfftn(cp.fft.rfftn(x) * H, x.shape)
+    with telemetry.timer('fft'):
+        return cp.fft.irfftn(cp.fft.rfftn(x) * H, x.shape)
 
 
 if __name__ == '__main__':
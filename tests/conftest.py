@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The package is used from a checkout (see ScottRLDecon/rlgc.py), not installed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
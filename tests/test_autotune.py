@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+import scipy.fft
+
+from RLDecon import autotune
+
+RESULT = np.ones((4, 8, 8), np.float32)
+
+
+@pytest.fixture
+def fake_engines(monkeypatch):
+    # Timings and results by (mode, backend, padding); a missing entry raises like a failing engine
+    outcomes = {}
+    calls = []
+
+    def benchmark(volume, kernel, niter, config, repeats = 1, options = None):
+        calls.append((config['mode'], config['backend'], config['pad_amount'], options))
+        outcome = outcomes[config['mode'], config['backend'], config['pad_amount']]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    monkeypatch.setattr(autotune, 'benchmark', benchmark)
+    monkeypatch.setattr(autotune, 'available_backends',
+                        lambda flowdec = True: ([('rl', None)] if flowdec else []) + [('rfft', 'numpy'), ('rfft', 'cupy')])
+    return outcomes, calls
+
+
+def volume():
+    return np.zeros((20, 30, 30), np.float32)
+
+
+def test_fast_pad_makes_padded_sizes_fast():
+    pad = autotune.fast_pad((20, 30, 30), 4)
+    assert 4 <= pad <= 4 + autotune.MAX_EXTRA_PAD
+    assert all(scipy.fft.next_fast_len(n + 2*pad, real=True) == n + 2*pad for n in (20, 30, 30))
+    # Already fast sizes keep the requested padding
+    assert autotune.fast_pad((24, 56, 56), 4) == 4
+
+
+def test_sample_is_the_central_block():
+    data = np.arange(2 * 10 * 12).reshape(2, 10, 12)
+    sample = autotune.sample_volume(data, size=4)
+    assert np.array_equal(sample, data[:, 3:7, 4:8])
+    assert autotune.sample_volume(data, size=64).shape == data.shape
+
+
+def test_decision_is_cached_per_key(tmp_path, fake_engines):
+    outcomes, calls = fake_engines
+    cache_file_str = str(tmp_path / 'autotune.json')
+    pads = sorted({16, autotune.fast_pad(volume().shape, 16)})
+    for pad in pads:
+        outcomes['rl', None, pad] = (2.0, RESULT)
+        outcomes['rfft', 'numpy', pad] = (1.0, RESULT * 1.01)
+        outcomes['rfft', 'cupy', pad] = (0.5 if pad == pads[-1] else 0.6, RESULT)
+
+    best = autotune.autotune(volume(), np.ones((5, 5, 5)), 10, 16, cache_file_str=cache_file_str)
+    assert (best['mode'], best['backend'], best['pad_amount']) == ('rfft', 'cupy', pads[-1])
+    assert len(calls) == 3 * len(pads)
+
+    # Same shape, kernel, niter and padding: no benchmarks
+    assert autotune.autotune(volume(), np.ones((5, 5, 5)), 10, 16, cache_file_str=cache_file_str) == best
+    assert len(calls) == 3 * len(pads)
+    # Any of them changed, or an engine option set: benchmarked again
+    autotune.autotune(volume(), np.ones((5, 5, 5)), 20, 16, cache_file_str=cache_file_str)
+    assert len(calls) == 6 * len(pads)
+    autotune.autotune(volume(), np.ones((5, 5, 5)), 10, 16, cache_file_str=cache_file_str, regularization=0.002)
+    assert len(calls) == 8 * len(pads)
+    assert {call[0] for call in calls[-2 * len(pads):]} == {'rfft'}
+    assert calls[-1][3]['regularization'] == 0.002
+    assert len(autotune.load_cache(cache_file_str)) == 3
+
+
+def test_failing_and_inaccurate_candidates_are_skipped(tmp_path, fake_engines):
+    outcomes, calls = fake_engines
+    for pad in sorted({16, autotune.fast_pad(volume().shape, 16)}):
+        outcomes['rl', None, pad] = (2.0, RESULT)
+        outcomes['rfft', 'numpy', pad] = (1.0, RESULT)
+        # Fast but wrong, and a GPU that runs out of memory
+        outcomes['rfft', 'cupy', pad] = (0.1, RESULT * 2) if pad == 16 else MemoryError('out of memory')
+    best = autotune.autotune(volume(), np.ones((5, 5, 5)), 10, 16, cache_file_str=str(tmp_path / 'autotune.json'))
+    assert (best['mode'], best['backend']) == ('rfft', 'numpy')
+    assert best['error'] == 0
+
+
+def test_reference_failing_moves_to_next_candidate(fake_engines):
+    outcomes, _ = fake_engines
+    for pad in sorted({16, autotune.fast_pad(volume().shape, 16)}):
+        outcomes['rl', None, pad] = RuntimeError('no GPU for TensorFlow')
+        outcomes['rfft', 'numpy', pad] = (1.0, RESULT)
+        outcomes['rfft', 'cupy', pad] = (0.5, RESULT * 1.5)
+    best = autotune.autotune(volume(), np.ones((5, 5, 5)), 10, 16, cache_file_str=None)
+    assert best['backend'] == 'numpy'
+
+
+def test_nothing_runs(tmp_path, fake_engines):
+    with pytest.raises(RuntimeError, match='no engine'):
+        autotune.autotune(volume(), np.ones((5, 5, 5)), 10, 16, cache_file_str=str(tmp_path / 'autotune.json'))
+    assert not (tmp_path / 'autotune.json').exists()
+
+
+def test_real_engines_agree(tmp_path):
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('flowdec')
+    rng = np.random.default_rng(0)
+    data = rng.poisson(100, size=(12, 32, 32)).astype(np.float32)
+    z, y, x = np.mgrid[-2:3, -2:3, -2:3]
+    kernel = np.exp(-(z**2 + y**2 + x**2)/2).astype(np.float32)
+    best = autotune.autotune(data, kernel / kernel.sum(), 3, 4, cache_file_str=str(tmp_path / 'autotune.json'),
+                             regularization=0.002)
+    assert best['mode'] == 'rfft' and best['error'] <= autotune.DEFAULT_TOLERANCE
@@ -0,0 +1,30 @@
+import glob
+import os
+
+import numpy as np
+
+from RLDecon.bead_fit import find_beads, fit_beads
+
+PSF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PSFs')
+
+
+def test_fit_beads_matches_shipped_covariance():
+    covariance, beads = fit_beads(sorted(glob.glob(os.path.join(PSF_DIR, '*.ome.tif'))))
+    reference = np.loadtxt(os.path.join(PSF_DIR, '488PSF_sigma.csv'), delimiter=',')
+    # Each stack holds a single bead; side lobes and noise must not be fitted as beads
+    assert len(beads) == 4 and all(b['accepted'] for b in beads)
+    # Rows are y, x, z. Truncated ROIs used to give lateral variances around 9
+    assert np.allclose(np.diag(covariance)[:2], np.diag(reference)[:2], atol=1.0), np.diag(covariance)
+    assert abs(covariance[2, 2] - reference[2, 2]) < 2.5, np.diag(covariance)
+
+
+def test_find_beads_suppresses_side_lobes_and_noise():
+    z, y, x = np.meshgrid(*[np.arange(n) for n in (40, 40, 40)], indexing='ij')
+    def bead(c, amplitude):
+        return amplitude * np.exp(-0.5 * ((z - c[0])**2 / 9 + (y - c[1])**2 / 2 + (x - c[2])**2 / 2))
+    rng = np.random.default_rng(0)
+    stack = 100 + bead((20, 12, 12), 1000) + bead((31, 12, 12), 300) + bead((20, 28, 28), 500) + bead((20, 28, 12), 50)
+    stack = (stack + rng.normal(0, 2, stack.shape)).astype(np.float32)
+    peaks = find_beads(stack, (21, 11, 11))
+    # The lobe 11 planes under the bright bead and the bead at 5% of its height are dropped
+    assert sorted(map(tuple, peaks)) == [(20, 12, 12), (20, 28, 28)]
@@ -0,0 +1,80 @@
+import json
+import threading
+
+import numpy as np
+import pytest
+import tifffile
+
+from RLDecon.checkpoint import TimepointCheckpoint
+
+RESOLUTION = (9615384, 1000000)
+SHAPE = (3, 4, 2, 8, 8)
+
+
+def test_reopening_keeps_finished_volumes(tmp_path):
+    output_file_str = str(tmp_path / 'out.tif')
+    params = {'niter': 5, 'roi': (slice(None),)}
+    checkpoint = TimepointCheckpoint(output_file_str, SHAPE, {'spacing': 0.27}, RESOLUTION, params)
+    checkpoint.write(0, 0, np.full(SHAPE[1:2] + SHAPE[3:], 7, np.uint16))
+    checkpoint.write(0, 1, np.full(SHAPE[1:2] + SHAPE[3:], 8, np.uint16))
+    checkpoint.write(1, 1, np.full(SHAPE[1:2] + SHAPE[3:], 9, np.uint16))
+    # Dropped without close(), as after a crash
+    del checkpoint
+
+    with open(output_file_str + '.manifest.json') as f:
+        assert sorted(map(tuple, json.load(f)['completed'])) == [(0, 0), (0, 1), (1, 1)]
+    checkpoint = TimepointCheckpoint(output_file_str, SHAPE, {'spacing': 0.27}, RESOLUTION, params)
+    assert checkpoint.is_done(1, 1) and not checkpoint.is_done(1, 0)
+    assert checkpoint.first_missing() == 1
+    assert (checkpoint.out[1, :, 1] == 9).all() and (checkpoint.out[0, :, 0] == 7).all()
+    checkpoint.close()
+    assert tifffile.imread(output_file_str).shape == SHAPE
+
+
+def test_changed_params_start_from_scratch(tmp_path):
+    output_file_str = str(tmp_path / 'out.tif')
+    checkpoint = TimepointCheckpoint(output_file_str, SHAPE, {}, RESOLUTION, {'niter': 5})
+    checkpoint.write(0, 0, np.ones(SHAPE[1:2] + SHAPE[3:], np.uint16))
+    checkpoint.close()
+
+    checkpoint = TimepointCheckpoint(output_file_str, SHAPE, {}, RESOLUTION, {'niter': 6})
+    assert not checkpoint.completed and checkpoint.first_missing() == 0
+    assert not checkpoint.out.any()
+    checkpoint.close()
+
+
+def test_resume_after_cancel_matches_uninterrupted_run(tmp_path, monkeypatch):
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('flowdec')
+    from RLDecon import run_decon
+
+    rng = np.random.default_rng(0)
+    data = (rng.poisson(100, size=(8, 8, 16, 16)) + 50).astype(np.uint16)
+    z, y, x = np.mgrid[-2:3, -2:3, -2:3]
+    kernel = np.exp(-(z**2 + y**2 + x**2)/2).astype(np.float32)
+
+    def run(output_file_str, **options):
+        return run_decon.run_5d_decon(str(tmp_path / 'input.tif'), data, {'spacing': 0.27}, [kernel / kernel.sum()],
+                                      RESOLUTION, RESOLUTION, 2.7, 3, 4, 1, output_file_str=output_file_str,
+                                      mode='rfft', pipeline_depth=1, **options)
+
+    expected = tifffile.imread(run(str(tmp_path / 'expected.tif')))
+    cancel_event = threading.Event()
+
+    def progress(done, total):
+        if done == 1:
+            cancel_event.set()
+    output_file_str = str(tmp_path / 'resumed.tif')
+    with pytest.raises(run_decon.DeconvolutionCancelled):
+        run(output_file_str, resume=True, progress=progress, cancel_event=cancel_event)
+    with open(output_file_str + '.manifest.json') as f:
+        finished = len(json.load(f)['completed'])
+    # The writer is at most a few volumes behind the computation, so cancelling stops it early
+    assert 1 <= finished < 8
+
+    calls = []
+    deconvolve = run_decon.deconvolve
+    monkeypatch.setattr(run_decon, 'deconvolve', lambda *args, **kwargs: calls.append(1) or deconvolve(*args, **kwargs))
+    run(output_file_str, resume=True)
+    assert len(calls) == 8 - finished
+    assert np.array_equal(tifffile.imread(output_file_str), expected)
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import scipy.fft
+from scipy import ndimage
+
+from RLDecon.kernels import kernel_to_otf
+from RLDecon.rl import RichardsonLucy, downsample, downsample_kernel
+
+
+def kernel():
+    z, y, x = np.mgrid[-4:5, -10:11, -10:11]
+    kernel = np.exp(-(z**2/4 + y**2/12 + x**2/12)).astype(np.float32)
+    return kernel / kernel.sum()
+
+
+def centroid(array):
+    grid = np.indices(array.shape).reshape(array.ndim, -1)
+    return grid @ array.ravel() / array.sum()
+
+
+@pytest.mark.parametrize('factor', [2, 4])
+def test_coarse_kernel_keeps_its_centre(factor):
+    coarse = downsample_kernel(kernel(), factor)
+    assert all(n % 2 == 1 for n in coarse.shape)
+    assert np.isclose(coarse.sum(), 1)
+    assert np.allclose(centroid(coarse), np.array(coarse.shape) // 2, atol=1e-3), centroid(coarse)
+
+
+def blurred_scene():
+    rng = np.random.default_rng(0)
+    shape = (16, 96, 96)
+    truth = np.zeros(shape, np.float32)
+    truth[4:12, 20:70, 30:80] = 1000
+    truth = ndimage.gaussian_filter(truth, (1, 4, 4)) + 100
+    for z, y, x in rng.integers((2, 8, 8), (14, 88, 88), size=(30, 3)):
+        truth[z, y, x] += 3000
+    blurred = scipy.fft.irfftn(scipy.fft.rfftn(truth) * kernel_to_otf(kernel(), shape), shape)
+    return truth, rng.poisson(np.clip(blurred, 0, None)).astype(np.float32)
+
+
+@pytest.mark.parametrize('factor', [2, 4])
+def test_coarse_start_needs_fewer_full_iterations(factor):
+    truth, data = blurred_scene()
+
+    def error(estimate):
+        return np.linalg.norm(estimate - truth) / np.linalg.norm(truth)
+    single = error(RichardsonLucy(8).deconvolve(data, kernel(), 16))
+    # 8 coarse iterations cost about as much as 2 (factor 2) or 0.5 (factor 4) full ones
+    coarse = error(RichardsonLucy(8, coarse_factor=factor, coarse_iterations=8).deconvolve(data, kernel(), 12))
+    assert coarse <= single, (coarse, single)
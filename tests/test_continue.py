@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import tifffile
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('flowdec')
+
+from RLDecon.checkpoint import SavedEstimate
+from RLDecon.deskew import deskew
+from RLDecon.run_decon import run_5d_decon
+
+RESOLUTION = (9615384, 1000000)
+
+
+def deskewed_stack(timepoints = 2):
+    # Beads on a background, deskewed so that most of each volume is zero wedges
+    rng = np.random.default_rng(0)
+    raw = (rng.random((40, 48, 48)) * 50 + 1000).astype(np.float32)
+    for z, y, x in rng.integers(4, 40, size=(20, 3)):
+        raw[z, y, x] += 2000
+    volume = deskew(raw, 2.0, order=0).astype(np.uint16)
+    return np.stack([volume] * timepoints)
+
+
+def gaussian_kernel():
+    z, y, x = np.mgrid[-3:4, -3:4, -3:4]
+    kernel = np.exp(-(z**2/4 + y**2/2 + x**2/2)).astype(np.float32)
+    return kernel / kernel.sum()
+
+
+def run(data, tmp_path, name, niter, **options):
+    return run_5d_decon(str(tmp_path / 'input.tif'), data, {'spacing': 0.27}, [gaussian_kernel()], RESOLUTION, RESOLUTION,
+                        2.7, niter, 4, 1, output_file_str=str(tmp_path / name), mode='rfft', **options)
+
+
+@pytest.mark.parametrize('autocrop', [False, True])
+def test_continue_matches_longer_run(tmp_path, autocrop):
+    data = deskewed_stack()
+    full = run(data, tmp_path, 'full.tif', 10, autocrop=autocrop)
+    first = run(data, tmp_path, 'first.tif', 4, autocrop=autocrop, save_estimate=True)
+    continued = run(data, tmp_path, 'continued.tif', 6, autocrop=autocrop, continue_from=first, save_estimate=True)
+    assert SavedEstimate.load(continued).niter == 10
+
+    full, continued = tifffile.imread(full).astype(float), tifffile.imread(continued).astype(float)
+    assert np.isfinite(continued).all()
+    assert continued.max() < 65535
+    # Restarting re-pads the borders and draws the noise filling the zero wedges afresh, which
+    # barely reaches into the data on this bright background
+    inside = data[0] > 0
+    assert np.linalg.norm((continued - full)[:, inside]) / np.linalg.norm(full[:, inside]) < 0.02
+
+
+def test_continue_rejects_other_volumes(tmp_path):
+    data = deskewed_stack()
+    first = run(data, tmp_path, 'first.tif', 2, save_estimate=True)
+    with pytest.raises(ValueError):
+        run(data, tmp_path, 'other.tif', 2, continue_from=first, timepoints=[0])
+    with pytest.raises(ValueError):
+        run_5d_decon(str(tmp_path / 'input.tif'), data, {'spacing': 0.27}, [gaussian_kernel()], RESOLUTION, RESOLUTION,
+                     2.7, 2, 4, 1, output_file_str=str(tmp_path / 'flowdec.tif'), mode='rl', continue_from=first)
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+import tifffile
+
+from RLDecon.deskew import deskew, deskew_geometry, deskewed_shape, get_skewed_kernel, shear_covariance
+
+RESOLUTION = (9615384, 1000000)
+
+
+def moments(array):
+    grid = np.indices(array.shape).reshape(array.ndim, -1).astype(np.float64)
+    weights = array.ravel() / array.sum()
+    centred = grid - grid @ weights[:, None]
+    return (centred * weights) @ centred.T
+
+
+def test_geometry():
+    z_spacing, shift = deskew_geometry(4.0, 0.1, angle=30)
+    assert np.isclose(z_spacing, 4.0 * np.cos(np.pi / 6))
+    assert np.isclose(shift, 0.4 * 0.5 / 0.1)
+
+
+@pytest.mark.parametrize('shift', [1.5, -1.5])
+def test_deskew_moves_each_frame_by_the_shift(shift):
+    volume = np.zeros((5, 4, 10), np.float32)
+    volume[:, 2, 3] = 1
+    result = deskew(volume, shift, order=1)
+    assert result.shape == deskewed_shape(volume.shape, shift) == (5, 4, 16)
+    columns = [np.argmax(result[k, 2]) for k in range(5)]
+    # Raw x=3 lands at 3 + shift*k, offset so that every output x is non-negative
+    origin = max(0.0, -shift * 4)
+    assert np.allclose(columns, [np.floor(3 + shift * k + origin + 0.5) for k in range(5)], atol=1)
+    assert np.isclose(result.sum(), volume.sum())
+    assert result[0, 2, -1] == 0 if shift > 0 else result[-1, 2, -1] == 0
+
+
+def test_shear_covariance_matches_a_sheared_gaussian():
+    cov = np.array([[9.0, 0.0, 1.0], [0.0, 2.0, 0.0], [1.0, 0.0, 3.0]])
+    shift = 0.8
+    raw_cov = shear_covariance(cov, shift)
+    shear = np.array([[1, 0, 0], [0, 1, 0], [shift, 0, 1]])
+    assert np.allclose(shear @ raw_cov @ shear.T, cov)
+
+    # Sample the deskewed-frame Gaussian at the deskewed positions of raw voxels
+    shape = (41, 21, 61)
+    raw = np.indices(shape).reshape(3, -1).astype(np.float64) - (np.array(shape)[:, None] // 2)
+    deskewed = shear @ raw
+    values = np.exp(-0.5 * np.einsum('an,ab,bn->n', deskewed, np.linalg.inv(cov), deskewed)).reshape(shape)
+    assert np.allclose(moments(values), raw_cov, atol=1e-3)
+
+
+def test_skewed_kernel_is_normalised_and_grows_with_the_shear():
+    psf = np.array([[2.4, 0, 0], [0, 1.9, 0], [0, 0, 13.1]])
+    straight = get_skewed_kernel(psf, 1.5, 0.0)
+    sheared = get_skewed_kernel(psf, 1.5, 2.0)
+    for kernel in (straight, sheared):
+        assert kernel.dtype == np.float32 and np.isclose(kernel.sum(), 1)
+        assert all(n % 2 == 1 for n in kernel.shape)
+    assert sheared.shape[2] > straight.shape[2]
+    # Along x the sheared kernel drifts with z, in the raw frame it runs against the shift
+    top, bottom = sheared[sheared.shape[0] // 2 - 2], sheared[sheared.shape[0] // 2 + 2]
+    assert np.argmax(top.sum(axis=0)) > np.argmax(bottom.sum(axis=0))
+
+
+def test_fused_run_writes_the_deskewed_volume(tmp_path):
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('flowdec')
+    from RLDecon.run_decon import run_5d_decon
+
+    # Kernels are at least 25^3, so the padded volume must be too
+    raw = np.full((1, 24, 24, 48), 100, np.uint16)
+    raw[0, 12, 12, 16] = 5000
+    psf = np.array([[2.4, 0, 0], [0, 1.9, 0], [0, 0, 13.1]])
+    output_file_str = run_5d_decon(str(tmp_path / 'raw.tif'), raw, {'spacing': 0.27}, [psf], RESOLUTION, RESOLUTION,
+                                   2.7, 3, 4, 1, output_file_str=str(tmp_path / 'out.tif'), mode='rfft',
+                                   deskew_angle=57.2)
+    z_spacing, shift = deskew_geometry(2.7, RESOLUTION[1] / RESOLUTION[0], 57.2)
+    with tifffile.TiffFile(output_file_str) as tif:
+        result = tif.asarray()
+        assert np.isclose(tif.imagej_metadata['spacing'], z_spacing / 10)
+    assert result.shape == deskewed_shape(raw.shape[1:], shift)
+    # The bead is deconvolved where deskewing puts it
+    assert np.unravel_index(np.argmax(result), result.shape)[:2] == (12, 12)
+    assert abs(np.argmax(result[12, 12]) - (16 + 12 * shift)) <= 1
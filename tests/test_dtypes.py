@@ -0,0 +1,182 @@
+import os
+import sys
+import threading
+
+import numpy as np
+import pytest
+import scipy.fft
+import tifffile
+from scipy import ndimage
+
+from RLDecon.rl import RichardsonLucy
+from RLDecon.wiener import WienerDeconvolver
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Modules whose frames are inspected line by line
+WATCHED = {os.path.join(ROOT, *path) for path in (('RLDecon', 'rl.py'), ('RLDecon', 'wiener.py'), ('RLDecon', 'kernels.py'),
+                                                   ('RLDecon', 'run_decon.py'), ('ScottRLDecon', 'rlgc.py'))}
+WATCHED = {os.path.normcase(os.path.abspath(f)) for f in WATCHED}
+
+# Array constructors whose results are checked. Ufuncs cannot be swapped for functions (numpy's
+# reductions call their methods), their results are caught by the line tracing
+CREATORS = ['empty', 'zeros', 'ones', 'full', 'array', 'asarray', 'ascontiguousarray', 'empty_like', 'zeros_like',
+            'ones_like', 'full_like', 'pad', 'gradient', 'stack', 'concatenate', 'copy', 'flip', 'roll']
+
+# Small parameter arrays (covariances, frequency vectors) may be double; volumes may not
+MIN_SIZE = 1000
+
+
+class WideArrays(list):
+    """
+    Record every float64 or complex128 array of at least MIN_SIZE elements that is created
+    while the context is active.
+
+    Array constructors and the FFTs and filters of numpy, scipy and (if given) cupy are wrapped
+    so their results are checked, and the frames of the engine modules are traced line by line
+    on every thread, so named temporaries and buffers (ratios, TV terms, upsampled starts,
+    iteration stacks) are checked as well. Arrays a traced function was given are the caller's
+    business and are not recorded.
+    """
+    def __init__(self, xp_modules = ()):
+        super().__init__()
+        self.monkeypatch = pytest.MonkeyPatch()
+        self.modules = [(np, CREATORS), (scipy.fft, ['rfftn', 'irfftn', 'fftn', 'ifftn']),
+                        (ndimage, ['zoom', 'uniform_filter', 'gaussian_filter', 'shift', 'fourier_shift'])]
+        for xp in xp_modules:
+            self.modules += [(xp, CREATORS), (xp.fft, ['rfftn', 'irfftn', 'fftn', 'ifftn'])]
+
+    def check(self, where, value):
+        dtype, size = getattr(value, 'dtype', None), getattr(value, 'size', 0)
+        if dtype in (np.float64, np.complex128) and isinstance(size, int) and size >= MIN_SIZE:
+            self.append((where, str(dtype), getattr(value, 'shape', None)))
+
+    def wrap(self, module, name):
+        function = getattr(module, name)
+
+        def wrapped(*args, **kwargs):
+            result = function(*args, **kwargs)
+            self.check(f'{module.__name__}.{name}', result)
+            return result
+        self.monkeypatch.setattr(module, name, wrapped)
+
+    def trace(self, frame, event, arg):
+        if os.path.normcase(os.path.abspath(frame.f_code.co_filename)) not in WATCHED:
+            return None
+        given = {id(v) for v in frame.f_locals.values()}
+
+        def local(frame, event, arg):
+            where = f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}'
+            for name, value in frame.f_locals.items():
+                if id(value) not in given:
+                    self.check(f'{where} {name}', value)
+            if event == 'return' and id(arg) not in given:
+                self.check(f'{where} return', arg)
+            return local
+        return local
+
+    def __enter__(self):
+        for module, names in self.modules:
+            for name in names:
+                if hasattr(module, name):
+                    self.wrap(module, name)
+        threading.settrace(self.trace)
+        sys.settrace(self.trace)
+        return self
+
+    def __exit__(self, *exc):
+        sys.settrace(None)
+        threading.settrace(None)
+        self.monkeypatch.undo()
+
+
+def volume(dtype):
+    rng = np.random.default_rng(0)
+    data = rng.poisson(100, size=(12, 40, 40)).astype(dtype)
+    data[4:8, 15:25, 15:25] += 1000
+    return data
+
+
+def kernel():
+    z, y, x = np.mgrid[-2:3, -3:4, -3:4]
+    kernel = np.exp(-(z**2/2 + y**2/3 + x**2/3)).astype(np.float32)
+    return kernel / kernel.sum()
+
+
+def test_watch_catches_double_temporaries(monkeypatch):
+    # A double floor makes every ratio between the FFTs float64, which must not go unnoticed
+    from RLDecon import rl
+    monkeypatch.setattr(rl, 'EPSILON', np.full(1, rl.EPSILON))
+    with WideArrays() as wide:
+        RichardsonLucy(4).deconvolve(volume(np.float32), kernel(), 2)
+    assert any(where.endswith('iterate ratio') for where, _, _ in wide), wide[:10]
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.uint16])
+@pytest.mark.parametrize('options', [{}, {'regularization': 0.002, 'cutoff': 0.8}, {'coarse_factor': 2},
+                                     {'coarse_factor': 4, 'regularization': 0.002}])
+def test_rl_stays_single_precision(dtype, options):
+    data = volume(dtype)
+    with WideArrays() as wide:
+        result = RichardsonLucy(4, **options).deconvolve(data, kernel(), 4)
+    assert result.dtype == np.float32
+    assert not wide, wide[:10]
+
+
+def test_rl_continue_stays_single_precision():
+    start = volume(np.float64)
+    data = volume(np.uint16)
+    with WideArrays() as wide:
+        result = RichardsonLucy(4).deconvolve(data, kernel(), 2, start=start)
+    assert result.dtype == np.float32
+    assert not wide, wide[:10]
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.uint16])
+def test_wiener_stays_single_precision(dtype):
+    data = volume(dtype)
+    with WideArrays() as wide:
+        result = WienerDeconvolver(4).deconvolve(data, kernel())
+    assert result.dtype == np.float32
+    assert not wide, wide[:10]
+
+
+def test_run_decon_stays_single_precision(monkeypatch, tmp_path):
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('flowdec')
+    from RLDecon import run_decon
+
+    written = {}
+    monkeypatch.setattr(run_decon, 'write_output', lambda output, res, *args, **kwargs: written.update(dtype=res.dtype))
+    data = volume(np.uint16)[None]
+    resolution = (9615384, 1000000)
+
+    def run(precise, **options):
+        run_decon.run_5d_decon(str(tmp_path / 'input.tif'), data, {'spacing': 0.27}, [kernel()], resolution, resolution,
+                               2.7, 3, 4, 1, output_file_str=str(tmp_path / 'out.tif'), precise=precise, **options)
+
+    for options in ({'mode': 'rfft'}, {'mode': 'rfft', 'coarse_factor': 2}, {'mode': 'preview'}):
+        with WideArrays() as wide:
+            filled = run_decon.fill_zeros(volume(np.float32))
+            run(False, **options)
+        assert filled.dtype == np.float32
+        assert written['dtype'] == np.float32
+        assert not wide, (options, wide[:10])
+    run(True, mode='rfft')
+    assert written['dtype'] == np.float64
+
+
+def test_rlgc_stays_single_precision(monkeypatch, tmp_path):
+    cp = pytest.importorskip('cupy')
+    from ScottRLDecon import rlgc
+
+    tifffile.imwrite(str(tmp_path / 'input.tif'), volume(np.uint16))
+    outputs = {name: str(tmp_path / f'{name}.tif') for name in ('output', 'rl_output', 'iters_output',
+                                                                 'rl_iters_output', 'updates_output')}
+    argv = ['rlgc.py', '--input', str(tmp_path / 'input.tif'), '--psf', os.path.join(ROOT, 'PSFs', '488PSF_sigma.csv'),
+            '--max_iters', '3', '--limit', '0', *[a for name, f in outputs.items() for a in (f'--{name}', f)]]
+    monkeypatch.setattr(sys, 'argv', argv)
+    with WideArrays([cp]) as wide:
+        rlgc.main()
+    assert not wide, wide[:10]
+    assert all(tifffile.imread(f).dtype == np.float32 for f in outputs.values())
@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+import tifffile
+
+from RLDecon import index
+from RLDecon.index import header_mdata, index_files, scan_folder
+from RLDecon.utils import read_image
+
+RESOLUTION = (9615384, 1000000)
+
+
+def write_stack(file_str, timepoints):
+    tifffile.imwrite(file_str, np.zeros((timepoints, 4, 8, 8), np.uint16), imagej=True,
+                     metadata={'spacing': 0.27, 'axes': 'TZYX'}, resolution=RESOLUTION)
+
+
+def test_scan_rereads_only_changed_files(tmp_path, monkeypatch):
+    files = [str(tmp_path / f'stack{k}.tif') for k in range(3)]
+    for file_str in files:
+        write_stack(file_str, 2)
+    first = scan_folder(str(tmp_path))
+    assert sorted(first) == files and all(first[f]['shape'] == [2, 4, 8, 8] for f in files)
+
+    write_stack(files[1], 3)
+    stat = os.stat(files[1])
+    os.utime(files[1], (stat.st_atime, stat.st_mtime + 10))
+    read = []
+    read_header = index.read_header
+    monkeypatch.setattr(index, 'read_header', lambda file_str: read.append(file_str) or read_header(file_str))
+    second = scan_folder(str(tmp_path))
+    assert read == [files[1]]
+    assert second[files[1]]['shape'] == [3, 4, 8, 8] and second[files[1]]['frames'] == 3
+    assert second[files[0]] == first[files[0]]
+
+
+def test_index_files_gives_what_the_file_says(tmp_path):
+    file_str = str(tmp_path / 'stack.tif')
+    write_stack(file_str, 2)
+    header = index_files([file_str])[file_str]
+    dat, mdata, x_res, y_res = read_image(file_str)
+    assert tuple(header['shape']) == dat.shape
+    assert tuple(header['x_res']) == x_res and tuple(header['y_res']) == y_res
+    assert {k: header_mdata(header)[k] for k in ('slices', 'frames', 'spacing')} == \
+           {k: mdata[k] for k in ('slices', 'frames', 'spacing')}
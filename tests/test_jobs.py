@@ -0,0 +1,112 @@
+import threading
+
+import pytest
+
+pytest.importorskip('tkinter')
+
+from RLDecon import deconvolvers, jobs
+from RLDecon.jobs import Job, JobRunner, format_seconds
+
+
+@pytest.fixture
+def run_decon():
+    # The worker imports run_decon, and with it TensorFlow, for DeconvolutionCancelled
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('flowdec')
+    from RLDecon import run_decon
+    return run_decon
+
+
+def test_eta_ignores_volumes_skipped_on_resume(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(jobs.time, 'perf_counter', lambda: now[0])
+    job = Job('resumed.tif')
+    job.started = now[0]
+    assert job.eta() is None
+    # Four volumes were already done; the first report follows the fifth, 10 s after the start
+    now[0] = 110.0
+    job.update(5, 10)
+    assert job.eta() == pytest.approx(50.0)
+    now[0] = 120.0
+    job.update(6, 10)
+    assert job.eta() == pytest.approx(40.0)
+
+
+def test_format_seconds():
+    assert format_seconds(None) == '--:--'
+    assert format_seconds(75.4) == '1:15'
+    assert format_seconds(3725) == '1:02:05'
+
+
+def test_jobs_report_their_states(run_decon):
+    runner = JobRunner()
+    release = threading.Event()
+
+    def work(progress, cancel_event, total = 3):
+        release.wait(10)
+        for done in range(1, total + 1):
+            if cancel_event.is_set():
+                raise run_decon.DeconvolutionCancelled()
+            progress(done, total)
+
+    def fail(progress, cancel_event):
+        raise RuntimeError('no PSF')
+
+    finished = runner.submit('finished.tif', work)
+    failed = runner.submit('failed.tif', fail)
+    cancelled = runner.submit('cancelled.tif', work)
+    assert runner.busy()
+    cancelled.cancel_event.set()
+    release.set()
+    for job in (finished, failed, cancelled):
+        job.future.result(10)
+    runner.shutdown()
+
+    assert (finished.state, finished.done, finished.total) == ('finished', 3, 3)
+    assert failed.state == 'failed' and isinstance(failed.error, RuntimeError)
+    assert cancelled.state == 'cancelled' and cancelled.done == 0
+    assert not runner.busy()
+    events = []
+    while not runner.events.empty():
+        events.append(runner.events.get())
+    assert events.count(finished) >= 3 + 2
+
+
+def test_cancel_stops_running_job_between_volumes(run_decon):
+    runner = JobRunner()
+    started = threading.Event()
+
+    def work(progress, cancel_event):
+        for done in range(1, 100):
+            started.set()
+            if cancel_event.wait(0.01):
+                raise run_decon.DeconvolutionCancelled()
+            progress(done, 100)
+
+    job = runner.submit('long.tif', work)
+    assert started.wait(10)
+    runner.cancel_all()
+    job.future.result(10)
+    runner.shutdown()
+    assert job.state == 'cancelled' and job.done < 99
+
+
+def test_shutdown_releases_pool_after_running_job(run_decon):
+    started, release = threading.Event(), threading.Event()
+
+    def job(progress, cancel_event):
+        deconvolvers.get_deconvolver('preview', pad_amount=4)
+        started.set()
+        release.wait(10)
+
+    runner = JobRunner()
+    submitted = runner.submit('job', job)
+    assert started.wait(10)
+    runner.shutdown()
+    # The running job keeps its deconvolver until it stops
+    assert deconvolvers._pool
+    release.set()
+    submitted.future.result(10)
+    runner.executor.shutdown(wait=True)
+    assert not deconvolvers._pool
+    assert submitted.cancel_event.is_set()
@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+import scipy.fft
+from scipy import ndimage
+
+from RLDecon.kernels import KernelCache, gaussian_otf, get_kernel, kernel_to_otf, voxel_covariance
+
+PSF = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PSFs', '488PSF_sigma.csv')
+
+
+def filtered_kernel(psf, z_spacing):
+    # The kernel run_decon built before kernels.py: a 25^3 impulse blurred with the diagonal sigmas
+    kernel = np.zeros((25, 25, 25))
+    kernel[12, 12, 12] = 1
+    return ndimage.gaussian_filter(kernel, sigma=[np.sqrt(psf[2, 2])/z_spacing, np.sqrt(psf[0, 0]), np.sqrt(psf[1, 1])])
+
+
+def test_diagonal_kernel_matches_gaussian_filter():
+    psf = np.diag(np.diag(np.loadtxt(PSF, delimiter=',')))
+    kernel = get_kernel(psf, 2.7)
+    assert kernel.shape == (25, 25, 25) and kernel.dtype == np.float32
+    assert np.isclose(kernel.sum(), 1, atol=1e-5)
+    assert np.abs(kernel - filtered_kernel(psf, 2.7)).max() < 1e-5
+
+
+def test_otf_keeps_the_full_covariance():
+    cov = np.array([[4.0, 0.0, 1.5], [0.0, 2.0, 0.0], [1.5, 0.0, 3.0]])
+    shape = (32, 32, 32)
+    otf = gaussian_otf(cov, shape)
+    assert otf.dtype == np.float32 and otf.shape == (32, 32, 17)
+    assert np.isclose(otf[0, 0, 0], 1)
+
+    # Second moments of the real-space kernel give back the covariance, off-diagonal terms included
+    kernel = np.fft.fftshift(scipy.fft.irfftn(otf, shape)).astype(np.float64)
+    grid = np.indices(shape).reshape(3, -1) - 16
+    moments = (grid * kernel.ravel()) @ grid.T
+    assert np.allclose(moments, cov, atol=1e-3)
+
+
+def test_voxel_covariance_scales_z():
+    psf = np.loadtxt(PSF, delimiter=',')
+    cov = voxel_covariance(psf, 2.0)
+    assert np.isclose(cov[0, 0], psf[2, 2] / 4) and np.isclose(cov[1, 1], psf[0, 0])
+    assert np.isclose(cov[0, 1], psf[2, 0] / 2) and np.allclose(cov, cov.T)
+
+
+def test_kernel_to_otf_matches_analytic_otf():
+    cov = voxel_covariance(np.loadtxt(PSF, delimiter=','), 2.7)
+    shape = (40, 48, 48)
+    otf = kernel_to_otf(get_kernel(np.loadtxt(PSF, delimiter=','), 2.7), shape)
+    assert otf.dtype == np.complex64
+    # The kernel box truncates the Gaussian at 4 sigma, so the spectra agree to that precision
+    assert np.abs(otf - gaussian_otf(cov, shape)).max() < 2e-4
+
+
+def test_kernel_cache_keeps_the_most_recent_shapes():
+    cache = KernelCache(size=2)
+    kernel = np.ones((3, 3, 3))
+    calls = []
+
+    def make(shape):
+        return lambda: calls.append(shape) or shape
+    for shape in [(8, 8, 8), (9, 9, 9), (8, 8, 8), (10, 10, 10), (8, 8, 8), (9, 9, 9)]:
+        assert cache.get(kernel, shape, make(shape)) == shape
+    assert calls == [(8, 8, 8), (9, 9, 9), (10, 10, 10), (9, 9, 9)]
+    assert len(cache) == 2
@@ -0,0 +1,80 @@
+import threading
+import time
+
+import pytest
+
+from RLDecon.pipeline import run_pipelined
+
+
+def test_stages_run_in_order_on_their_threads():
+    threads, written = {}, []
+
+    def read(item):
+        threads.setdefault('read', set()).add(threading.current_thread().name)
+        return item * 10
+
+    def compute(item, data):
+        threads.setdefault('compute', set()).add(threading.current_thread().name)
+        return data + 1
+
+    def write(item, result):
+        threads.setdefault('write', set()).add(threading.current_thread().name)
+        written.append((item, result))
+
+    run_pipelined(range(20), read, compute, write, depth=2)
+    assert written == [(i, i * 10 + 1) for i in range(20)]
+    assert threads == {'read': {'rldecon-read'}, 'compute': {threading.current_thread().name},
+                       'write': {'rldecon-write'}}
+
+
+@pytest.mark.parametrize('depth', [1, 3])
+def test_reader_stays_within_depth(depth):
+    reads, ahead = [], []
+
+    def compute(item, data):
+        ahead.append(len(reads) - item)
+        time.sleep(0.002)
+        return data
+
+    run_pipelined(range(30), reads.append, compute, lambda item, result: None, depth=depth)
+    # Besides the queue, one item can be held by the reader and one is being computed
+    assert max(ahead) <= depth + 2
+
+
+def test_stages_overlap():
+    def stage(*args):
+        time.sleep(0.05)
+
+    start = time.perf_counter()
+    run_pipelined(range(8), stage, stage, stage, depth=2)
+    # Run one after the other the stages would take 8 * 0.15 s
+    assert time.perf_counter() - start < 0.75
+
+
+def test_computed_results_are_written_before_compute_error():
+    written = []
+
+    def compute(item, data):
+        if item == 3:
+            raise KeyboardInterrupt
+        return item
+
+    with pytest.raises(KeyboardInterrupt):
+        run_pipelined(range(10), lambda item: item, compute, lambda item, result: written.append(item), depth=2)
+    assert written == [0, 1, 2]
+
+
+@pytest.mark.parametrize('stage', ['read', 'write'])
+def test_errors_in_other_stages_are_raised(stage):
+    calls = []
+
+    def fail_at_4(item, *args):
+        calls.append(item)
+        if item == 4:
+            raise OSError(stage)
+        return item
+
+    stages = {'read': lambda item: item, 'write': lambda item, result: None, stage: fail_at_4}
+    with pytest.raises(OSError, match=stage):
+        run_pipelined(range(1000), stages['read'], lambda item, data: data, stages['write'], depth=2)
+    assert max(calls) < 20
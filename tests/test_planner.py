@@ -0,0 +1,138 @@
+import numpy as np
+import pytest
+
+from RLDecon import planner
+from RLDecon.planner import MAX_PIPELINE_DEPTH, MIN_TILE, estimate_memory, plan_run
+
+VOLUME = (100, 2048, 2048)
+
+
+@pytest.fixture(autouse=True)
+def no_gpu(monkeypatch):
+    # Plans must not depend on the machine the tests run on
+    monkeypatch.setattr(planner, 'gpu_memory_mb', lambda: None)
+    monkeypatch.setattr(planner, 'available_memory_mb', lambda: None)
+
+
+def test_estimate_scales_with_volumes_and_tiles():
+    one = estimate_memory(VOLUME, 1, mode='preview')
+    ten = estimate_memory(VOLUME, 10, mode='preview')
+    assert np.isclose(ten['input'], 10 * one['input']) and np.isclose(ten['output'], 10 * one['output'])
+    assert ten['engine'] == one['engine']
+    tiled = estimate_memory(VOLUME, 1, mode='preview', tile_shape=(512, 512))
+    assert tiled['engine'] < one['engine'] / 10
+    resumable = estimate_memory(VOLUME, 10, mode='preview', resume=True)
+    assert resumable['output'] == resumable['write'] == 0
+
+
+def test_tiles_are_halved_until_the_engine_fits():
+    whole = estimate_memory(VOLUME, 1, mode='rfft', pipeline_depth=1)
+    budget = whole['host'] + whole['engine'] / 5
+    plan = plan_run(VOLUME, 1, mode='rfft', memory_budget=budget)
+    assert plan['fits'] and plan['engine_on_host']
+    # Halved along the longer side in turn: 2048 x 2048 -> 1024 x 2048 -> 1024 x 1024 -> ...
+    assert all(2048 % n == 0 and n >= MIN_TILE for n in plan['tile_shape'])
+    assert abs(np.log2(plan['tile_shape'][0]) - np.log2(plan['tile_shape'][1])) <= 1
+    larger = tuple(2*n for n in plan['tile_shape'])
+    assert plan['estimate']['host'] + plan['estimate']['engine'] <= budget
+    assert estimate_memory(VOLUME, 1, mode='rfft', pipeline_depth=1, tile_shape=larger)['engine'] > budget - whole['host']
+
+
+def test_pipeline_depth_fills_the_budget():
+    assert plan_run(VOLUME, 4, mode='preview', memory_budget=1e9)['pipeline_depth'] == MAX_PIPELINE_DEPTH
+    depth2 = estimate_memory(VOLUME, 4, mode='preview', pipeline_depth=2)
+    plan = plan_run(VOLUME, 4, mode='preview', memory_budget=depth2['host'] + depth2['engine'] + 1)
+    assert plan['pipeline_depth'] == 2 and plan['tile_shape'] is None
+    # Without a budget the default depth is kept, and a given depth is reported as is
+    assert plan_run(VOLUME, 4, mode='preview', memory_budget=None)['pipeline_depth'] == 2
+    assert plan_run(VOLUME, 4, mode='preview', memory_budget=1e9, pipeline_depth=1)['pipeline_depth'] == 1
+
+
+def test_workers_are_capped_by_memory():
+    one = plan_run(VOLUME, 1, mode='preview', memory_budget=1e9, pipeline_depth=1)
+    per_run = one['estimate']['host'] + one['estimate']['engine']
+    plan = plan_run(VOLUME, 1, mode='preview', memory_budget=3.5 * per_run, pipeline_depth=1, workers=8)
+    assert plan['workers'] == 3
+    assert plan_run(VOLUME, 1, mode='preview', memory_budget=1e9, pipeline_depth=1, workers=8)['workers'] == 8
+
+
+def test_engine_goes_where_the_backend_runs(monkeypatch):
+    queries = []
+    monkeypatch.setattr(planner, 'gpu_memory_mb', lambda: queries.append(1) or 8000.0)
+    assert plan_run(VOLUME, 1, mode='rfft', backend='numpy', memory_budget=1e6)['engine_on_host']
+    assert plan_run(VOLUME, 1, mode='preview', memory_budget=1e6)['engine_on_host']
+    assert not queries
+    cupy = plan_run(VOLUME, 1, mode='rfft', backend='cupy', memory_budget=1e6)
+    assert not cupy['engine_on_host'] and cupy['device_budget'] == 8000.0
+    # Sized for the device: the engine is tiled to fit in 8 GB although the host has plenty
+    assert cupy['tile_shape'] is not None and cupy['estimate']['engine'] <= 8000.0
+    assert not plan_run(VOLUME, 1, mode='rl', device_budget=4000.0, memory_budget=1e6)['engine_on_host']
+    assert len(queries) == 1
+
+
+def test_gpu_query_runs_once_per_process(monkeypatch):
+    calls = []
+
+    class Completed:
+        stdout = '1234\n'
+    monkeypatch.undo()
+    planner.gpu_memory_mb.cache_clear()
+    monkeypatch.setattr(planner.subprocess, 'run', lambda *args, **kwargs: calls.append(args) or Completed())
+    try:
+        assert planner.gpu_memory_mb() == 1234.0
+        assert planner.gpu_memory_mb() == 1234.0
+        assert len(calls) == 1
+    finally:
+        planner.gpu_memory_mb.cache_clear()
+
+
+def test_nothing_fits_a_tiny_budget():
+    plan = plan_run(VOLUME, 1, mode='preview', memory_budget=10)
+    assert not plan['fits'] and max(plan['tile_shape']) == MIN_TILE
+
+
+def test_run_decon_raises_memory_error(tmp_path):
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('flowdec')
+    from RLDecon.run_decon import run_5d_decon
+
+    kernel = np.ones((3, 3, 3), np.float32) / 27
+    resolution = (9615384, 1000000)
+    with pytest.raises(MemoryError):
+        run_5d_decon(str(tmp_path / 'input.tif'), np.ones((2, 16, 64, 64), np.uint16), {'spacing': 0.27}, [kernel],
+                     resolution, resolution, 2.7, 2, 4, 1, mode='preview', memory_budget=0.01)
+    assert not list(tmp_path.iterdir())
+
+
+def test_tiles_cover_the_volume_once():
+    from RLDecon.roi import iter_tiles
+    covered = np.zeros((4, 50, 70), int)
+    for tile, block, crop in iter_tiles(covered.shape, (16, 32), (2, 3, 3)):
+        covered[tile] += 1
+        assert all(b.start <= t.start and t.stop <= b.stop for t, b in zip(tile, block))
+        assert [(b.start + c.start, b.start + c.stop) for b, c in zip(block, crop)] == [(t.start, t.stop) for t in tile]
+    assert (covered == 1).all()
+
+
+def test_tiled_run_matches_whole_volumes(tmp_path):
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('flowdec')
+    import tifffile
+    from RLDecon.run_decon import run_5d_decon
+
+    rng = np.random.default_rng(0)
+    data = (rng.random((1, 12, 48, 48)) * 50 + 1000).astype(np.uint16)
+    for z, y, x in rng.integers(2, 46, size=(20, 3)) // [4, 1, 1]:
+        data[0, z, y, x] += 2000
+    z, y, x = np.mgrid[-2:3, -2:3, -2:3]
+    kernel = np.exp(-(z**2 + y**2 + x**2)/2).astype(np.float32)
+    resolution = (9615384, 1000000)
+    results = []
+    for tile_shape in (None, (16, 24)):
+        output_file_str = run_5d_decon(str(tmp_path / 'input.tif'), data, {'spacing': 0.27}, [kernel / kernel.sum()],
+                                       resolution, resolution, 2.7, 3, 4, 1, mode='rfft', tile_shape=tile_shape,
+                                       output_file_str=str(tmp_path / f'tiles{tile_shape is not None}.tif'))
+        results.append(tifffile.imread(output_file_str).astype(float))
+    whole, tiled = results
+    # Each tile sees the kernel half-width of context, so the seams only differ slightly
+    assert np.linalg.norm(tiled - whole) / np.linalg.norm(whole) < 0.002
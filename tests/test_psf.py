@@ -0,0 +1,33 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+import tifffile
+
+from RLDecon.psf import prepare_psf
+
+PSF_FILES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PSFs', '*.tif')))
+
+
+@pytest.mark.parametrize('psf_file', PSF_FILES, ids=os.path.basename)
+def test_prepare_psf_crops_shipped_psfs(psf_file):
+    raw = tifffile.imread(psf_file)
+    psf = prepare_psf(raw)
+    assert psf.dtype == np.float32
+    assert all(n % 2 == 1 for n in psf.shape)
+    assert np.isclose(psf.sum(), 1, atol=1e-4)
+    # The bead PSFs span a few microns; scattered noise above the floor must not grow the box to the stack
+    assert psf.shape[0] <= 65 and max(psf.shape[1:]) <= 41, psf.shape
+    assert np.prod(psf.shape) < np.prod(raw.shape) / 10
+    # Centred on the middle voxel
+    peak = np.unravel_index(np.argmax(psf), psf.shape)
+    assert all(abs(p - n // 2) <= 2 for p, n in zip(peak, psf.shape)), peak
+
+
+@pytest.mark.parametrize('psf_file', PSF_FILES[:1], ids=os.path.basename)
+def test_prepare_psf_energy_shrinks_box(psf_file):
+    raw = tifffile.imread(psf_file)
+    small, large = prepare_psf(raw, energy=0.9), prepare_psf(raw, energy=0.99)
+    assert all(s <= l for s, l in zip(small.shape, large.shape))
+    assert np.prod(small.shape) < np.prod(large.shape)
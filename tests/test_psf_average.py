@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import tifffile
+
+from RLDecon.psf_average import average_covariances, average_psfs, load_psfs
+
+SHAPE = (16, 24, 24)
+
+
+def bead(centre):
+    grid = np.indices(SHAPE).astype(np.float64)
+    sigmas = (2.0, 1.5, 1.5)
+    return np.exp(-sum((g - c)**2 / (2 * s**2) for g, c, s in zip(grid, centre, sigmas))).astype(np.float32)
+
+
+def write_beads(tmp_path, centres):
+    files = []
+    for k, centre in enumerate(centres):
+        files.append(str(tmp_path / f'psf{k}.tif'))
+        tifffile.imwrite(files[-1], bead(centre))
+    return files
+
+
+CENTRES = [(8, 12, 12), (8.3, 11.4, 12.7), (7.5, 13.2, 10.9)]
+
+
+def test_registration_recovers_subpixel_shifts(tmp_path):
+    files = write_beads(tmp_path, CENTRES)
+    averaged, shifts = average_psfs(files)
+
+    expected = np.array(CENTRES[:1]) - np.array(CENTRES)
+    assert np.abs(shifts - expected).max() <= 0.05 + 1e-9, shifts
+    assert averaged.dtype == np.float32 and averaged.shape == SHAPE
+    # Every PSF lands on the reference, so the average is the reference bead
+    reference = bead(CENTRES[0])
+    assert np.abs(averaged - reference).max() < 0.01 * reference.max()
+
+
+def test_registration_of_noisy_beads(tmp_path):
+    rng = np.random.default_rng(0)
+    files = write_beads(tmp_path, CENTRES)
+    for psf_file in files:
+        tifffile.imwrite(psf_file, tifffile.imread(psf_file) + rng.normal(0, 0.01, SHAPE).astype(np.float32))
+    _, shifts = average_psfs(files)
+    expected = np.array(CENTRES[:1]) - np.array(CENTRES)
+    assert np.abs(shifts - expected).max() <= 0.1 + 1e-9, shifts
+
+
+def test_weights_favour_their_psf(tmp_path):
+    files = write_beads(tmp_path, [(8, 12, 12), (8, 12, 12)])
+    tifffile.imwrite(files[1], 3 * bead((8, 12, 12)))
+    averaged, _ = average_psfs(files, weights=[1, 3])
+    assert np.allclose(averaged.max(), 2.5, atol=1e-3)
+
+
+def test_psfs_must_share_a_shape(tmp_path):
+    files = write_beads(tmp_path, [(8, 12, 12)])
+    tifffile.imwrite(str(tmp_path / 'small.tif'), np.zeros((8, 8, 8), np.float32))
+    with pytest.raises(ValueError, match='same shape'):
+        load_psfs(files + [str(tmp_path / 'small.tif')])
+
+
+def test_average_covariances(tmp_path):
+    files = []
+    for k, scale in enumerate([1.0, 3.0]):
+        files.append(str(tmp_path / f'cov{k}.csv'))
+        np.savetxt(files[-1], scale * np.eye(3), delimiter=',')
+    assert np.allclose(average_covariances(files), 2 * np.eye(3))
+    assert np.allclose(average_covariances(files, weights=[3, 1]), 1.5 * np.eye(3))
@@ -0,0 +1,136 @@
+import numpy as np
+import pytest
+import tifffile
+
+from RLDecon.deskew import deskew
+from RLDecon.roi import kernel_halo, nonzero_slabs, padded_roi, parse_indices, parse_roi, read_volume
+
+
+@pytest.mark.parametrize('ome', [False, True])
+def test_read_volume_reads_only_its_pages(tmp_path, monkeypatch, ome):
+    data = np.arange(3*4*2*5*6, dtype=np.uint16).reshape(3, 4, 2, 5, 6)
+    file_str = str(tmp_path / ('stack.ome.tif' if ome else 'stack.tif'))
+    tifffile.imwrite(file_str, data, imagej=not ome, ome=ome, metadata={'axes': 'TZCYX'})
+    keys = []
+    asarray = tifffile.TiffFile.asarray
+
+    def recording(self, key = None, **kwargs):
+        keys.append(key)
+        return asarray(self, key=key, **kwargs)
+    monkeypatch.setattr(tifffile.TiffFile, 'asarray', recording)
+    with tifffile.TiffFile(file_str) as tif:
+        volume = read_volume(tif, timepoint=2, channel=1)
+    assert np.array_equal(volume, data[2, :, 1])
+    assert keys == [[2*8 + 2*z + 1 for z in range(4)]]
+
+
+def deskewed_volume(shift = 2.0):
+    rng = np.random.default_rng(0)
+    # Beads on a bright background, like the noise the zero wedges are filled with
+    raw = (rng.random((40, 16, 24)) * 50 + 1000).astype(np.float32)
+    for z, y, x in rng.integers(2, 14, size=(10, 3)) * [3, 1, 1]:
+        raw[z, y, x] += 2000
+    return deskew(raw, shift, order=0)
+
+
+def test_slabs_cover_every_nonzero_voxel():
+    volume = deskewed_volume()
+    halo = (3, 4, 4)
+    slabs = nonzero_slabs(volume, halo)
+    covered = np.zeros(volume.shape, int)
+    for core, block, crop in slabs:
+        covered[core] += 1
+        # The block is the core grown by the halo, clipped to the volume, and crop cuts the core back out
+        for c, b, k, h, n in zip(core, block, crop, halo, volume.shape):
+            assert (b.start, b.stop) == (max(0, c.start - h), min(n, c.stop + h))
+            assert (b.start + k.start, b.start + k.stop) == (c.start, c.stop)
+    assert (covered[volume != 0] == 1).all()
+    assert covered.max() == 1
+
+
+def test_slabs_follow_the_shear():
+    volume = deskewed_volume()
+    slabs = nonzero_slabs(volume, (3, 4, 4))
+    single = nonzero_slabs(volume, (3, 4, 4), max_slabs=1)
+    assert len(single) == 1 and len(slabs) > 1
+    size = lambda slabs: sum(np.prod([s.stop - s.start for s in block]) for _, block, _ in slabs)
+    assert size(slabs) < 0.75 * size(single)
+    # The one bounding box is the whole sheared extent
+    assert single[0][0] == (slice(0, 40), slice(0, 16), slice(0, volume.shape[2]))
+
+
+def test_no_slabs_for_empty_volume():
+    assert nonzero_slabs(np.zeros((4, 8, 8)), (1, 1, 1)) == []
+    volume = np.zeros((4, 8, 8))
+    volume[2, 3, 5] = 1
+    (core, block, crop), = nonzero_slabs(volume, (1, 1, 1))
+    assert core == (slice(2, 3), slice(3, 4), slice(5, 6))
+
+
+def test_autocrop_run_matches_full_run(tmp_path):
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('flowdec')
+    from RLDecon.run_decon import run_5d_decon
+
+    data = deskewed_volume().astype(np.uint16)[None]
+    z, y, x = np.mgrid[-2:3, -2:3, -2:3]
+    kernel = np.exp(-(z**2 + y**2 + x**2)/2).astype(np.float32)
+    resolution = (9615384, 1000000)
+    results = {}
+    for autocrop in (False, True):
+        output_file_str = run_5d_decon(str(tmp_path / 'input.tif'), data, {'spacing': 0.27}, [kernel / kernel.sum()],
+                                       resolution, resolution, 2.7, 3, 4, 1, mode='rfft', autocrop=autocrop,
+                                       output_file_str=str(tmp_path / f'autocrop{autocrop}.tif'))
+        results[autocrop] = tifffile.imread(output_file_str).astype(float).reshape(data.shape)
+    inside = data[0] > 0
+    cores = np.zeros(inside.shape, bool)
+    for core, _, _ in nonzero_slabs(data[0], (2, 2, 2)):
+        cores[core] = True
+    assert (results[True][:, ~cores] == 0).all()
+    # Zero wedges are filled with noise in the full run, so only the data itself is compared
+    difference = np.linalg.norm((results[True] - results[False])[:, inside]) / np.linalg.norm(results[False][:, inside])
+    assert difference < 0.02
+
+
+def test_parse_roi_and_indices():
+    assert parse_roi(':,100:300,5:') == (slice(None, None), slice(100, 300), slice(5, None))
+    with pytest.raises(ValueError):
+        parse_roi('100:300,100:300')
+    with pytest.raises(ValueError):
+        parse_roi(':,1,2:3')
+    assert parse_indices('5,0,10:13,11') == [0, 5, 10, 11, 12]
+
+
+def test_halo_is_clipped_to_the_volume():
+    halo = kernel_halo([(5, 25, 25), (9, 11, 11)])
+    assert halo == (4, 12, 12)
+    block, crop = padded_roi((slice(None), slice(5, 40), slice(100, 120)), halo, (10, 128, 128))
+    assert block == (slice(0, 10), slice(0, 52), slice(88, 128))
+    assert crop == (slice(0, 10), slice(5, 40), slice(12, 32))
+    with pytest.raises(ValueError, match='Empty ROI'):
+        padded_roi((slice(None), slice(50, 50), slice(None)), halo, (10, 128, 128))
+
+
+def test_roi_run_matches_full_run_and_is_named_as_subset(tmp_path):
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('flowdec')
+    from RLDecon.run_decon import run_5d_decon
+
+    rng = np.random.default_rng(0)
+    data = (rng.random((2, 12, 48, 48)) * 50 + 1000).astype(np.uint16)
+    z, y, x = np.mgrid[-2:3, -2:3, -2:3]
+    kernel = np.exp(-(z**2 + y**2 + x**2)/2).astype(np.float32)
+    resolution = (9615384, 1000000)
+
+    def run(**options):
+        return run_5d_decon(str(tmp_path / 'input.tif'), data, {'spacing': 0.27}, [kernel / kernel.sum()], resolution,
+                            resolution, 2.7, 3, 4, 1, mode='rfft', **options)
+    full = tifffile.imread(run())
+    roi = (slice(None), slice(10, 30), slice(20, 44))
+    output_file_str = run(roi=roi, timepoints=[1])
+    assert output_file_str.endswith('_subset.tif')
+    subset = tifffile.imread(output_file_str)
+    assert subset.shape == (12, 20, 24)
+    # The halo gives the ROI the context the full run has, up to the padding at the block edges
+    expected = full[1][roi].astype(float)
+    assert np.linalg.norm(subset - expected) / np.linalg.norm(expected) < 0.002
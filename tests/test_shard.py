@@ -0,0 +1,62 @@
+import glob
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+import tifffile
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('flowdec')
+
+from RLDecon.shard import find_shards, merge_shards
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PSF = os.path.join(ROOT, 'PSFs', '488PSF_sigma.csv')
+RESOLUTION = (9615384, 1000000)
+
+
+def shard(input_file_str, output_dir, spec, *options):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT] + os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+    subprocess.run([sys.executable, '-m', 'RLDecon.shard', 'run', '--input', input_file_str, '--psf', PSF,
+                    '--shard', spec, '--niter', '3', '--pad_amount', '4', '--mode', 'rfft',
+                    '--output_dir', str(output_dir), *options], check=True, env=env)
+    return sorted(glob.glob(os.path.join(str(output_dir), '*.tif')))
+
+
+@pytest.fixture(scope='module')
+def hyperstack(tmp_path_factory):
+    rng = np.random.default_rng(0)
+    data = (rng.random((5, 24, 32, 32)) * 20 + 100).astype(np.uint16)
+    for t, z, y, x in zip(range(5), *rng.integers(3, 21, size=(3, 5))):
+        data[t, z, y, x] += 3000
+    input_file_str = str(tmp_path_factory.mktemp('shard') / 'stack.tif')
+    tifffile.imwrite(input_file_str, data, imagej=True, metadata={'spacing': 0.27, 'axes': 'TZYX'},
+                     resolution=RESOLUTION)
+    return input_file_str
+
+
+def test_shards_in_separate_processes_merge_to_single_run(hyperstack, tmp_path):
+    for index in range(3):
+        parts = shard(hyperstack, tmp_path / 'parts', f'{index}/3')
+    single, = shard(hyperstack, tmp_path / 'single', '0/1', '--over', 'files')
+    output_file_str = single.replace(str(tmp_path / 'single'), str(tmp_path / 'parts'))
+    assert find_shards(output_file_str) == parts and len(parts) == 3
+
+    merge_shards(output_file_str)
+    merged, expected = tifffile.imread(output_file_str), tifffile.imread(single)
+    assert merged.shape == expected.shape == (5, 24, 32, 32)
+    assert np.array_equal(merged, expected)
+
+
+def test_merge_rejects_mismatched_or_missing_shards(hyperstack, tmp_path):
+    for index in range(3):
+        parts = shard(hyperstack, tmp_path / 'parts', f'{index}/3')
+    other = shard(hyperstack, tmp_path / 'other', '2/3', '--pad_amount', '8')
+    output_file_str = str(tmp_path / 'merged.tif')
+    with pytest.raises(ValueError, match='pad_amount'):
+        merge_shards(output_file_str, parts[:2] + other)
+    with pytest.raises(ValueError, match='missing'):
+        merge_shards(output_file_str, parts[:2])
+    assert not os.path.exists(output_file_str)
@@ -0,0 +1,35 @@
+import csv
+import os
+
+import numpy as np
+import pytest
+import tifffile
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('flowdec')
+
+from RLDecon import rl
+from RLDecon.deconvolvers import clear_pool
+from RLDecon.sweep import run_sweep
+
+PSF = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PSFs', '488PSF_sigma.csv')
+
+
+def test_rfft_sweep_builds_each_otf_once(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    data = (rng.random((2, 28, 32, 32)) * 20 + 100).astype(np.uint16)
+    input_file_str = str(tmp_path / 'cell.tif')
+    tifffile.imwrite(input_file_str, data, imagej=True, metadata={'spacing': 0.27, 'axes': 'TZYX'},
+                     resolution=(9615384, 1000000))
+    built = []
+    kernel_to_otf = rl.kernel_to_otf
+    monkeypatch.setattr(rl, 'kernel_to_otf', lambda kernel, shape: built.append(shape) or kernel_to_otf(kernel, shape))
+    clear_pool()
+
+    rows = run_sweep([input_file_str], [[PSF]], [2, 3], [4], output_dir=str(tmp_path), mode='rfft')
+    assert [row['status'] for row in rows] == ['done', 'done']
+    assert all('_rfft_iter' in row['output'] and os.path.exists(row['output']) for row in rows)
+    # Both iteration counts run on the same kernel object and padded shape
+    assert len(built) == 1
+    with open(tmp_path / 'sweep_results.csv') as f:
+        assert [row['mode'] for row in csv.DictReader(f)] == ['rfft', 'rfft']
@@ -0,0 +1,128 @@
+import json
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from RLDecon.telemetry import StackSampler, Telemetry, profile_from_env, profiled
+
+
+def read_lines(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_record_writes_timings_since_previous_record(tmp_path):
+    path = str(tmp_path / 'telemetry.jsonl')
+    telemetry = Telemetry(path)
+    with telemetry.timer('fft'):
+        time.sleep(0.01)
+    with telemetry.timer('fft'):
+        pass
+    telemetry.record('iteration', iteration=np.int64(1), residual=np.float32(0.5))
+    with telemetry.timer('io'):
+        pass
+    telemetry.record('write')
+    telemetry.close()
+
+    first, second = read_lines(path)
+    assert first['event'] == 'iteration' and first['iteration'] == 1 and first['residual'] == 0.5
+    assert set(first['timings']) == {'fft'} and first['timings']['fft'] >= 0.01
+    assert set(second['timings']) == {'io'}
+    assert 'peak_memory_mb' in first
+
+
+def test_timings_are_kept_per_thread(tmp_path):
+    path = str(tmp_path / 'telemetry.jsonl')
+    telemetry = Telemetry(path)
+    with telemetry.timer('elementwise'):
+        pass
+
+    def worker():
+        with telemetry.timer('io'):
+            pass
+        telemetry.record('read')
+    thread = threading.Thread(target=worker)
+    thread.start()
+    thread.join()
+    telemetry.record('timepoint')
+    telemetry.close()
+
+    read, timepoint = read_lines(path)
+    assert set(read['timings']) == {'io'}
+    assert set(timepoint['timings']) == {'elementwise'}
+
+
+def test_disabled_telemetry_writes_nothing(tmp_path, monkeypatch):
+    monkeypatch.delenv('RLDECON_TELEMETRY', raising=False)
+    telemetry = Telemetry.from_env()
+    assert not telemetry.enabled
+    with telemetry.timer('fft'):
+        pass
+    telemetry.record('iteration')
+    telemetry.close()
+    assert not list(tmp_path.iterdir())
+
+
+def test_sampler_sees_other_threads_by_name(tmp_path):
+    stop = threading.Event()
+
+    def busy_loop():
+        while not stop.is_set():
+            sum(range(1000))
+    thread = threading.Thread(target=busy_loop, name='reader')
+    thread.start()
+    sampler = StackSampler(interval=0.001)
+    sampler.start()
+    time.sleep(0.1)
+    sampler.stop()
+    stop.set()
+    thread.join()
+
+    assert any(stack.startswith('reader;') and 'busy_loop' in stack for stack in sampler.samples)
+    output = str(tmp_path / 'stacks.txt')
+    sampler.dump(output)
+    with open(output) as f:
+        stack, count = f.readline().rsplit(' ', 1)
+    assert int(count) == max(sampler.samples.values())
+
+
+def test_profile_modes(tmp_path, monkeypatch):
+    monkeypatch.setenv('RLDECON_PROFILE', 'sample:' + str(tmp_path / 'stacks.txt'))
+    mode, output = profile_from_env()
+    assert mode == 'sample'
+    with profiled(mode, output, interval=0.001):
+        time.sleep(0.02)
+    assert (tmp_path / 'stacks.txt').exists()
+
+    with profiled('cprofile', str(tmp_path / 'run.prof')):
+        sum(range(1000))
+    assert (tmp_path / 'run.prof').stat().st_size > 0
+
+    monkeypatch.setenv('RLDECON_PROFILE', '')
+    assert profile_from_env() == (None, None)
+    with pytest.raises(ValueError):
+        with profiled('perf'):
+            pass
+
+
+def test_run_records_every_timepoint(tmp_path):
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('flowdec')
+    from RLDecon.run_decon import run_5d_decon
+
+    z, y, x = np.mgrid[-2:3, -2:3, -2:3]
+    kernel = np.exp(-(z**2 + y**2 + x**2)/2).astype(np.float32)
+    data = np.random.default_rng(0).poisson(100, size=(2, 8, 16, 16)).astype(np.uint16)
+    path = str(tmp_path / 'telemetry.jsonl')
+    resolution = (9615384, 1000000)
+    run_5d_decon(str(tmp_path / 'input.tif'), data, {'spacing': 0.27}, [kernel / kernel.sum()], resolution, resolution,
+                 2.7, 2, 4, 1, output_file_str=str(tmp_path / 'out.tif'), mode='rfft', telemetry=Telemetry(path))
+
+    lines = read_lines(path)
+    events = [line['event'] for line in lines]
+    assert events[0] == 'plan' and events[-1] == 'write'
+    timepoints = [line for line in lines if line['event'] == 'timepoint']
+    assert sorted(line['timepoint'] for line in timepoints) == [0, 1]
+    assert all('deconvolution' in line['timings'] for line in timepoints)
@@ -0,0 +1,86 @@
+import argparse
+import os
+import subprocess
+import sys
+
+import pytest
+
+from RLDecon import threads
+from RLDecon.threads import THREAD_ENV_VARS, ThreadPolicy, add_thread_arguments, policy_from_args
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+@pytest.fixture(autouse=True)
+def no_policy(monkeypatch):
+    # apply() changes process-wide state; undo it after every test
+    monkeypatch.setattr(threads, '_policy', None)
+    monkeypatch.setattr(threads, 'cpu_count', lambda: 8)
+    environ = dict(os.environ)
+    for var in ['RLDECON_WORKERS', 'RLDECON_THREADS', 'RLDECON_AFFINITY']:
+        os.environ.pop(var, None)
+    yield
+    os.environ.clear()
+    os.environ.update(environ)
+
+
+def test_from_env(monkeypatch):
+    policy = ThreadPolicy.from_env()
+    assert (policy.workers, policy.threads, policy.inter_op_threads, policy.affinity) == (1, 8, 2, False)
+
+    monkeypatch.setenv('RLDECON_WORKERS', '3')
+    assert ThreadPolicy.from_env().threads == 2
+    monkeypatch.setenv('RLDECON_THREADS', '1')
+    monkeypatch.setenv('RLDECON_AFFINITY', '1')
+    policy = ThreadPolicy.from_env()
+    assert (policy.workers, policy.threads, policy.inter_op_threads, policy.affinity) == (3, 1, 1, True)
+    monkeypatch.setenv('RLDECON_AFFINITY', '0')
+    assert not ThreadPolicy.from_env().affinity
+    monkeypatch.setenv('RLDECON_WORKERS', 'two')
+    with pytest.raises(ValueError):
+        ThreadPolicy.from_env()
+
+
+def test_more_workers_than_cores_get_one_thread_each():
+    assert ThreadPolicy(workers=32).threads == 1
+    assert ThreadPolicy(workers=0).workers == 1
+
+
+def test_apply_sets_library_limits(capsys):
+    # Pools of an imported numpy can only be limited through threadpoolctl
+    import numpy
+    assert threads.fft_workers() == -1 and threads.current_policy() is None
+    policy = ThreadPolicy(workers=2, threads=3).apply()
+    assert all(os.environ[var] == '3' for var in THREAD_ENV_VARS)
+    assert os.environ['TF_NUM_INTEROP_THREADS'] == '2'
+    assert threads.current_policy() is policy and threads.fft_workers() == 3
+    try:
+        import threadpoolctl
+    except ImportError:
+        assert 'threadpoolctl is not installed' in capsys.readouterr().out
+
+
+def test_package_import_applies_policy_from_env():
+    env = dict(os.environ, RLDECON_THREADS='3', PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    code = ('import RLDecon, os\nfrom RLDecon.threads import fft_workers\n'
+            'print(os.environ["OMP_NUM_THREADS"], os.environ["MKL_NUM_THREADS"], fft_workers())')
+    output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True).stdout
+    assert output.split()[-3:] == ['3', '3', '3']
+
+
+def test_pin_gives_each_worker_its_own_cores(monkeypatch):
+    pinned = []
+    monkeypatch.setattr(os, 'sched_setaffinity', lambda tid, cores: pinned.append(cores), raising=False)
+    policy = ThreadPolicy(workers=3, threads=2, affinity=True)
+    policy._cores = list(range(8))
+    assert [policy.pin() for _ in range(4)] == [{0, 1}, {2, 3}, {4, 5}, {0, 1}]
+    assert policy.pin(2) == {4, 5} and len(pinned) == 5
+    assert ThreadPolicy(workers=3, threads=2).pin() is None
+
+
+def test_cli_options(monkeypatch):
+    parser = argparse.ArgumentParser()
+    add_thread_arguments(parser)
+    policy = policy_from_args(parser.parse_args(['--threads', '2', '--affinity']), workers=4)
+    assert (policy.workers, policy.threads, policy.affinity) == (4, 2, True)
+    assert threads.current_policy() is policy
@@ -0,0 +1,58 @@
+import json
+import os
+import threading
+
+import numpy as np
+import pytest
+import tifffile
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('flowdec')
+
+from RLDecon.watch import MANIFEST_NAME, FolderWatcher
+
+PSF = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PSFs', '488PSF_sigma.csv')
+
+
+def run_once(watcher):
+    # A hanging --once run fails the test instead of the whole suite
+    thread = threading.Thread(target=watcher.run, kwargs={'interval': 0.01, 'once': True}, daemon=True)
+    thread.start()
+    thread.join(timeout=20)
+    assert not thread.is_alive(), 'once=True did not finish'
+
+
+def test_once_gives_up_on_truncated_tif(tmp_path):
+    file_str = str(tmp_path / 'broken.tif')
+    tifffile.imwrite(file_str, np.zeros((5, 64, 64), np.uint16))
+    with open(file_str, 'r+b') as f:
+        f.truncate(100)
+    watcher = FolderWatcher(str(tmp_path), [PSF], settle=0, timeout=0.05)
+    run_once(watcher)
+    with open(os.path.join(watcher.output_dir, MANIFEST_NAME)) as f:
+        entry = json.load(f)['broken.tif']
+    assert entry['status'] == 'failed' and entry['error'] == 'unreadable'
+
+    # Left alone by the next run, and picked up again once it is rewritten
+    watcher = FolderWatcher(str(tmp_path), [PSF], settle=0, timeout=0.05)
+    assert watcher.poll(once=True) == (0, 0)
+    with open(file_str, 'ab') as f:
+        f.write(b'\0' * 10)
+    assert watcher.poll(once=True) == (0, 1)
+
+
+def test_once_does_not_wait_for_files_that_keep_changing(tmp_path, monkeypatch):
+    file_str = str(tmp_path / 'growing.tif')
+    tifffile.imwrite(file_str, np.zeros((5, 64, 64), np.uint16))
+    watcher = FolderWatcher(str(tmp_path), [PSF], settle=0, timeout=0.05)
+    sizes = iter(range(10**6))
+    stat = os.stat
+
+    def growing(path, *args, **kwargs):
+        result = stat(path, *args, **kwargs)
+        if path == file_str:
+            return os.stat_result((result.st_mode, 0, 0, 0, 0, 0, next(sizes), 0, 0, 0))
+        return result
+    monkeypatch.setattr(os, 'stat', growing)
+    run_once(watcher)
+    assert 'growing.tif' not in watcher.manifest
@@ -0,0 +1,82 @@
+import collections
+
+import numpy as np
+import pytest
+import scipy.fft
+
+from RLDecon.kernels import kernel_to_otf
+from RLDecon.wiener import WienerDeconvolver
+
+Acquisition = collections.namedtuple('Acquisition', ['data', 'kernel'])
+
+
+def kernel():
+    z, y, x = np.mgrid[-3:4, -3:4, -3:4]
+    kernel = np.exp(-(z**2/3 + y**2/2 + x**2/2)).astype(np.float32)
+    return kernel / kernel.sum()
+
+
+def scene():
+    # Blobs rather than single voxels, so the scene lies in the band the kernel passes
+    rng = np.random.default_rng(0)
+    grid = np.indices((16, 32, 32))
+    truth = np.full((16, 32, 32), 100, np.float32)
+    for centre in rng.integers(4, 12, size=(6, 3)) * [1, 2, 2]:
+        truth += 2000 * np.exp(-sum((g - c)**2 for g, c in zip(grid, centre)) / 4.5).astype(np.float32)
+    return truth
+
+
+def blur(volume):
+    # Circular convolution, so without padding the filter is the exact inverse up to regularisation
+    otf = kernel_to_otf(kernel(), volume.shape)
+    return scipy.fft.irfftn(scipy.fft.rfftn(volume) * otf, volume.shape).astype(np.float32)
+
+
+def test_weak_regularization_inverts_a_circular_blur():
+    truth = scene()
+    result = WienerDeconvolver(pad_amount=0, regularization=1e-7).deconvolve(blur(truth), kernel())
+    assert result.dtype == np.float32 and result.shape == truth.shape
+    assert np.abs(result - truth).max() < 1e-3 * truth.max()
+
+
+def test_preview_sharpens_padded_volumes():
+    truth = scene()
+    blurred = blur(truth)
+    result = WienerDeconvolver(pad_amount=4).deconvolve(blurred, kernel())
+    assert result.shape == truth.shape and result.min() >= 0
+    assert np.linalg.norm(result - truth) < 0.5 * np.linalg.norm(blurred - truth)
+
+
+def test_regularization_smooths():
+    blurred = blur(scene())
+    weak, strong = (WienerDeconvolver(4, regularization).deconvolve(blurred, kernel()) for regularization in (0.001, 1.0))
+    assert np.abs(strong - blurred).max() < np.abs(weak - blurred).max()
+    assert strong.max() < weak.max()
+
+
+def test_filters_are_cached_per_kernel_and_shape():
+    engine = WienerDeconvolver(4)
+    k = kernel()
+    assert engine.get_filter(k, (24, 40, 40)) is engine.get_filter(k, (24, 40, 40))
+    assert engine.get_filter(k, (24, 40, 40)) is not engine.get_filter(k, (24, 40, 48))
+    engine.clear_cache()
+    assert len(engine._filters) == 0
+
+
+def test_run_takes_flowdec_acquisitions():
+    blurred = blur(scene())
+    result = WienerDeconvolver(4).initialize().run(Acquisition(blurred, kernel()), niter=10)
+    assert isinstance(result, Acquisition)
+    assert np.array_equal(result.data, WienerDeconvolver(4).deconvolve(blurred, kernel()))
+
+
+def test_preview_mode_output_name(tmp_path):
+    pytest.importorskip('tensorflow')
+    pytest.importorskip('flowdec')
+    from RLDecon.run_decon import run_5d_decon
+
+    data = blur(scene()).astype(np.uint16)[None]
+    resolution = (9615384, 1000000)
+    output_file_str = run_5d_decon(str(tmp_path / 'input.tif'), data, {'spacing': 0.27}, [kernel()], resolution,
+                                   resolution, 2.7, 10, 4, 1, mode='preview')
+    assert output_file_str == str(tmp_path / 'inputwienerPreview_padding4_channels1.tif')
@@ -0,0 +1,66 @@
+import argparse
+
+import numpy as np
+import pytest
+import tifffile
+
+from RLDecon.writer import add_write_arguments, write_options_from_args, write_output
+
+RESOLUTION = (9615384, 1000000)
+
+
+def hyperstack():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 4000, size=(2, 6, 2, 32, 48)).astype(np.uint16)
+
+
+@pytest.mark.parametrize('options', [{}, {'compression': 'none'}, {'compression': 'zlib', 'level': 6, 'maxworkers': 4},
+                                     {'compression': 'zlib', 'rowsperstrip': 8}, {'compression': 'zlib', 'tile': (16, 16)}])
+def test_round_trip(tmp_path, options):
+    data = hyperstack()
+    output_file_str = str(tmp_path / 'out.tif')
+    write_output(output_file_str, data, {'spacing': 0.27, 'axes': 'TZCYX'}, RESOLUTION, **options)
+    with tifffile.TiffFile(output_file_str) as tif:
+        assert np.array_equal(tif.asarray(), data)
+        assert tif.is_imagej and tif.imagej_metadata['frames'] == 2 and tif.imagej_metadata['channels'] == 2
+        page = tif.pages[0]
+        expected = tifffile.COMPRESSION.ADOBE_DEFLATE if options.get('compression') == 'zlib' else tifffile.COMPRESSION.NONE
+        assert page.compression == expected
+        assert page.is_tiled == ('tile' in options)
+        if 'rowsperstrip' in options:
+            assert page.rowsperstrip == 8
+    assert not (tmp_path / 'out.tif.tmp').exists()
+
+
+def test_zstd_round_trip(tmp_path):
+    pytest.importorskip('imagecodecs')
+    data = hyperstack()
+    output_file_str = write_output(str(tmp_path / 'out.tif'), data, compression='zstd', level=3)
+    assert np.array_equal(tifffile.imread(output_file_str), data)
+
+
+def test_results_are_converted_to_uint16(tmp_path):
+    output_file_str = write_output(str(tmp_path / 'out.tif'), np.full((1, 2, 1, 4, 4), 7.6, np.float32))
+    result = tifffile.imread(output_file_str)
+    assert result.dtype == np.uint16 and (result == 7).all()
+
+
+def test_failed_write_leaves_existing_output(tmp_path, monkeypatch):
+    output_file_str = str(tmp_path / 'out.tif')
+    write_output(output_file_str, hyperstack())
+
+    def fail(*args, **kwargs):
+        raise OSError('share went away')
+    monkeypatch.setattr(tifffile, 'imwrite', fail)
+    with pytest.raises(OSError):
+        write_output(output_file_str, np.zeros((1, 2, 1, 4, 4), np.uint16))
+    assert np.array_equal(tifffile.imread(output_file_str), hyperstack())
+
+
+def test_cli_options():
+    parser = argparse.ArgumentParser()
+    add_write_arguments(parser)
+    options = write_options_from_args(parser.parse_args(['--compression', 'zlib', '--compression_level', '3',
+                                                         '--tile', '64', '64', '--write_workers', '2']))
+    assert options == {'compression': 'zlib', 'level': 3, 'tile': [64, 64], 'rowsperstrip': None, 'maxworkers': 2}
+    assert write_options_from_args(parser.parse_args([]))['compression'] == 'none'